@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""Times matching the files of a directory against mediamirror's conversions,
+comparing the old loop over every extension (with endswith on every name) with
+the single extension lookup per file used by plan_directory.
+
+	python3 benchmarks/bench_dispatch.py [--files N] [--extensions N] [--repeat N]
+"""
+
+import os
+import sys
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import mediamirror
+
+# Extensions that appear in a media library but aren't mirrored
+other_extensions = [ 'cue', 'log', 'txt', 'nfo', 'pdf', 'sfv', 'md5', 'accurip' ]
+
+
+def make_names(count):
+	extensions = sorted(mediamirror.conversions.keys()) + other_extensions
+	return [ '%05d track.%s' % (i, extensions[i % len(extensions)]) for i in range(count) ]
+
+
+def add_extensions(count):
+	"""Registers extra copy conversions, as --conversion would."""
+	for i in range(count):
+		mediamirror.register_conversion('x%02d' % i, 'x%02d' % i, mediamirror.copy_file)
+
+
+def old_dispatch(names):
+	matched = []
+	for ext in list(mediamirror.conversions.keys()):
+		(dest_ext, convert_fn, priority) = mediamirror.conversions[ext]
+		for filename in names:
+			if not filename.endswith(ext):
+				continue
+			matched.append((filename, dest_ext, convert_fn))
+	return matched
+
+
+def new_dispatch(names):
+	matched = []
+	for filename in names:
+		conversion = mediamirror.lookup_conversion(filename)
+		if conversion is None:
+			continue
+		(ext, dest_ext, convert_fn, priority) = conversion
+		matched.append((filename, dest_ext, convert_fn))
+	return matched
+
+
+def measure(label, fn, names, repeat):
+	best = None
+	for i in range(repeat):
+		start = time.perf_counter()
+		matched = fn(names)
+		elapsed = time.perf_counter() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	print('%-8s %8.2fms  %d matched' % (label, best * 1000, len(matched)))
+	return best
+
+
+def main():
+	parser = OptionParser(usage="Usage: %prog [options]")
+	parser.add_option("--files", type="int", default=10000)
+	parser.add_option("--extensions", type="int", default=0,
+					  help="Extra conversions to register on top of the defaults")
+	parser.add_option("--repeat", type="int", default=5)
+	(options, args) = parser.parse_args()
+
+	add_extensions(options.extensions)
+	names = make_names(options.files)
+	print('%d files, %d conversions' % (len(names), len(mediamirror.conversions)))
+	old = measure('per-ext', old_dispatch, names, options.repeat)
+	new = measure('lookup', new_dispatch, names, options.repeat)
+	print('Speedup %.1fx' % (old / new))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Compares the transcoding throughput of the encoder profiles in flac2mp3 on a
+generated test FLAC. Needs the flac executable, plus whichever encoders the
+profiles use (profiles whose encoder isn't installed are skipped).
+
+	python3 benchmarks/bench_encoders.py [--seconds N] [--profile NAME ...]
+"""
+
+import os
+import sys
+import math
+import time
+import wave
+import array
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import flac2mp3
+
+rate = 44100
+
+
+def make_wav(path, seconds):
+	"""A stereo 16-bit chord with a little noise, so the encoders have some work to do."""
+	samples = array.array('h')
+	noise = 12345
+	for i in range(int(seconds * rate)):
+		t = float(i) / rate
+		value = 0.3 * math.sin(2 * math.pi * 220 * t) + 0.2 * math.sin(2 * math.pi * 277.2 * t)
+		noise = (noise * 1103515245 + 12345) & 0x7fffffff
+		value += 0.05 * (noise / float(0x7fffffff) - 0.5)
+		sample = int(value * 32767)
+		samples.append(sample)
+		samples.append(-sample)
+	if sys.byteorder == 'big':
+		samples.byteswap()
+	w = wave.open(path, 'wb')
+	w.setnchannels(2)
+	w.setsampwidth(2)
+	w.setframerate(rate)
+	w.writeframes(samples.tobytes())
+	w.close()
+
+
+def encoder_exe(profile):
+	exe = flac2mp3.encoder_profiles[profile][0][0]
+	return exe.replace('{lame}', flac2mp3.lame_exe)
+
+
+def main():
+	parser = OptionParser(usage="Usage: %prog [options]")
+	parser.add_option("--seconds", type="float", default=60.0,
+					  help="Length of the test audio [default: %default].")
+	parser.add_option("--profile", dest="profiles", action="append",
+					  help="A profile to test (may be repeated) [default: all].")
+	parser.add_option("--repeat", type="int", default=3,
+					  help="Encode each profile this many times and take the best [default: %default].")
+	(options, args) = parser.parse_args()
+
+	if shutil.which(flac2mp3.flac_exe) is None:
+		parser.error("The flac executable (%s) is needed to make the test file." % flac2mp3.flac_exe)
+	profiles = options.profiles or sorted(flac2mp3.encoder_profiles.keys())
+
+	tmp = tempfile.mkdtemp(prefix='bench_encoders_')
+	try:
+		wav = os.path.join(tmp, 'test.wav')
+		flac = os.path.join(tmp, 'test.flac')
+		make_wav(wav, options.seconds)
+		subprocess.check_call([flac2mp3.flac_exe, '--silent', '-o', flac, wav])
+		print('%.0f seconds of audio, %d byte FLAC' % (options.seconds, os.path.getsize(flac)))
+		print('%-12s %8s %10s %10s' % ('profile', 'seconds', 'realtime', 'bytes'))
+		for profile in profiles:
+			if shutil.which(encoder_exe(profile)) is None:
+				print('%-12s skipped, %s is not installed' % (profile, encoder_exe(profile)))
+				continue
+			flac2mp3.encoder_profile = profile
+			out = os.path.join(tmp, 'out.' + flac2mp3.encoder_extension())
+			best = None
+			for i in range(options.repeat):
+				start = time.time()
+				ok = flac2mp3.encode_file(flac, out)
+				elapsed = time.time() - start
+				if not ok:
+					break
+				best = elapsed if best is None else min(best, elapsed)
+			if best is None:
+				print('%-12s failed' % profile)
+				continue
+			print('%-12s %8.2f %9.1fx %10d' % (profile, best, options.seconds / best, os.path.getsize(out)))
+			os.remove(out)
+	finally:
+		shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+	main()
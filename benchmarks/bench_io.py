@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Times walking the source and planning a mirror (checking every destination
+and scanning it for things to prune) on a simulated network share, where each
+stat and directory listing takes --latency seconds (see slowfs.py), with the
+file system operations made one at a time and through ioengine with
+--concurrency of them in flight.
+
+	python3 benchmarks/bench_io.py [--artists N] [--albums N] [--tracks N] [--latency S] [--concurrency N]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from optparse import OptionParser
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+sys.path.insert(0, os.path.join(here, os.pardir))
+import walker
+import mediamirror
+from synthlib import empty_tree
+from ioengine import IOEngine
+from pathtree import PathTree
+from slowfs import SlowFS
+
+
+def walk(source, io):
+	return sum(1 for d in walker.walk(source, mediamirror.excluded_paths, io))
+
+
+def plan(source, io):
+	mediamirror.io_engine = io
+	mediamirror.mirrored = PathTree(mediamirror.dest_root)
+	return len(list(mediamirror.plan_mirror([ mediamirror.source_root ], True)))
+
+
+def measure(label, fn, source, concurrency, latency):
+	io = IOEngine(concurrency)
+	try:
+		with SlowFS(latency) as fs:
+			start = time.perf_counter()
+			result = fn(source, io)
+			elapsed = time.perf_counter() - start
+	finally:
+		io.close()
+	print('%-6s concurrency %-3d %8.3fs  %6d operations  (%d results)' % (label, concurrency, elapsed, fs.calls, result))
+
+
+def main():
+	parser = OptionParser(usage="Usage: %prog [options]")
+	parser.add_option("--artists", type="int", default=20)
+	parser.add_option("--albums", type="int", default=3)
+	parser.add_option("--tracks", type="int", default=10)
+	parser.add_option("--latency", type="float", default=0.002)
+	parser.add_option("--concurrency", type="int", default=32)
+	(options, args) = parser.parse_args()
+
+	mediamirror.log.setLevel(mediamirror.logging.WARNING)
+	temp = tempfile.mkdtemp(prefix='bench_io_')
+	try:
+		source = os.path.join(temp, 'source')
+		dest = os.path.join(temp, 'dest')
+		empty_tree(source, options.artists, options.albums, options.tracks, '.mp3')
+		# An up to date mirror, apart from a few albums that need pruning
+		shutil.copytree(source, dest, ignore=shutil.ignore_patterns('.@__thumb'))
+		empty_tree(os.path.join(dest, 'gone'), 2, options.albums, options.tracks, '.mp3')
+		mediamirror.source_root = source + os.sep
+		mediamirror.dest_root = dest + os.sep
+		print('%d albums of %d tracks, %.1fms a round trip' %
+		      (options.artists * options.albums, options.tracks, options.latency * 1000))
+		for (label, fn) in [ ('walk', walk), ('plan', plan) ]:
+			for concurrency in [ 1, options.concurrency ]:
+				measure(label, fn, source, concurrency, options.latency)
+	finally:
+		shutil.rmtree(temp)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""Times mediamirror and playlist.py over the life of a synthetic library (see
+synthlib.py): the initial mirror, a rerun with nothing to do, a rerun after
+some tracks have been re-tagged, after some albums have been moved and after
+some have been deleted (so they are pruned).
+
+Each run is a separate process, as it would be from cron, so the times include
+starting Python. mediamirror's counters are read back from its --events log.
+The results are written as JSON, so those from two versions can be compared.
+If flac or lame aren't installed, flac files are copied rather than transcoded
+(and "transcode" is false in the results).
+
+	python3 benchmarks/bench_library.py [--artists N] [--albums N] [--tracks N] [--jobs N] [--output FILE]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+here = os.path.dirname(os.path.abspath(__file__))
+top = os.path.join(here, os.pardir)
+sys.path.insert(0, here)
+import synthlib
+
+from mutagen.flac import FLAC
+
+
+def library_files(root, ext):
+	for (dirpath, dirnames, filenames) in os.walk(root):
+		dirnames.sort()
+		for name in sorted(filenames):
+			if name.endswith(ext):
+				yield os.path.join(dirpath, name)
+
+
+def albums(root):
+	for artist in sorted(os.listdir(root)):
+		path = os.path.join(root, artist)
+		if os.path.isdir(path):
+			for album in sorted(os.listdir(path)):
+				if os.path.isdir(os.path.join(path, album)):
+					yield os.path.join(path, album)
+
+
+def retag(source, every):
+	"""Changes the title of every every'th track."""
+	for (i, path) in enumerate(library_files(source, '.flac')):
+		if i % every == 0:
+			flac = FLAC(path)
+			flac['title'] = flac['title'][0] + ' (remastered)'
+			flac.save()
+
+
+def move(source, every):
+	"""Renames every every'th album."""
+	for (i, path) in enumerate(list(albums(source))):
+		if i % every == 0:
+			os.rename(path, path + ' (deluxe)')
+
+
+def delete(source, every):
+	"""Deletes every every'th album."""
+	for (i, path) in enumerate(list(albums(source))):
+		if i % every == 1:
+			shutil.rmtree(path)
+
+
+def run(command):
+	start = time.perf_counter()
+	done = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+	elapsed = time.perf_counter() - start
+	if done.returncode != 0:
+		sys.stderr.write(done.stderr.decode(errors='replace'))
+		raise subprocess.CalledProcessError(done.returncode, command)
+	return elapsed
+
+
+def last_run_event(path):
+	"""Returns the 'run' event mediamirror logged last."""
+	found = None
+	with open(path) as f:
+		for line in f:
+			event = json.loads(line)
+			if event['event'] == 'run':
+				found = event
+	return found
+
+
+def git_revision():
+	try:
+		return subprocess.check_output([ 'git', 'describe', '--always', '--dirty' ], cwd=top,
+		                               stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def main():
+	parser = OptionParser(usage="Usage: %prog [options]")
+	parser.add_option("--artists", type="int", default=10)
+	parser.add_option("--albums", type="int", default=3)
+	parser.add_option("--tracks", type="int", default=10)
+	parser.add_option("--seconds", type="float", default=2.0)
+	parser.add_option("--jobs", type="int", default=4)
+	parser.add_option("--every", type="int", default=5,
+					  help="Re-tag, move and delete every Nth track or album [default: %default]")
+	parser.add_option("--no-transcode", action="store_true", default=False,
+					  help="Copy flac files rather than transcoding them, even if flac and lame are installed")
+	parser.add_option("--output", default=None,
+					  help="Write the results to this file rather than standard output")
+	parser.add_option("--keep", action="store_true", default=False,
+					  help="Don't delete the library and mirror afterwards")
+	(options, args) = parser.parse_args()
+
+	transcode = not options.no_transcode and all(shutil.which(exe) for exe in ('flac', 'lame'))
+	temp = tempfile.mkdtemp(prefix='bench_library_')
+	source = os.path.join(temp, 'source')
+	dest = os.path.join(temp, 'dest')
+	events = os.path.join(temp, 'events.jsonl')
+	playlist = os.path.join(temp, 'chronological.m3u')
+	mirror = [ sys.executable, os.path.join(top, 'mediamirror.py'), '-s', source, '-d', dest,
+	           '-p', '--state', '-j', str(options.jobs), '--events', events ]
+	if not transcode:
+		mirror += [ '--conversion', 'flac=flac:copy:10' ]
+	playlister = [ sys.executable, os.path.join(top, 'playlist.py'), '-s', source, '-o', playlist,
+	               '-c', os.path.join(temp, 'playlist-cache.db'), '-j', str(options.jobs) ]
+
+	scenarios = [
+		('initial', None),
+		('noop', None),
+		('retag', retag),
+		('move', move),
+		('prune', delete),
+		]
+	results = dict(
+		python=sys.version.split()[0],
+		revision=git_revision(),
+		time=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+		transcode=transcode,
+		jobs=options.jobs,
+		library=dict(artists=options.artists, albums=options.albums, tracks=options.tracks,
+		             seconds=options.seconds),
+		scenarios=list())
+	try:
+		start = time.perf_counter()
+		results['library']['flac_files'] = synthlib.generate(source, options.artists, options.albums,
+		                                                options.tracks, options.seconds)
+		results['library']['generate_seconds'] = round(time.perf_counter() - start, 3)
+		for (name, change) in scenarios:
+			if change is not None:
+				# Mirrored files get their source's mtime rounded up to an even
+				# second, so a change made sooner than that wouldn't be seen
+				time.sleep(2.1)
+				change(source, options.every)
+			mirror_seconds = run(mirror)
+			event = last_run_event(events)
+			playlist_seconds = run(playlister)
+			results['scenarios'].append(dict(
+				name=name,
+				mirror_seconds=round(mirror_seconds, 3),
+				playlist_seconds=round(playlist_seconds, 3),
+				counters=event['counters'],
+				stages=event['stages']))
+	finally:
+		if options.keep:
+			sys.stderr.write('Library and mirror left in %s\n' % temp)
+		else:
+			shutil.rmtree(temp)
+
+	sys.stderr.write('%-10s %10s %10s  %s\n' % ('scenario', 'mirror', 'playlist', 'counters'))
+	for scenario in results['scenarios']:
+		counters = ' '.join('%s=%d' % item for item in sorted(scenario['counters'].items())
+		                    if not item[0].startswith('bytes'))
+		sys.stderr.write('%-10s %9.2fs %9.2fs  %s\n' % (scenario['name'], scenario['mirror_seconds'],
+		                                                scenario['playlist_seconds'], counters))
+	if options.output is None:
+		json.dump(results, sys.stdout, indent=1, sort_keys=True)
+		sys.stdout.write('\n')
+	else:
+		with open(options.output, 'w') as f:
+			json.dump(results, f, indent=1, sort_keys=True)
+			f.write('\n')
+
+
+if __name__ == "__main__":
+	main()
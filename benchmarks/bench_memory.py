@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""Measures the peak memory (with tracemalloc) of the set of mirrored paths for
+a generated library, comparing a set of absolute path strings (with every
+parent directory added, as mediamirror used to) with pathtree.PathTree. No
+files are created; the paths are only generated.
+
+	python3 benchmarks/bench_memory.py [--artists N] [--albums N] [--tracks N]
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from pathtree import PathTree
+
+dest_root = '/share/Music/Portable/'
+
+
+def generate(artists, albums, tracks):
+	"""Yields the destination paths for each album: (directory, [files])."""
+	for a in range(artists):
+		artist = 'Artist Name %04d' % a
+		for b in range(albums):
+			album = os.path.join(dest_root, artist, '%d - Album Title %03d' % (1970 + b % 50, b))
+			files = [ os.path.join(album, '%02d - Some Track Title %02d.mp3' % (t + 1, t)) for t in range(tracks) ]
+			files.append(os.path.join(album, 'folder.jpg'))
+			yield (album, files)
+
+
+def build_set(albums):
+	mirrored = set()
+	for (directory, files) in albums:
+		for path in files:
+			mirrored.add(path)
+		while directory not in mirrored:
+			mirrored.add(directory)
+			(directory, tail) = os.path.split(directory)
+			if len(tail) == 0:
+				break
+	return mirrored
+
+
+def build_tree(albums):
+	mirrored = PathTree(dest_root)
+	for (directory, files) in albums:
+		for path in files:
+			mirrored.add(path)
+	return mirrored
+
+
+def measure(label, fn, options):
+	tracemalloc.start()
+	start = time.perf_counter()
+	mirrored = fn(generate(options.artists, options.albums, options.tracks))
+	elapsed = time.perf_counter() - start
+	(current, peak) = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	print('%-6s %8d entries  %7.1f MB held  %7.1f MB peak  %6.2fs' %
+	      (label, len(mirrored), current / 1048576.0, peak / 1048576.0, elapsed))
+	return mirrored
+
+
+def main():
+	parser = OptionParser(usage="Usage: %prog [options]")
+	parser.add_option("--artists", type="int", default=2000)
+	parser.add_option("--albums", type="int", default=20)
+	parser.add_option("--tracks", type="int", default=12)
+	(options, args) = parser.parse_args()
+
+	print('%d files' % (options.artists * options.albums * (options.tracks + 1)))
+	measure('set', build_set, options)
+	measure('tree', build_tree, options)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""Times the prune on a synthetic destination tree: building the set of
+mirrored paths, finding what to delete (the old get_path_hierachy set
+intersections against mediamirror.find_unmirrored) and deleting it serially
+or in batches on threads.
+
+	python3 benchmarks/bench_prune.py [--artists N] [--albums N] [--tracks N] [--jobs N]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from optparse import OptionParser
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+sys.path.insert(0, os.path.join(here, os.pardir))
+import walker
+import mediamirror
+from pathtree import PathTree
+from synthlib import empty_tree
+
+
+def make_tree(root, artists, albums, tracks):
+	"""Creates the tree, returning the files in it that should be kept. Every
+	fifth album has been removed from the source, as has every tenth track."""
+	return [ path for (b, t, path) in empty_tree(root, artists, albums, tracks, '.mp3', cover=False)
+	         if b % 5 != 4 and t % 10 != 9 ]
+
+
+def get_path_hierachy(path):
+	s = set()
+	s.add(path)
+	(head, tail) = os.path.split(path)
+	if len(tail) > 0:
+		s |= get_path_hierachy(head)
+	return s
+
+
+def old_mirrored(wanted):
+	mirrored = set()
+	for path in wanted:
+		mirrored.add(path)
+		mirrored |= get_path_hierachy(os.path.dirname(path))
+	return mirrored
+
+
+def new_mirrored(wanted, root):
+	mirrored = PathTree(root)
+	for path in wanted:
+		mirrored.add(path)
+	return mirrored
+
+
+def old_find_unmirrored(root, mirrored):
+	to_prune = set()
+	for d in walker.walk(root):
+		for entry in d.dirs + d.links:
+			if entry.path not in mirrored:
+				if len(to_prune & get_path_hierachy(entry.path)) == 0:
+					to_prune.add(entry.path)
+		for filename in d.filenames():
+			filepath = os.path.join(d.path, filename)
+			if filepath not in mirrored:
+				if len(to_prune & get_path_hierachy(filepath)) == 0:
+					to_prune.add(filepath)
+	return sorted(to_prune)
+
+
+def new_find_unmirrored(root, mirrored):
+	mediamirror.dest_root = root
+	mediamirror.mirrored = mirrored
+	(to_prune, orphans) = mediamirror.find_unmirrored()
+	return to_prune
+
+
+def timed(label, fn, *args):
+	start = time.perf_counter()
+	result = fn(*args)
+	print('%-24s %8.3fs' % (label, time.perf_counter() - start))
+	return result
+
+
+def main():
+	parser = OptionParser(usage="Usage: %prog [options]")
+	parser.add_option("--artists", type="int", default=200)
+	parser.add_option("--albums", type="int", default=10)
+	parser.add_option("--tracks", type="int", default=12)
+	parser.add_option("--jobs", type="int", default=8)
+	(options, args) = parser.parse_args()
+
+	mediamirror.log.setLevel(mediamirror.logging.WARNING)
+	temp = tempfile.mkdtemp(prefix='bench_prune_')
+	try:
+		roots = [ os.path.join(temp, 'serial'), os.path.join(temp, 'threads') ]
+		make_tree(roots[0], options.artists, options.albums, options.tracks)
+		wanted = make_tree(roots[1], options.artists, options.albums, options.tracks)
+		print('Tree of %d files, keeping %d' % (options.artists * options.albums * options.tracks, len(wanted)))
+
+		old = timed('mirrored (hierachy sets)', old_mirrored, wanted)
+		new = timed('mirrored (path tree)', new_mirrored, wanted, roots[1])
+		assert all(path in new for path in old if path.startswith(roots[1]))
+
+		old = timed('find (set intersections)', old_find_unmirrored, roots[1], old_mirrored(wanted))
+		new = timed('find (walk order)', new_find_unmirrored, roots[1], new_mirrored(wanted, roots[1]))
+		assert old == new
+		print('%d paths to delete' % len(new))
+
+		serial = [ path.replace(roots[1], roots[0], 1) for path in new ]
+		timed('delete (serial)', mediamirror.prune, serial, 1)
+		timed('delete (%d threads)' % options.jobs, mediamirror.prune, new, options.jobs)
+	finally:
+		shutil.rmtree(temp)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""Kills mediamirror part way through mirroring a synthetic library (see
+synthlib.py), as a container restart would, then reruns it and reports how much
+work the rerun had to do: the jobs it found unfinished in the journal, the
+half written files it removed and how many files it converted, against how
+many were still to do. It exits with an error unless the rerun leaves every
+file complete, having recovered no more jobs than the scheduler can have
+queued (jobs x (queue_depth + 1)). The same killed mirror is also rerun with
+its journal deleted, to count the truncated files then taken to be up to date.
+
+flac files are "converted" by slow_convert below, which writes the destination
+in place a chunk at a time (as a tag rewrite does), so a kill leaves truncated
+files with new mtimes.
+
+	python3 benchmarks/bench_resume.py [--artists N] [--albums N] [--tracks N] [--jobs N] [--kill-after S]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+here = os.path.dirname(os.path.abspath(__file__))
+top = os.path.join(here, os.pardir)
+sys.path.insert(0, here)
+sys.path.insert(0, top)
+import synthlib
+import scheduler
+
+# How slow_convert writes its output
+chunks = 8
+chunk_delay = 0.02
+
+
+def slow_convert(source, dest):
+	"""A conversion handler (for --conversion) that copies source to dest in place, slowly."""
+	os.makedirs(os.path.dirname(dest), exist_ok=True)
+	with open(source, 'rb') as f:
+		data = f.read()
+	size = len(data) // chunks + 1
+	with open(dest, 'wb') as out:
+		for start in range(0, len(data), size):
+			out.write(data[start:start + size])
+			out.flush()
+			time.sleep(chunk_delay)
+	return {'action': 'converted', 'bytes': len(data)}
+
+
+def flacs(source):
+	for (dirpath, dirnames, filenames) in os.walk(source):
+		for name in filenames:
+			if name.endswith('.flac'):
+				yield os.path.join(dirpath, name)
+
+
+def check(source, dest):
+	"""Returns (complete, truncated, missing) counts of the converted flacs in dest."""
+	counts = [ 0, 0, 0 ]
+	for path in flacs(source):
+		converted = path.replace(source, dest, 1)[:-len('.flac')] + '.mp3'
+		if not os.path.exists(converted):
+			counts[2] += 1
+		elif os.path.getsize(converted) == os.path.getsize(path):
+			counts[0] += 1
+		else:
+			counts[1] += 1
+	return tuple(counts)
+
+
+def temporaries(dest):
+	return sum(1 for (dirpath, dirnames, filenames) in os.walk(dest)
+	           for name in filenames if '.part' in name)
+
+
+def counters(events):
+	found = dict()
+	with open(events) as f:
+		for line in f:
+			event = json.loads(line)
+			if event['event'] == 'run':
+				found = event['counters']
+	return found
+
+
+def mirror(source, dest, jobs, events):
+	return [ sys.executable, os.path.join(top, 'mediamirror.py'), '-s', source, '-d', dest,
+	         '--state', '-j', str(jobs), '--events', events,
+	         '--conversion', 'flac=mp3:bench_resume.slow_convert:10' ]
+
+
+def rerun(label, command, source, dest):
+	env = dict(os.environ, PYTHONPATH=here)
+	start = time.perf_counter()
+	subprocess.run(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+	elapsed = time.perf_counter() - start
+	found = counters(command[command.index('--events') + 1])
+	(complete, truncated, missing) = check(source, dest)
+	print('%-12s %6.2fs  %3d jobs recovered, %3d files removed, %3d converted;'
+	      '  then %d complete, %d truncated, %d missing' %
+	      (label, elapsed, found.get('jobs_recovered', 0), found.get('partial_files_removed', 0),
+	       found.get('files_converted', 0), complete, truncated, missing))
+	return (found.get('jobs_recovered', 0), truncated, missing)
+
+
+def main():
+	parser = OptionParser(usage="Usage: %prog [options]")
+	parser.add_option("--artists", type="int", default=10)
+	parser.add_option("--albums", type="int", default=3)
+	parser.add_option("--tracks", type="int", default=10)
+	parser.add_option("--jobs", type="int", default=4)
+	parser.add_option("--kill-after", type="float", default=3.0,
+					  help="Seconds into the first run to kill it [default: %default]")
+	(options, args) = parser.parse_args()
+
+	temp = tempfile.mkdtemp(prefix='bench_resume_')
+	try:
+		source = os.path.join(temp, 'source')
+		dest = os.path.join(temp, 'dest')
+		synthlib.generate(source, options.artists, options.albums, options.tracks, 1.0)
+		total = sum(1 for path in flacs(source))
+
+		# Kill the whole process group, workers and all, with no chance to clean up
+		first = subprocess.Popen(mirror(source, dest, options.jobs, os.path.join(temp, 'first.jsonl')),
+		                         env=dict(os.environ, PYTHONPATH=here), start_new_session=True,
+		                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+		time.sleep(options.kill_after)
+		os.killpg(first.pid, signal.SIGKILL)
+		first.wait()
+		(complete, truncated, missing) = check(source, dest)
+		print('%d flac files; killed after %.1fs with %d complete, %d truncated, %d missing, %d temporary files' %
+		      (total, options.kill_after, complete, truncated, missing, temporaries(dest)))
+
+		unjournalled = os.path.join(temp, 'unjournalled')
+		# Neither is there if the kill came before the run got going, and
+		# there's no journal if it came after the run had finished
+		if os.path.exists(dest):
+			shutil.copytree(dest, unjournalled)
+		journal = os.path.join(unjournalled, '.mediamirror-journal')
+		if os.path.exists(journal):
+			os.remove(journal)
+		(recovered, truncated, missing) = rerun('resumed', mirror(source, dest, options.jobs,
+		                                        os.path.join(temp, 'resumed.jsonl')), source, dest)
+		rerun('no journal', mirror(source, unjournalled, options.jobs, os.path.join(temp, 'unjournalled.jsonl')),
+		      source, unjournalled)
+		limit = options.jobs * (scheduler.queue_depth + 1)
+		if truncated or missing or recovered > limit:
+			print('FAILED: the resumed run left %d truncated and %d missing files, '
+			      'and recovered %d jobs (at most %d expected)' % (truncated, missing, recovered, limit))
+			sys.exit(1)
+	finally:
+		shutil.rmtree(temp)
+
+
+if __name__ == "__main__":
+	main()
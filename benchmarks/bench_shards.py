@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""Mirrors a synthetic library (see synthlib.py) with N --shard processes
+running side by side on this machine, then --merge-shards, and checks the
+result is the same as mirroring it with a single process; then deletes some
+albums and does both again, to check the merge prunes them. Reports how long
+each took and how evenly the shards split the work.
+
+flac files are "converted" by bench_resume.slow_convert, so there is work
+worth sharing out even without flac and lame.
+
+	python3 benchmarks/bench_shards.py [--artists N] [--albums N] [--tracks N] [--shards N]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+here = os.path.dirname(os.path.abspath(__file__))
+top = os.path.join(here, os.pardir)
+sys.path.insert(0, here)
+import synthlib
+from bench_library import albums
+
+
+def mirror(source, dest, *args):
+	return [ sys.executable, os.path.join(top, 'mediamirror.py'), '-s', source, '-d', dest, '--state',
+	         '--conversion', 'flac=mp3:bench_resume.slow_convert:10' ] + list(args)
+
+
+def start(command):
+	return subprocess.Popen(command, env=dict(os.environ, PYTHONPATH=here),
+	                        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+
+def finish(process):
+	(out, err) = process.communicate()
+	if process.returncode != 0:
+		sys.stderr.write(err.decode(errors='replace'))
+		raise subprocess.CalledProcessError(process.returncode, process.args)
+
+
+def converted(events):
+	with open(events) as f:
+		for line in f:
+			event = json.loads(line)
+			if event['event'] == 'run':
+				return event['counters'].get('files_converted', 0)
+	return 0
+
+
+def listing(dest):
+	"""Every file in dest and its size, leaving out mediamirror's own."""
+	found = dict()
+	for (dirpath, dirnames, filenames) in os.walk(dest):
+		for name in filenames:
+			if not name.startswith('.mediamirror-'):
+				path = os.path.join(dirpath, name)
+				found[os.path.relpath(path, dest)] = os.path.getsize(path)
+	return found
+
+
+def sharded(source, dest, temp, count, label):
+	start_time = time.perf_counter()
+	events = [ os.path.join(temp, '%s-%d.jsonl' % (label, index)) for index in range(1, count + 1) ]
+	processes = [ start(mirror(source, dest, '--shard', '%d/%d' % (index, count), '--events', events[index - 1]))
+	              for index in range(1, count + 1) ]
+	for process in processes:
+		finish(process)
+	shards_done = time.perf_counter()
+	finish(start(mirror(source, dest, '--merge-shards', str(count))))
+	merged = time.perf_counter()
+	print('%-8s %d shards %6.2fs, merge %5.2fs; files converted by each: %s' %
+	      (label, count, shards_done - start_time, merged - shards_done,
+	       ', '.join(str(converted(path)) for path in events)))
+
+
+def single(source, dest, label):
+	start_time = time.perf_counter()
+	finish(start(mirror(source, dest, '-p')))
+	print('%-8s 1 process %6.2fs' % (label, time.perf_counter() - start_time))
+
+
+def main():
+	parser = OptionParser(usage="Usage: %prog [options]")
+	parser.add_option("--artists", type="int", default=10)
+	parser.add_option("--albums", type="int", default=3)
+	parser.add_option("--tracks", type="int", default=10)
+	parser.add_option("--shards", type="int", default=4)
+	(options, args) = parser.parse_args()
+
+	temp = tempfile.mkdtemp(prefix='bench_shards_')
+	try:
+		source = os.path.join(temp, 'source')
+		# Playlists are rewritten with the destination's path, so give both
+		# paths of the same length
+		reference = os.path.join(temp, 'single', 'mirror')
+		dest = os.path.join(temp, 'shards', 'mirror')
+		synthlib.generate(source, options.artists, options.albums, options.tracks, 1.0)
+		for (label, change) in [ ('initial', None), ('prune', True) ]:
+			if change:
+				for (i, path) in enumerate(list(albums(source))):
+					if i % 4 == 1:
+						shutil.rmtree(path)
+			single(source, reference, label)
+			sharded(source, dest, temp, options.shards, label)
+			expected = listing(reference)
+			got = listing(dest)
+			if got != expected:
+				print('Mismatch: %d files only in the single mirror, %d only in the sharded one, %d different' %
+				      (len(set(expected) - set(got)), len(set(got) - set(expected)),
+				       sum(1 for name in expected if name in got and got[name] != expected[name])))
+				sys.exit(1)
+			print('%-8s %d files, the same either way' % (label, len(got)))
+	finally:
+		shutil.rmtree(temp)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""Times syncing the tags of a few thousand FLAC/mp3 pairs, with the previous
+tag_sync (a string.Template per frame per file, one status write per frame)
+against flac2mp3.tag_sync: on freshly encoded mp3s (only a placeholder tag, as
+lame writes), on ones that are already up to date, after retitling every FLAC
+and after giving every album new, larger, cover art. Also counts the mp3s
+written and those whose audio had to be moved because the ID3 tag in front of
+it changed size.
+
+	python3 benchmarks/bench_tags.py [--pairs N]
+"""
+
+import os
+import sys
+import time
+import shutil
+import string
+import hashlib
+import tempfile
+from optparse import OptionParser
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+sys.path.insert(0, os.path.join(here, os.pardir))
+import flac2mp3
+import synthlib
+from mutagen.flac import FLAC
+from mutagen.id3 import ID3, ID3NoHeaderError, APIC, TSSE
+
+# An MPEG-1 layer III frame header (128kbps, 44.1kHz) and its 417 byte frame
+mpeg_frame = b'\xff\xfb\x90\x64' + bytes(413)
+
+
+def old_tag_sync(flac_name, mp3_name, flac=None, mp3=None):
+	"""tag_sync as it was, indented with tabs but otherwise unchanged."""
+	if mp3 is None:
+		try:
+			mp3 = ID3(mp3_name)
+		except ID3NoHeaderError:
+			mp3 = ID3()
+	if flac is None:
+		flac = FLAC(flac_name)
+
+	flactags = old_flac_tag_dict(flac)
+	tag_differences = {}
+	tag_index = 1
+
+	for frame in list(flac2mp3.mp3_flac_dict.keys()):
+		mp3_has_frame = True
+		flac_has_frame = True
+		frames_differ = False
+		mp3_value = None
+		flac_value = None
+
+		format, comparator, id3_generator = flac2mp3.mp3_flac_dict[frame]
+
+		try:
+			mp3_value = mp3[frame]
+		except KeyError:
+			mp3_has_frame = False
+
+		try:
+			flac_value = string.Template(format).substitute(flactags)
+		except KeyError:
+			flac_has_frame = False
+
+		if flac_has_frame and mp3_has_frame:
+			frames_differ = not comparator(mp3_value, flac_value)
+
+		if (flac_has_frame and not mp3_has_frame) or frames_differ:
+			tag_differences[frame] = id3_generator(flac_value)
+			flac2mp3.print_status(mp3_name, tag_index, ".")
+		elif not flac_has_frame and mp3_has_frame:
+			tag_differences[frame] = None
+			flac2mp3.print_status(mp3_name, tag_index, "X")
+		else:
+			flac2mp3.print_status(mp3_name, tag_index, " ")
+		tag_index += 1
+
+	mp3_pictures = set((apic.mime, apic.type, picture_hash(apic.data)) for apic in mp3.getall('APIC'))
+	apics = []
+	descs = set()
+	pictures_differ = False
+	for picture in flac.pictures:
+		(mime, data) = flac2mp3.prepare_picture(picture)
+		digest = picture_hash(data)
+		desc = picture.desc
+		if desc in descs:
+			desc = '%s %d' % (desc, picture.type)
+		descs.add(desc)
+		apics.append(APIC(encoding=3, desc=desc, type=picture.type, data=data, mime=mime))
+		if (mime, picture.type, digest) not in mp3_pictures:
+			pictures_differ = True
+			flac2mp3.print_status(mp3_name, tag_index, "P")
+	if pictures_differ:
+		tag_differences['APIC'] = apics
+	print("")
+	for frame in list(tag_differences.keys()):
+		if tag_differences[frame] == None:
+			mp3.delall(frame)
+		else:
+			mp3.setall(frame, tag_differences[frame])
+
+	if len(list(tag_differences.keys())) > 0:
+		mp3.save(mp3_name, v1=1)
+	return flactags['MD5']
+
+
+def picture_hash(data):
+	"""How pictures were compared: by a SHA-1 of their data, every time."""
+	return hashlib.sha1(data).digest()
+
+
+def old_flac_tag_dict(flac):
+	ret = {}
+	for key in list(flac.tags.as_dict().keys()):
+		ret[key.upper()] = flac.tags[key][0]
+	ret['MD5'] = ('%x' % flac.info.md5_signature)
+	if 'TRACKTOTAL' in ret:
+		ret['TOTALTRACKS'] = ret['TRACKTOTAL']
+	if 'DISCTOTAL' in ret:
+		ret['TOTALDISCS'] = ret['DISCTOTAL']
+	if 'TOTALTRACKS' not in ret:
+		ret['TOTALTRACKS'] = ''
+	if 'TOTALDISCS' not in ret:
+		ret['TOTALDISCS'] = ''
+	return ret
+
+
+def cover(album, size):
+	"""An album's cover art: a PNG padded out to size bytes, as real art is tens of kilobytes."""
+	png = synthlib.make_png(64, 64, (album % 256, 40, 40))
+	return png + bytes(max(size - len(png), 0))
+
+
+def make_pairs(root, count):
+	pairs = list()
+	for n in range(count):
+		flac = os.path.join(root, '%05d.flac' % n)
+		synthlib.write_flac(flac, 0.1, n % 30000)
+		synthlib.tag_flac(flac, {
+			'title': 'Track %d' % n, 'artist': 'Artist %d' % (n // 100),
+			'album': 'Album %d' % (n // 10), 'albumartist': 'Artist %d' % (n // 100),
+			'date': '2001-02-03', 'genre': 'Rock', 'tracknumber': str(n % 10 + 1),
+			'totaltracks': '10', 'discnumber': '1', 'totaldiscs': '1',
+			'comment': 'Ripped for the benchmark', 'composer': 'Composer', 'isrc': 'GBAAA0100001',
+			'musicbrainz_albumid': '5b11f4ce-a62d-471e-81fc-a69a8278c7da',
+			'musicbrainz_artistid': '1f9df192-a621-4f54-8850-2c5373b7eac9',
+			'musicbrainz_trackid': '2e5c4d9a-6b5d-4b5b-9d0b-%012d' % n,
+			'artistsort': 'Artist %d, The' % (n // 100),
+		}, cover(n // 10, 30000))
+		pairs.append((flac, os.path.join(root, '%05d.mp3' % n)))
+	return pairs
+
+
+def encode(pairs):
+	"""Replaces every mp3 with a 'fresh encode': audio frames behind lame's placeholder tag."""
+	for (flac, mp3) in pairs:
+		with open(mp3, 'wb') as f:
+			f.write(mpeg_frame * 20)
+		tag = ID3()
+		tag.add(TSSE(encoding=3, text=['LAME 3.100']))
+		tag.save(mp3, v2_version=3)
+
+
+def retitle(pairs):
+	for (flac, mp3) in pairs:
+		tags = FLAC(flac)
+		tags['title'] = tags['title'][0] + ' (remastered edition)'
+		tags.save()
+
+
+def recover(pairs):
+	"""Gives every album new, larger, cover art."""
+	for (n, (flac, mp3)) in enumerate(pairs):
+		tags = FLAC(flac)
+		tags.clear_pictures()
+		tags.save()
+		synthlib.tag_flac(flac, {}, cover(n // 10 + 1000, 40000))
+
+
+def audio_offset(path):
+	"""Where the audio starts: after the ID3v2 tag, whose size is synchsafe."""
+	with open(path, 'rb') as f:
+		header = f.read(10)
+	if header[:3] != b'ID3':
+		return 0
+	return 10 + ((header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9])
+
+
+def measure(label, sync, pairs):
+	before = [ (os.stat(mp3).st_mtime_ns, audio_offset(mp3)) for (flac, mp3) in pairs ]
+	stdout = sys.stdout
+	start = time.perf_counter()
+	with open(os.devnull, 'w') as sys.stdout:
+		for (flac, mp3) in pairs:
+			sync(flac, mp3)
+	sys.stdout = stdout
+	elapsed = time.perf_counter() - start
+	after = [ (os.stat(mp3).st_mtime_ns, audio_offset(mp3)) for (flac, mp3) in pairs ]
+	written = sum(1 for (b, a) in zip(before, after) if b[0] != a[0])
+	moved = sum(1 for (b, a) in zip(before, after) if b[1] != a[1])
+	print('%-10s %-8s %8.3fs  %7.3fms a pair  %5d written  %5d audio moved' %
+	      (label, sync.__name__.replace('_tag_sync', '').replace('tag_sync', 'new'),
+	       elapsed, elapsed * 1000 / len(pairs), written, moved))
+
+
+def main():
+	parser = OptionParser(usage="Usage: %prog [options]")
+	parser.add_option("--pairs", type="int", default=2000)
+	(options, args) = parser.parse_args()
+
+	flac2mp3.log.setLevel(flac2mp3.logging.WARNING)
+	temp = tempfile.mkdtemp(prefix='bench_tags_')
+	try:
+		print('%d FLAC/mp3 pairs' % options.pairs)
+		for sync in [ old_tag_sync, flac2mp3.tag_sync ]:
+			root = os.path.join(temp, sync.__name__)
+			os.mkdir(root)
+			pairs = make_pairs(root, options.pairs)
+			encode(pairs)
+			measure('encoded', sync, pairs)
+			measure('unchanged', sync, pairs)
+			retitle(pairs)
+			measure('retitled', sync, pairs)
+			recover(pairs)
+			measure('new cover', sync, pairs)
+			flac2mp3.art_cache = flac2mp3.ArtCache(flac2mp3.art_cache_bytes)
+	finally:
+		shutil.rmtree(temp)
+
+
+if __name__ == "__main__":
+	main()
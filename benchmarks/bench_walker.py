@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""Counts the directory listings and stat calls made walking a synthetic media
+tree, comparing the old listdir/isdir walk with walker.walk.
+
+	python3 benchmarks/bench_walker.py [--artists N] [--albums N] [--tracks N]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from optparse import OptionParser
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+sys.path.insert(0, os.path.join(here, os.pardir))
+import walker
+from synthlib import empty_tree
+
+excluded_paths = [ ".@__thumb", "_fresh" ]
+
+
+class Counter(object):
+	"""Counts calls to the os functions that hit the file system."""
+	names = [ 'listdir', 'scandir', 'stat', 'lstat' ]
+
+	def __init__(self):
+		self.counts = dict((name, 0) for name in self.names)
+		self.counts['DirEntry.stat'] = 0
+		self.saved = dict()
+
+	def __enter__(self):
+		for name in self.names:
+			self.saved[name] = getattr(os, name)
+			setattr(os, name, self._wrap(name, self.saved[name]))
+		return self
+
+	def __exit__(self, *exc):
+		for name in self.names:
+			setattr(os, name, self.saved[name])
+
+	def _wrap(self, name, fn):
+		counter = self
+		def wrapped(*args, **kwargs):
+			counter.counts[name] += 1
+			result = fn(*args, **kwargs)
+			if name == 'scandir':
+				return CountingScandir(result, counter)
+			return result
+		return wrapped
+
+
+class CountingEntry(object):
+	"""Wraps an os.DirEntry, counting the stat() calls that aren't cached."""
+	def __init__(self, entry, counter):
+		self._entry = entry
+		self._counter = counter
+		self._stat = None
+
+	def __getattr__(self, name):
+		return getattr(self._entry, name)
+
+	def stat(self, **kwargs):
+		if self._stat is None:
+			self._counter.counts['DirEntry.stat'] += 1
+			self._stat = self._entry.stat(**kwargs)
+		return self._stat
+
+
+class CountingScandir(object):
+	def __init__(self, it, counter):
+		self.it = it
+		self.counter = counter
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.it.close()
+
+	def __iter__(self):
+		for entry in self.it:
+			yield CountingEntry(entry, self.counter)
+
+
+def old_dirwalk(dir):
+	"""The walk mediamirror used before walker.py."""
+	yield dir
+	for f in sorted( os.listdir(dir) ):
+		fullpath = os.path.join(dir,f)
+		if os.path.isdir(fullpath) and not os.path.islink(fullpath):
+			for x in old_dirwalk(fullpath):
+				if not walker.is_excluded(x, excluded_paths):
+					yield x
+
+
+def old_run(root):
+	"""Walk, list the files in each directory and get their mtimes."""
+	for directory in old_dirwalk(root):
+		for name in os.listdir(directory):
+			path = os.path.join(directory, name)
+			if not os.path.isdir(path):
+				os.path.getmtime(path)
+
+
+def new_run(root):
+	for d in walker.walk(root, excluded_paths):
+		for entry in d.files.values():
+			entry.stat().st_mtime
+
+
+def measure(label, fn, root):
+	with Counter() as counter:
+		start = time.time()
+		fn(root)
+		elapsed = time.time() - start
+	calls = ', '.join('%s=%d' % (name, counter.counts[name]) for name in sorted(counter.counts))
+	print('%-8s %7.3fs  %s (total %d)' % (label, elapsed, calls, sum(counter.counts.values())))
+
+
+def main():
+	parser = OptionParser(usage="Usage: %prog [options]")
+	parser.add_option("--artists", type="int", default=50)
+	parser.add_option("--albums", type="int", default=4)
+	parser.add_option("--tracks", type="int", default=12)
+	(options, args) = parser.parse_args()
+
+	root = tempfile.mkdtemp(prefix='bench_walker_')
+	try:
+		empty_tree(root, options.artists, options.albums, options.tracks)
+		print('Tree of %d albums with %d tracks each' % (options.artists * options.albums, options.tracks))
+		measure('listdir', old_run, root)
+		measure('scandir', new_run, root)
+	finally:
+		shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+	main()
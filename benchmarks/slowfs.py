@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""A stand-in for a network share on a local disk: while it is in use, every
+metadata operation (stat, directory listing, mkdir, unlink, ...) made through
+the os module, and every os.DirEntry.stat(), first waits for latency seconds,
+like a round trip to an SMB or NFS server. The wait releases the GIL, as real
+network I/O does, so operations made on several threads overlap.
+
+	with SlowFS(0.002) as fs:
+		...
+	print(fs.calls)
+"""
+
+import os
+import time
+import threading
+
+# os functions that are a round trip to the server on a share
+slow_functions = [ 'stat', 'lstat', 'listdir', 'mkdir', 'rmdir', 'unlink', 'remove', 'rename', 'replace', 'utime' ]
+
+
+class SlowFS(object):
+
+	def __init__(self, latency):
+		self.latency = latency
+		self.calls = 0
+		self.lock = threading.Lock()
+		self.saved = dict()
+
+	def wait(self):
+		with self.lock:
+			self.calls += 1
+		time.sleep(self.latency)
+
+	def __enter__(self):
+		for name in slow_functions + [ 'scandir' ]:
+			self.saved[name] = getattr(os, name)
+		for name in slow_functions:
+			setattr(os, name, self._slow(self.saved[name]))
+		setattr(os, 'scandir', self._slow_scandir(self.saved['scandir']))
+		return self
+
+	def __exit__(self, *exc):
+		for (name, fn) in self.saved.items():
+			setattr(os, name, fn)
+
+	def _slow(self, fn):
+		fs = self
+		def slow(*args, **kwargs):
+			fs.wait()
+			return fn(*args, **kwargs)
+		return slow
+
+	def _slow_scandir(self, scandir):
+		fs = self
+		def slow_scandir(*args, **kwargs):
+			fs.wait()
+			return _Scandir(scandir(*args, **kwargs), fs)
+		return slow_scandir
+
+
+class _Entry(object):
+	"""Wraps an os.DirEntry so that its first stat() is slow, as it isn't cached yet."""
+
+	def __init__(self, entry, fs):
+		self._entry = entry
+		self._fs = fs
+		self._stat = None
+
+	def __getattr__(self, name):
+		return getattr(self._entry, name)
+
+	def __fspath__(self):
+		return self._entry.path
+
+	def stat(self, **kwargs):
+		if self._stat is None:
+			self._fs.wait()
+			self._stat = self._entry.stat(**kwargs)
+		return self._stat
+
+
+class _Scandir(object):
+
+	def __init__(self, it, fs):
+		self.it = it
+		self.fs = fs
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.it.close()
+
+	def __iter__(self):
+		for entry in self.it:
+			yield _Entry(entry, self.fs)
+
+	def close(self):
+		self.it.close()
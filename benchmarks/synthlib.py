@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""Generates a synthetic media library for benchmarking: artists with albums of
+small but real FLAC files (tagged, with embedded cover art), a cover image and
+an excluded .@__thumb directory per album, and playlists at several levels.
+
+The FLACs are written in pure Python. Each channel of each block is a FLAC
+CONSTANT subframe, so a track is a few hundred bytes per second of audio, yet
+decodes properly and has a correct STREAMINFO MD5. Every track gets a different
+constant, so no two tracks have the same audio MD5.
+
+	python3 benchmarks/synthlib.py DIR [--artists N] [--albums N] [--tracks N] [--seconds N]
+"""
+
+import os
+import zlib
+import struct
+import hashlib
+from optparse import OptionParser
+
+from mutagen.flac import FLAC, Picture
+
+rate = 44100
+block_size = 4096
+
+# Codes used in the FLAC frame header
+_rate_code = 9         # 44.1kHz
+_block_size_code = 12  # 4096 samples
+_channels_code = 1     # left/right, stored independently
+_sample_size_code = 4  # 16 bits per sample
+
+
+def _crc8(data):
+	crc = 0
+	for byte in data:
+		crc ^= byte
+		for i in range(8):
+			crc = ((crc << 1) ^ 0x07) & 0xff if crc & 0x80 else (crc << 1) & 0xff
+	return crc
+
+
+def _crc16(data):
+	crc = 0
+	for byte in data:
+		crc ^= byte << 8
+		for i in range(8):
+			crc = ((crc << 1) ^ 0x8005) & 0xffff if crc & 0x8000 else (crc << 1) & 0xffff
+	return crc
+
+
+def _utf8_number(n):
+	"""The 'UTF-8' style coding FLAC uses for frame numbers."""
+	if n < 0x80:
+		return bytes([ n ])
+	length = 2
+	while n >= 1 << (5 * length + 1):
+		length += 1
+	out = []
+	for i in range(length - 1):
+		out.insert(0, 0x80 | (n & 0x3f))
+		n >>= 6
+	out.insert(0, ((0xff00 >> length) & 0xff) | n)
+	return bytes(out)
+
+
+def _frame(number, samples, value):
+	header = bytearray([ 0xff, 0xf8 ])
+	if samples == block_size:
+		header.append((_block_size_code << 4) | _rate_code)
+	else:
+		# A short last block: the size (minus one) follows as 16 bits
+		header.append((7 << 4) | _rate_code)
+	header.append((_channels_code << 4) | (_sample_size_code << 1))
+	header += _utf8_number(number)
+	if samples != block_size:
+		header += struct.pack('>H', samples - 1)
+	header.append(_crc8(header))
+	# Two CONSTANT subframes (type 0, no wasted bits), one per channel
+	subframe = b'\x00' + struct.pack('>h', value)
+	frame = bytes(header) + subframe + subframe
+	return frame + struct.pack('>H', _crc16(frame))
+
+
+def write_flac(path, seconds, value):
+	"""Writes a stereo 16-bit FLAC of the given length in which every sample is value."""
+	total = int(seconds * rate)
+	frames = []
+	md5 = hashlib.md5()
+	pair = struct.pack('<hh', value, value)
+	done = 0
+	number = 0
+	while done < total:
+		samples = min(block_size, total - done)
+		frames.append(_frame(number, samples, value))
+		md5.update(pair * samples)
+		done += samples
+		number += 1
+	sizes = [ len(frame) for frame in frames ] or [ 0 ]
+	info = struct.pack('>HH', block_size, block_size)
+	info += min(sizes).to_bytes(3, 'big') + max(sizes).to_bytes(3, 'big')
+	info += ((rate << 44) | (1 << 41) | (15 << 36) | total).to_bytes(8, 'big')
+	info += md5.digest()
+	with open(path, 'wb') as f:
+		f.write(b'fLaC')
+		# STREAMINFO, marked as the last metadata block; mutagen adds the rest
+		f.write(bytes([ 0x80 ]) + len(info).to_bytes(3, 'big') + info)
+		for frame in frames:
+			f.write(frame)
+
+
+def make_png(width, height, colour):
+	"""A plain PNG of one colour, as cover art."""
+	def chunk(kind, data):
+		return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+	row = b'\x00' + bytes(colour) * width
+	return (b'\x89PNG\r\n\x1a\n' +
+	        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+	        chunk(b'IDAT', zlib.compress(row * height)) +
+	        chunk(b'IEND', b''))
+
+
+def tag_flac(path, tags, art=None):
+	flac = FLAC(path)
+	for (key, value) in tags.items():
+		flac[key] = value
+	if art is not None:
+		picture = Picture()
+		picture.type = 3
+		picture.mime = 'image/png'
+		picture.width = picture.height = 64
+		picture.depth = 24
+		picture.data = art
+		flac.add_picture(picture)
+	flac.save()
+
+
+def empty_tree(root, artists, albums, tracks, ext='.flac', cover=True):
+	"""Creates the same shape of tree with empty files, for benchmarks that only
+	walk, stat or delete it: artistNNN/albumNNN directories of tracks (and,
+	with cover, a cover.jpg and an excluded .@__thumb holding another). Returns
+	the tracks made, as (album number, track number, path)."""
+	made = list()
+	for a in range(artists):
+		for b in range(albums):
+			album = os.path.join(root, 'artist%03d' % a, 'album%03d' % b)
+			os.makedirs(album)
+			for t in range(tracks):
+				path = os.path.join(album, '%02d track%s' % (t, ext))
+				open(path, 'w').close()
+				made.append((b, t, path))
+			if cover:
+				os.makedirs(os.path.join(album, '.@__thumb'))
+				open(os.path.join(album, 'cover.jpg'), 'w').close()
+				open(os.path.join(album, '.@__thumb', 'cover.jpg'), 'w').close()
+	return made
+
+
+def generate(root, artists=10, albums=3, tracks=10, seconds=2.0):
+	"""Creates the library under root, returning the number of tracks made."""
+	count = 0
+	artist_playlists = []
+	for a in range(artists):
+		artist = 'Artist %03d' % a
+		artist_tracks = []
+		for b in range(albums):
+			album = '%d - Album %02d' % (1960 + (a * albums + b) % 60, b)
+			album_dir = os.path.join(root, artist, album)
+			os.makedirs(os.path.join(album_dir, '.@__thumb'), exist_ok=True)
+			art = make_png(64, 64, ((a * 37) % 256, (b * 91) % 256, 128))
+			for name in [ 'cover.png', os.path.join('.@__thumb', 'cover.png') ]:
+				with open(os.path.join(album_dir, name), 'wb') as f:
+					f.write(art)
+			for t in range(tracks):
+				name = '%02d - Track %02d.flac' % (t + 1, t + 1)
+				path = os.path.join(album_dir, name)
+				# A different constant for every track, so every audio MD5 differs
+				write_flac(path, seconds, (count % 60000) - 30000)
+				tag_flac(path, {
+					'artist': artist,
+					'album': album[7:],
+					'title': 'Track %02d' % (t + 1),
+					'tracknumber': str(t + 1),
+					'date': album[:4],
+					}, art)
+				artist_tracks.append(os.path.join(album, name))
+				count += 1
+		# A playlist per artist, with paths relative to it
+		playlist = os.path.join(root, artist, 'best of.m3u')
+		with open(playlist, 'w') as f:
+			f.write('#EXTM3U\n')
+			for path in artist_tracks[::3]:
+				f.write('#EXTINF:%d,%s\n%s\n' % (seconds, os.path.basename(path), path))
+		artist_playlists.append(playlist)
+	# And one at the top, with absolute paths
+	with open(os.path.join(root, 'everything.m3u8'), 'w') as f:
+		f.write('#EXTM3U\n')
+		for playlist in artist_playlists:
+			for line in open(playlist):
+				if not line.startswith('#'):
+					f.write(os.path.join(os.path.dirname(playlist), line))
+	return count
+
+
+def main():
+	parser = OptionParser(usage="Usage: %prog [options] DIR")
+	parser.add_option("--artists", type="int", default=10)
+	parser.add_option("--albums", type="int", default=3)
+	parser.add_option("--tracks", type="int", default=10)
+	parser.add_option("--seconds", type="float", default=2.0)
+	(options, args) = parser.parse_args()
+	if len(args) != 1:
+		parser.error("The directory to create the library in must be given.")
+	count = generate(args[0], options.artists, options.albums, options.tracks, options.seconds)
+	print('Made %d tracks in %s' % (count, args[0]))
+
+
+if __name__ == "__main__":
+	main()
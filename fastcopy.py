@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""Copies files as cheaply as the file systems allow: a reflink (a copy-on-write
+clone, e.g. on btrfs or XFS), optionally a hard link, then copy_file_range
+(which lets the kernel, or an NFS/SMB server, do the copy) and finally an
+ordinary copy. Files are written to a temporary name and renamed into place."""
+
+import os
+import errno
+import shutil
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+import logging
+log = logging.getLogger("mediamirror")
+
+# ioctl from <linux/fs.h> that clones one file's data into another
+FICLONE = 0x40049409
+
+# How much copy_file_range is asked to copy at a time
+block_size = 64 * 1024 * 1024
+
+# Errors meaning "this method doesn't work here", rather than a real problem
+_unsupported = set([ errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.ENOTTY,
+                     errno.EOPNOTSUPP, errno.EPERM, errno.EBADF ])
+
+
+def _reflink(source, temp):
+	if fcntl is None:
+		return False
+	with open(source, 'rb') as src, open(temp, 'wb') as dst:
+		try:
+			fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+		except OSError as e:
+			if e.errno in _unsupported:
+				return False
+			raise
+	return True
+
+
+def _copy_file_range(source, temp):
+	if not hasattr(os, 'copy_file_range'):
+		return False
+	with open(source, 'rb') as src, open(temp, 'wb') as dst:
+		copied = 0
+		while True:
+			try:
+				n = os.copy_file_range(src.fileno(), dst.fileno(), block_size)
+			except OSError as e:
+				if copied == 0 and e.errno in _unsupported:
+					return False
+				raise
+			if n == 0:
+				return True
+			copied += n
+
+
+def _link(source, temp):
+	try:
+		os.link(source, temp)
+	except OSError as e:
+		if e.errno in _unsupported or e.errno == errno.EMLINK:
+			return False
+		raise
+	return True
+
+
+def copy(source, dest, hardlink=False, set_mtime=None):
+	"""Copies source to dest, returning how: 'reflinked', 'linked' or 'copied'.
+	Hard links are only used if hardlink is set, as then changing either file
+	changes both. set_mtime(dest, source), if given, is called on the copy
+	before it is renamed into place (a hard link already shares its mtime)."""
+	temp = '%s.%d.part' % (dest, os.getpid())
+	try:
+		if _reflink(source, temp):
+			how = 'reflinked'
+		else:
+			_remove(temp)
+			if hardlink and _link(source, temp):
+				how = 'linked'
+			elif _copy_file_range(source, temp):
+				how = 'copied'
+			else:
+				# shutil uses sendfile where it can
+				shutil.copyfile(source, temp)
+				how = 'copied'
+		if how != 'linked' and set_mtime is not None:
+			set_mtime(temp, source)
+		os.replace(temp, dest)
+	except BaseException:
+		_remove(temp)
+		raise
+	log.debug('%s %s to %s', how.capitalize(), source, dest)
+	return how
+
+
+def _remove(path):
+	try:
+		os.remove(path)
+	except OSError:
+		pass
@@ -11,13 +11,51 @@ log.addHandler(log_console)
 flac_exe = 'flac'
 lame_exe = 'lame'
 
+# Encoder profiles: (command, extension, tag format). The command reads the
+# decoded WAV on stdin and writes '{output}'; '{lame}' is replaced with lame_exe.
+# The tag format is 'id3', 'vorbis' or 'mp4'.
+# We need to pass --tl (or any tag option) to lame to ensure Mutagen can read the file afterwards.
+encoder_profiles = {
+    'lame-v2':     (['{lame}', '--vbr-new', '-V2', '--quiet', '--noreplaygain', '--tl', 'placeholder', '-', '{output}'], 'mp3', 'id3'),
+    'lame-v0':     (['{lame}', '--vbr-new', '-V0', '--quiet', '--noreplaygain', '--tl', 'placeholder', '-', '{output}'], 'mp3', 'id3'),
+    'lame-cbr320': (['{lame}', '--cbr', '-b', '320', '--quiet', '--noreplaygain', '--tl', 'placeholder', '-', '{output}'], 'mp3', 'id3'),
+    'opus':        (['opusenc', '--quiet', '--bitrate', '160', '-', '{output}'], 'opus', 'vorbis'),
+    'aac':         (['ffmpeg', '-loglevel', 'error', '-y', '-f', 'wav', '-i', '-', '-vn', '-c:a', 'aac', '-b:a', '256k', '-f', 'ipod', '{output}'], 'm4a', 'mp4'),
+}
+encoder_profile = 'lame-v2'
+
+# Size of the pipe between the decoder and the encoder (where it can be set)
+pipe_buffer_size = 1024 * 1024
+
+# Optional transcodecache.TranscodeCache of previously transcoded audio
+transcode_cache = None
+
+# Cover art wider or taller than this many pixels is scaled down (once per
+# album) before it is embedded in the mp3s; None embeds pictures unchanged.
+max_art_size = None
+# Upper limit on the memory used to keep prepared cover art between tracks
+art_cache_bytes = 32 * 1024 * 1024
+
 from mutagen.id3 import ID3, ID3NoHeaderError, TALB, TPE1, TPE2, TBPM, COMM, TCMP, TCOM, TPE3, TDRC, TPOS, TCON, TSRC, TEXT, TPUB, TIT2, TRCK, UFID, TXXX, TSOP, TSO2, APIC, TSOT, TSOA
 from mutagen.flac import FLAC
+import mutagen
+import io
+import math
+import base64
 import string
 import sys
 import os.path
+from collections import OrderedDict
 from subprocess import Popen, PIPE
 
+import metrics
+
+# Pillow is only needed to resize cover art (see max_art_size)
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
 def one_to_one_conversion(flac_frame_name, frame_class):
     return (flac_frame_name, lambda mp3, flac: mp3.text[0] == flac, lambda str:[frame_class(encoding=3, text=str)])
 
@@ -60,12 +98,147 @@ mp3_flac_dict = {
     'TXXX:ALBUMARTISTSORT':             one_to_one_conversion_txxx('$ALBUMARTISTSORT', 'ALBUMARTISTSORT'),
 }
 
+def compile_format(format):
+    """Turns a format from mp3_flac_dict, such as '$DISCNUMBER/$TOTALDISCS',
+    into a function of a flac_tag_dict that returns the value, or None if a tag
+    it needs is missing (where string.Template.substitute raises KeyError)."""
+    pieces = []
+    position = 0
+    for match in string.Template.pattern.finditer(format):
+        if match.start() > position:
+            pieces.append((False, format[position:match.start()]))
+        if match.group('escaped') is not None:
+            pieces.append((False, '$'))
+        elif match.group('named') is not None or match.group('braced') is not None:
+            pieces.append((True, match.group('named') or match.group('braced')))
+        else:
+            raise ValueError('Invalid tag format %r' % format)
+        position = match.end()
+    if position < len(format):
+        pieces.append((False, format[position:]))
+    if len(pieces) == 1 and pieces[0][0]:
+        return lambda tags, name=pieces[0][1]: tags.get(name)
+    def value(tags):
+        out = []
+        for (is_name, text) in pieces:
+            if is_name:
+                text = tags.get(text)
+                if text is None:
+                    return None
+            out.append(text)
+        return ''.join(out)
+    return value
+
+def compile_tag_map(mapping):
+    """Precompiles mp3_flac_dict into a list of (frame, value function, getter,
+    comparator, generator). The getter returns the frames already in an ID3
+    tag: a straight lookup for frames whose key is the frame name, or getall
+    for ones such as COMM, whose key also includes a description and language."""
+    compiled = []
+    for frame in mapping:
+        (format, comparator, id3_generator) = mapping[frame]
+        if id3_generator('0')[0].HashKey == frame:
+            getter = lambda mp3, frame=frame: [ mp3[frame] ] if frame in mp3 else []
+        else:
+            getter = lambda mp3, frame=frame: mp3.getall(frame)
+        compiled.append((frame, compile_format(format), getter, comparator, id3_generator))
+    return compiled
+
+# mp3_flac_dict, ready to use; compile it again after changing mp3_flac_dict
+id3_tag_map = compile_tag_map(mp3_flac_dict)
+
+# Spare room left in an ID3 tag that has to grow, so later changes (e.g. new
+# cover art) can still be written in place without moving the audio
+id3_padding = 16 * 1024
+
+def keep_padding(info):
+    """mutagen padding policy: write the tag in place whenever it fits (never
+    shrinking it, as that moves the audio too), otherwise leave id3_padding."""
+    if info.padding >= 0:
+        return info.padding
+    return id3_padding
+
 status_printed=False
 
+class ArtCache(object):
+    """Resized cover art, so each album's art is only resized and re-encoded
+    once. Entries are (original data, mime, data), keyed by something cheap
+    (see prepare_picture). Least recently used entries are
+    dropped to keep within max_bytes."""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if key in self.entries:
+            self.size -= self._bytes(self.entries.pop(key))
+        self.entries[key] = value
+        self.size += self._bytes(value)
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            (old_key, old_value) = self.entries.popitem(last=False)
+            self.size -= self._bytes(old_value)
+
+    def _bytes(self, value):
+        (original, mime, data) = value
+        if data is original:
+            return len(data)
+        return len(original) + len(data)
+
+art_cache = ArtCache(art_cache_bytes)
+resize_warned = False
+
+def resize_picture(mime, data):
+    """Scales a picture down to fit within max_art_size, returning (mime, data)."""
+    global resize_warned
+    if Image is None:
+        if not resize_warned:
+            log.warning("Pillow is not installed, so cover art will not be resized")
+            resize_warned = True
+        return (mime, data)
+    try:
+        image = Image.open(io.BytesIO(data))
+        if max(image.size) <= max_art_size:
+            return (mime, data)
+        image.thumbnail((max_art_size, max_art_size))
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        out = io.BytesIO()
+        image.save(out, 'JPEG', quality=90)
+        return ('image/jpeg', out.getvalue())
+    except Exception:
+        log.warning("Could not resize cover art: %s", sys.exc_info()[1])
+        return (mime, data)
+
+def prepare_picture(picture):
+    """Returns (mime, data) of a FLAC picture as it should be embedded. Art
+    that isn't resized is embedded as it is, without going near the cache.
+    Otherwise the cache is looked up by the picture's mime, type and length,
+    and the entry found checked against the picture's data, which is far
+    cheaper than resizing it again."""
+    if max_art_size is None:
+        return (picture.mime, picture.data)
+    key = (picture.mime, picture.type, len(picture.data), max_art_size)
+    cached = art_cache.get(key)
+    if cached is not None and cached[0] == picture.data:
+        return cached[1:]
+    (mime, data) = resize_picture(picture.mime, picture.data)
+    art_cache.put(key, (picture.data, mime, data))
+    return (mime, data)
+
 def flac_tag_dict(flac):
+    """Returns the first value of each of the FLAC's tags by upper case name,
+    with its audio MD5 and TOTALTRACKS/TOTALDISCS added."""
     ret = {}
-    for key in list(flac.tags.as_dict().keys()):
-        ret[key.upper()] = flac.tags[key][0]
+    if flac.tags is not None:
+        for (key, value) in flac.tags:
+            ret.setdefault(key.upper(), value)
     ret['MD5'] = ('%x' % flac.info.md5_signature)
     if 'TRACKTOTAL' in ret:
         ret['TOTALTRACKS'] = ret['TRACKTOTAL']
@@ -77,22 +250,63 @@ def flac_tag_dict(flac):
         ret['TOTALDISCS'] = ''
     return ret
 
+def flac_md5(flac_name):
+    """Returns the audio MD5 from the FLAC's STREAMINFO block."""
+    return '%x' % FLAC(flac_name).info.md5_signature
+
+def encoder_settings():
+    """The encoder command of the current profile, as used to key the transcode cache."""
+    return encoder_profiles[encoder_profile][0]
+
+def encoder_extension():
+    """The extension of the files made by the current profile."""
+    return encoder_profiles[encoder_profile][1]
+
+def enlarge_pipe(pipe):
+    try:
+        import fcntl
+        # F_SETPIPE_SZ is Linux only (and only named in Python 3.10+)
+        fcntl.fcntl(pipe.fileno(), getattr(fcntl, 'F_SETPIPE_SZ', 1031), pipe_buffer_size)
+    except (ImportError, OSError):
+        pass
+
 def encode_file(flac_name, mp3_name):
-    # We need to pass --tl (or any tag option) to ensure Mutagen can read the file afterwards.
+    (command, ext, tag_format) = encoder_profiles[encoder_profile]
     flac_cmd = [flac_exe, "--decode", "--silent", "--stdout", flac_name]
-    flac = Popen(flac_cmd, stdout=PIPE)
-    lame_cmd = [lame_exe, "--vbr-new", "-V2", "--quiet", "--noreplaygain", "--tl", "placeholder", "-", mp3_name]
-    lame = Popen(lame_cmd, stdin=flac.stdout)
+    flac = Popen(flac_cmd, stdout=PIPE, bufsize=pipe_buffer_size)
+    enlarge_pipe(flac.stdout)
+    lame_cmd = [arg.replace('{lame}', lame_exe).replace('{output}', mp3_name) for arg in command]
+    try:
+        lame = Popen(lame_cmd, stdin=flac.stdout)
+    except OSError:
+        flac.kill()
+        flac.wait()
+        raise
+    # Only the encoder should hold the read end, so the decoder sees it exit
+    flac.stdout.close()
     log.debug("Transcoding command: %s | %s", str(flac_cmd), str(lame_cmd))
-    lame.communicate()
-    lame.wait()
-    flac.wait()
+    with metrics.stage('transcode'):
+        lame.communicate()
+        lame.wait()
+        flac.wait()
     if flac.returncode != 0 or lame.returncode != 0:
         log.error("There was a problem transcoding the file.\n%s returned %d\n%s returned %d",
                   str(flac_cmd), flac.returncode, str(lame_cmd), lame.returncode);
         return False
     return True
 
+def temp_name(path):
+    """Where a file is written before being renamed into place."""
+    (root, ext) = os.path.splitext(path)
+    return '%s.%d.part%s' % (root, os.getpid(), ext)
+
+def set_mtime(dest, source):
+    """Gives dest the source's mtime, so later runs see it as up to date.
+    It's rounded up to an even second so that file systems with coarser
+    timestamps (e.g. FAT, some shares) can't make it look older."""
+    mtime = math.ceil(os.path.getmtime(source) / 2.0) * 2
+    os.utime(dest, (mtime, mtime))
+
 def print_status(file_name, pos, status):
     global status_printed
     if not status_printed:
@@ -101,100 +315,242 @@ def print_status(file_name, pos, status):
             sys.stdout.write(" ")
         status_printed = True
     sys.stdout.write(status)
-    sys.stdout.flush
+    sys.stdout.flush()
 
 def maybe_encode_file(flac_name, mp3_name):
+    """Brings mp3_name up to date with flac_name. If only the tags have changed
+    (the FLAC's STREAMINFO MD5 still matches the MD5 tagged in the mp3) the tags
+    are synced without transcoding. New encodes are written to a temporary file
+    and renamed into place once tagged, and the result is given the FLAC's mtime.
+    Returns a dict with the 'action' taken ('up-to-date', 'tag-synced',
+    'from-cache' or 'transcoded'), the FLAC audio 'md5' and the size of the
+    file written in 'bytes', or False if transcoding failed."""
+    (read_md5, sync) = tag_formats[encoder_profiles[encoder_profile][2]]
+    mp3 = None
     if os.path.isfile(mp3_name):
         if os.path.getmtime(mp3_name) >= os.path.getmtime(flac_name):
-            return
+            return { 'action': 'up-to-date', 'md5': None }
+    # NB: this only reads the FLAC's metadata blocks, not the audio
+    flac = FLAC(flac_name)
+    md5 = '%x' % flac.info.md5_signature
+    if os.path.isfile(mp3_name):
         # Need to check md5 to make sure they're the same:
-        flac = FLAC(flac_name)
-        mp3 = ID3(mp3_name)
         try:
-            if (len(mp3.getall('TXXX:MD5')) == 0) or ('%x' % flac.info.md5_signature) != mp3['TXXX:MD5'].text[0]:
-                try:
-                    mp3_sig = mp3['TXXX:MD5'].text[0]
-                except KeyError:
-                    mp3_sig = 'None'
+            (mp3_md5, mp3) = read_md5(mp3_name)
+            if md5 != mp3_md5:
                 print_status(mp3_name, 0, "R")
-                if not encode_file(flac_name, mp3_name):
-                    return
-        except ID3NoHeaderError:
+                mp3 = None
+            else:
+                print_status(mp3_name, 0, "T")
+        except Exception:
             print_status(mp3_name, 0, "I")
-            encode_file(flac_name, mp3_name)
+            mp3 = None
     else:
         print_status(mp3_name, 0, "E")
-        encode_file(flac_name, mp3_name)
-    tag_sync(flac_name, mp3_name)
-
-def tag_sync(flac_name, mp3_name):
-    mp3 = ID3(mp3_name)
-    flac = FLAC(flac_name)
 
-    flactags = flac_tag_dict(flac)
-    log.debug("Source tags present: %s", '; '.join(sorted(flactags.keys())))
-    log.debug("Destination tags present: %s", '; '.join(sorted(mp3.keys())))
-    tag_differences = {}
-    tag_index = 1
-
-    # First, check whether the tags that can easily be translated match:
-    for frame in list(mp3_flac_dict.keys()):
-        mp3_has_frame = True
-        flac_has_frame = True
-        frames_differ = False
-        mp3_value = None
-        flac_value = None
+    if mp3 is not None:
+        with metrics.stage('tag_sync'):
+            sync(flac_name, mp3_name, flac, mp3)
+        set_mtime(mp3_name, flac_name)
+        return { 'action': 'tag-synced', 'md5': md5, 'bytes': os.path.getsize(mp3_name) }
 
-        format, comparator, id3_generator = mp3_flac_dict[frame]
+    # An MD5 of zero means the encoder didn't record one, so it can't be a cache key
+    cacheable = transcode_cache is not None and flac.info.md5_signature != 0
+    temp = temp_name(mp3_name)
+    try:
+        if cacheable and transcode_cache.fetch(md5, encoder_settings(), temp):
+            action = 'from-cache'
+        elif not encode_file(flac_name, temp):
+            if os.path.exists(temp):
+                os.remove(temp)
+            return False
+        else:
+            action = 'transcoded'
+            if cacheable:
+                # Cache the untagged encode; tag_sync is cheap to redo
+                transcode_cache.store(md5, encoder_settings(), temp)
+        with metrics.stage('tag_sync'):
+            sync(flac_name, temp, flac, None)
+        set_mtime(temp, flac_name)
+        os.replace(temp, mp3_name)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+    return { 'action': action, 'md5': md5, 'bytes': os.path.getsize(mp3_name) }
 
-        try:
-            mp3_value = mp3[frame]
-        except KeyError:
-            mp3_has_frame = False
+def read_md5_id3(mp3_name):
+    """Returns (MD5 from the TXXX:MD5 frame or None, parsed ID3)."""
+    mp3 = ID3(mp3_name)
+    if len(mp3.getall('TXXX:MD5')) == 0:
+        return (None, mp3)
+    return (mp3['TXXX:MD5'].text[0], mp3)
 
+def id3_changes(mp3, flactags, flac):
+    """Compares a parsed ID3 tag with the FLAC's tags (a flac_tag_dict) and
+    pictures in one pass. Returns the frames to replace, as {frame: new frames,
+    or None to delete them}, and a status character for each frame compared."""
+    changes = {}
+    status = []
+    for (frame, value_of, getter, comparator, id3_generator) in id3_tag_map:
+        flac_value = value_of(flactags)
+        current = getter(mp3)
+        if flac_value is None:
+            if current:
+                changes[frame] = None
+                status.append("X")
+            else:
+                status.append(" ")
+            continue
         try:
-            flac_value = string.Template(format).substitute(flactags)
-        except KeyError:
-            flac_has_frame = False
-
-        if flac_has_frame and mp3_has_frame:
-            frames_differ = not comparator(mp3_value, flac_value)
-
-        if (flac_has_frame and not mp3_has_frame) or frames_differ:
-            log.debug("%s differs: %s <> %s", frame, flac_value, mp3_value)
-            tag_differences[frame] = id3_generator(flac_value)
-            print_status(mp3_name, tag_index, ".")
-        elif not flac_has_frame and mp3_has_frame:
-            tag_differences[frame] = None
-            print_status(mp3_name, tag_index, "X")
+            same = len(current) > 0 and comparator(current[0], flac_value)
+        except Exception:
+            same = False
+        if same:
+            status.append(" ")
         else:
-            print_status(mp3_name, tag_index, " ")
-        tag_index += 1
+            log.debug("%s differs: %s <> %s", frame, flac_value, current[0] if current else None)
+            changes[frame] = id3_generator(flac_value)
+            status.append(".")
 
-    # Now, check pictures:
+    # Now, check pictures. Comparing bytes only looks at the data once the
+    # lengths match, so it's as cheap as a check can be
+    mp3_pictures = mp3.getall('APIC')
+    apics = []
+    descs = set()
+    pictures_differ = False
     for picture in flac.pictures:
-        have_picture = False
-
-        for apic in mp3.getall('APIC'):
-            if apic.mime == picture.mime and apic.type == picture.type and apic.data == picture.data:
-                have_picture = True
-        if not have_picture:
-            if 'APIC:' not in tag_differences:
-                tag_differences['APIC:'] = []
-            tag_differences['APIC:'].append(APIC(encoding=3, desc='', type=picture.type, data=picture.data, mime=picture.mime))
-            print_status(mp3_name, tag_index, "P")
+        (mime, data) = prepare_picture(picture)
+        # ID3 tells APIC frames apart by their description, so keep them unique
+        desc = picture.desc
+        if desc in descs:
+            desc = '%s %d' % (desc, picture.type)
+        descs.add(desc)
+        apics.append(APIC(encoding=3, desc=desc, type=picture.type, data=data, mime=mime))
+        if not any(apic.type == picture.type and apic.mime == mime and apic.data == data for apic in mp3_pictures):
+            pictures_differ = True
+            status.append("P")
+    if pictures_differ:
+        # Replace all of the APIC frames together
+        changes['APIC'] = apics
+    return (changes, ''.join(status))
+
+def tag_sync(flac_name, mp3_name, flac=None, mp3=None):
+    """Copies the FLAC's tags and pictures to the mp3's ID3 frames, returning the
+    FLAC audio MD5. Already parsed FLAC/ID3 objects can be passed in, so neither
+    file is parsed twice. The tag is written (as ID3v2.4) at most once, and in
+    place if it still fits."""
+    if mp3 is None:
+        try:
+            mp3 = ID3(mp3_name)
+        except ID3NoHeaderError:
+            # e.g. from an encoder command that doesn't write a tag
+            mp3 = ID3()
+    if flac is None:
+        flac = FLAC(flac_name)
+
+    flactags = flac_tag_dict(flac)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Source tags present: %s", '; '.join(sorted(flactags.keys())))
+        log.debug("Destination tags present: %s", '; '.join(sorted(mp3.keys())))
+    (changes, status) = id3_changes(mp3, flactags, flac)
+    print_status(mp3_name, 1, status)
     print("")
     # And now push the changed tags to the MP3.
-    for frame in list(tag_differences.keys()):
-        if tag_differences[frame] == None:
+    for (frame, frames) in changes.items():
+        if frames is None:
             mp3.delall(frame)
         else:
-            mp3.setall(frame, tag_differences[frame])
+            mp3.setall(frame, frames)
 
-    if len(list(tag_differences.keys())) > 0:
-        mp3.save(mp3_name, v1=1)
-    else:
-        os.utime(mp3_name, None)
+    if changes:
+        mp3.save(mp3_name, v1=1, v2_version=4, padding=keep_padding)
+    return flactags['MD5']
+
+def read_md5_vorbis(name):
+    dest = mutagen.File(name)
+    return (dest.get('md5', [None])[0], dest)
+
+def tag_sync_vorbis(flac_name, dest_name, flac=None, dest=None):
+    """Copies the FLAC's Vorbis comments and pictures to an Ogg (Opus/Vorbis) file."""
+    if dest is None:
+        dest = mutagen.File(dest_name)
+    if flac is None:
+        flac = FLAC(flac_name)
+    wanted = [(key.upper(), value) for (key, value) in flac.tags if key.upper() != 'MD5']
+    wanted.append(('MD5', '%x' % flac.info.md5_signature))
+    for picture in flac.pictures:
+        wanted.append(('METADATA_BLOCK_PICTURE', base64.b64encode(picture.write()).decode('ascii')))
+    current = [(key.upper(), value) for (key, value) in dest.tags]
+    if sorted(current) != sorted(wanted):
+        dest.tags.clear()
+        dest.tags.extend(wanted)
+        dest.save()
+    return '%x' % flac.info.md5_signature
+
+# MP4 atoms and the FLAC tags they are copied from
+mp4_flac_dict = {
+    '\xa9nam': 'TITLE',
+    '\xa9ART': 'ARTIST',
+    '\xa9alb': 'ALBUM',
+    'aART': 'ALBUMARTIST',
+    '\xa9day': 'DATE',
+    '\xa9gen': 'GENRE',
+    '\xa9wrt': 'COMPOSER',
+    '\xa9cmt': 'COMMENT',
+    'soar': 'ARTISTSORT',
+    'soaa': 'ALBUMSORT',
+    'sonm': 'TITLESORT',
+}
+mp4_md5_atom = '----:com.apple.iTunes:MD5'
+
+def read_md5_mp4(name):
+    from mutagen.mp4 import MP4
+    dest = MP4(name)
+    values = dest.tags.get(mp4_md5_atom, []) if dest.tags is not None else []
+    if len(values) == 0:
+        return (None, dest)
+    return (bytes(values[0]).decode('ascii', 'replace'), dest)
+
+def tag_sync_mp4(flac_name, dest_name, flac=None, dest=None):
+    """Copies the FLAC's main tags and pictures to an MP4 (m4a) file."""
+    from mutagen.mp4 import MP4, MP4Cover, MP4FreeForm
+    if dest is None:
+        dest = MP4(dest_name)
+    if flac is None:
+        flac = FLAC(flac_name)
+    if dest.tags is None:
+        dest.add_tags()
+    flactags = flac_tag_dict(flac)
+    wanted = {}
+    for atom in mp4_flac_dict:
+        if mp4_flac_dict[atom] in flactags:
+            wanted[atom] = [flactags[mp4_flac_dict[atom]]]
+    for (atom, number, total) in [('trkn', 'TRACKNUMBER', 'TOTALTRACKS'), ('disk', 'DISCNUMBER', 'TOTALDISCS')]:
+        try:
+            wanted[atom] = [(int(flactags[number].split('/')[0]), int(flactags[total] or 0))]
+        except (KeyError, ValueError):
+            pass
+    wanted[mp4_md5_atom] = [MP4FreeForm(flactags['MD5'].encode('ascii'))]
+    covers = []
+    for picture in flac.pictures:
+        (mime, data) = prepare_picture(picture)
+        covers.append(MP4Cover(data, MP4Cover.FORMAT_PNG if mime == 'image/png' else MP4Cover.FORMAT_JPEG))
+    if covers:
+        wanted['covr'] = covers
+    current = dict((atom, list(dest.tags[atom])) for atom in dest.tags.keys())
+    if current != wanted:
+        dest.tags.clear()
+        dest.tags.update(wanted)
+        dest.save()
+    return flactags['MD5']
+
+# How to read back the MD5 and sync the tags for each tag format
+tag_formats = {
+    'id3':    (read_md5_id3, tag_sync),
+    'vorbis': (read_md5_vorbis, tag_sync_vorbis),
+    'mp4':    (read_md5_mp4, tag_sync_mp4),
+}
 
 
 if __name__ == "__main__":
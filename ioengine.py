@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Runs blocking file system calls (stat, directory listings, ...) concurrently,
+for sources and destinations on network shares (SMB, NFS) where every one is a
+round trip to the server. An asyncio event loop in a background thread hands
+the calls to a pool of threads, with at most limit of them in flight at once.
+Callers stay sequential: they submit a batch of calls and take the results in
+the order they asked for them. With a limit of 1 calls are simply made in turn,
+as on a local disk that is as fast as it gets."""
+
+import os
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class IOEngine(object):
+	"""Makes blocking calls with at most limit of them in flight at once."""
+
+	def __init__(self, limit=1):
+		self.limit = max(limit, 1)
+		self.loop = None
+		if self.limit > 1:
+			self.loop = asyncio.new_event_loop()
+			self.loop.set_default_executor(ThreadPoolExecutor(self.limit, thread_name_prefix='io'))
+			self.semaphore = None
+			self.thread = threading.Thread(target=self.loop.run_forever, name='io-loop', daemon=True)
+			self.thread.start()
+
+	async def _call(self, fn, args):
+		if self.semaphore is None:
+			# Made here so it belongs to the loop's thread
+			self.semaphore = asyncio.Semaphore(self.limit)
+		async with self.semaphore:
+			return await self.loop.run_in_executor(None, fn, *args)
+
+	def submit(self, fn, *args):
+		"""Starts fn(*args), returning a concurrent.futures.Future for its result."""
+		if self.loop is None:
+			future = Future()
+			try:
+				future.set_result(fn(*args))
+			except Exception as e:
+				future.set_exception(e)
+			return future
+		return asyncio.run_coroutine_threadsafe(self._call(fn, args), self.loop)
+
+	def map(self, fn, items):
+		"""Returns [ fn(item) for item in items ], with the calls made concurrently.
+		If any of them raises, the first exception (in order) is raised."""
+		if self.loop is None:
+			return [ fn(item) for item in items ]
+		futures = [ self.submit(fn, item) for item in items ]
+		return [ future.result() for future in futures ]
+
+	def close(self):
+		if self.loop is None:
+			return
+		self.loop.call_soon_threadsafe(self.loop.stop)
+		self.thread.join()
+		self.loop.run_until_complete(self.loop.shutdown_default_executor())
+		self.loop.close()
+		self.loop = None
+
+
+def stat_or_none(path):
+	"""Returns os.stat(path), or None if there's nothing there."""
+	try:
+		return os.stat(path)
+	except OSError:
+		return None
+
+
+def stat_entry(entry):
+	"""Stats an os.DirEntry, so that later calls to its stat() are answered from its cache."""
+	try:
+		return entry.stat()
+	except OSError:
+		return None
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""A write-ahead journal of the jobs in flight, so that a run that is killed part
+way through (e.g. when its container is restarted) can be cleaned up after by
+the next one. Before a job is queued, a record of its destination and that
+file's mtime is written and synced to disk; once the job has finished another
+record says so. recover() finds the jobs that never finished and removes what
+they may have left half written, so the next run makes those files again
+rather than trusting a truncated file with a new mtime."""
+
+import os
+import re
+import glob
+import json
+
+import logging
+log = logging.getLogger("mediamirror")
+
+# Default name of the journal, created in the root of the destination
+journal_filename = ".mediamirror-journal"
+
+# Rewrite the journal with just the jobs still in flight after this many records
+compact_records = 1000
+
+
+def _mtime(path):
+	try:
+		return os.path.getmtime(path)
+	except OSError:
+		return None
+
+
+def temporaries(dest):
+	"""The temporary files a job making dest may have left: flac2mp3.temp_name's
+	(name.PID.part.ext) and fastcopy's (name.ext.PID.part)."""
+	(root, ext) = os.path.splitext(dest)
+	return (glob.glob(glob.escape(root) + '.[0-9]*.part' + glob.escape(ext)) +
+	        glob.glob(glob.escape(dest) + '.[0-9]*.part'))
+
+
+_temporary = re.compile(r'\.[0-9]+\.part(\.[^.]*)?$')
+
+
+def is_temporary(name):
+	"""True if a file name looks like one of the temporary files above."""
+	return _temporary.search(name) is not None
+
+
+class Journal(object):
+	"""Appends a record to the journal at path for each job begun and ended.
+	Destinations are stored relative to dest_root."""
+
+	def __init__(self, path, dest_root):
+		self.path = path
+		self.dest_root = dest_root
+		self.in_flight = dict()
+		self.next_id = 0
+		self.records = 0
+		self.out = open(path, 'a', encoding='utf-8', errors='surrogateescape')
+
+	def begin(self, dest):
+		"""Records that a job is about to write dest, returning the id to end() it with."""
+		entry = self.next_id
+		self.next_id += 1
+		record = dict(begin=entry, dest=os.path.relpath(dest, self.dest_root), mtime=_mtime(dest))
+		self.in_flight[entry] = record
+		# The ends written since the last begin are synced along with it
+		self._write(record)
+		os.fsync(self.out.fileno())
+		return entry
+
+	def end(self, entry):
+		"""Records that a job has finished, whether or not it succeeded."""
+		del self.in_flight[entry]
+		self._write(dict(end=entry))
+		if self.records >= compact_records:
+			self._compact()
+
+	def _write(self, record):
+		self.out.write(json.dumps(record) + '\n')
+		self.out.flush()
+		self.records += 1
+
+	def _compact(self):
+		temp = self.path + '.new'
+		with open(temp, 'w', encoding='utf-8', errors='surrogateescape') as out:
+			for entry in sorted(self.in_flight):
+				out.write(json.dumps(self.in_flight[entry]) + '\n')
+			out.flush()
+			os.fsync(out.fileno())
+		os.replace(temp, self.path)
+		self.out.close()
+		self.out = open(self.path, 'a', encoding='utf-8', errors='surrogateescape')
+		self.records = len(self.in_flight)
+
+	def close(self):
+		"""Closes the journal, removing it if nothing is left in flight."""
+		self.out.close()
+		if not self.in_flight:
+			try:
+				os.remove(self.path)
+			except OSError:
+				pass
+
+
+def unfinished(path):
+	"""Returns the begin records in the journal at path that have no end."""
+	begun = dict()
+	with open(path, encoding='utf-8', errors='surrogateescape') as f:
+		for line in f:
+			try:
+				record = json.loads(line)
+			except ValueError:
+				# Torn by the run being killed as it wrote it
+				continue
+			if 'begin' in record:
+				begun[record['begin']] = record
+			elif 'end' in record:
+				begun.pop(record['end'], None)
+	return [ begun[entry] for entry in sorted(begun) ]
+
+
+def recover(path, dest_root):
+	"""Cleans up after an interrupted run that left a journal at path: removes
+	the temporary files of the jobs it left unfinished, and their destinations
+	if they were changed. Returns (the destinations of those jobs, the number
+	of files removed), and removes the journal."""
+	if not os.path.exists(path):
+		return ([], 0)
+	log.warning('The last run was interrupted, cleaning up after it')
+	dests = list()
+	removed = 0
+	for record in unfinished(path):
+		dest = os.path.join(dest_root, record['dest'])
+		dests.append(dest)
+		partial = temporaries(dest)
+		if _mtime(dest) != record['mtime']:
+			partial.append(dest)
+		for name in partial:
+			log.warning('Removing partially written file: %s', name)
+			try:
+				os.remove(name)
+				removed += 1
+			except OSError:
+				log.error('Error deleting file %s', name)
+	os.remove(path)
+	return (dests, removed)
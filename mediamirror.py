@@ -1,11 +1,29 @@
 #!/usr/bin/env python3
 import os
 import shutil
+import filecmp
+import hashlib
 import sys
+import time
 import platform
 import subprocess
-import time
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import flac2mp3
+import fastcopy
+import walker
+import watcher
+import metrics
+from transcodecache import TranscodeCache
+from scheduler import Scheduler
+from pathtree import PathTree
+from ioengine import IOEngine, stat_entry, stat_or_none
+from plan import Step, PlanWriter, PlanError, read_plan
+from state import MirrorState, state_filename, directory_fingerprint
+from journal import Journal, journal_filename
+import journal as journals
+import shards
+from shards import ShardError
 
 # Set up logging
 import logging
@@ -19,92 +37,248 @@ source_root = None
 dest_root = None
 dry_run = False
 
+# Runs the conversions in the plan (see execute)
+scheduler = Scheduler()
+
+# Makes the stat calls and directory listings of the walk, the checks of what
+# needs doing and the prune's walk of the destination (concurrently with
+# --io-concurrency, for network shares)
+io_engine = IOEngine()
+
+# Record of files already mirrored (see state.py), if --state is used
+state = None
+
+# Write-ahead record of the jobs in flight (see journal.py), so that if the run
+# is killed the next one can clean up what they left half written
+journal = None
+
+# (i, N) when this is shard i of N (see shards.py), which only mirrors the
+# source directories that hash to it
+shard = None
+rebuild_state = False
+
+# Whether copy_file may hard link files rather than copy them
+hardlink = False
+
+# Destination directories known to exist, so each is only checked once. With
+# --watch a later prune may remove them, so each batch of changes is a new
+# generation and the workers forget what they knew when they see one.
+known_directories = set()
+directory_generation = 0
+known_generation = 0
+
+# Network shares can take a moment to show a directory that has just been
+# created. 'verify' polls for it with an increasing delay, for up to
+# settle_timeout seconds, 'sleep' always waits settle_timeout seconds after
+# creating a directory and 'none' doesn't wait at all.
+settle_strategies = [ 'verify', 'sleep', 'none' ]
+settle_strategy = 'verify'
+settle_timeout = 2.0
+
+def wait_for_directory(destdir):
+	"""Waits for a newly created directory to appear, returning whether it did."""
+	if settle_strategy == 'sleep':
+		time.sleep(settle_timeout)
+	elif settle_strategy == 'verify':
+		delay = 0.05
+		deadline = time.time() + settle_timeout
+		while not os.path.isdir(destdir):
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				return False
+			time.sleep(min(delay, remaining))
+			delay *= 2
+		return True
+	return os.path.isdir(destdir)
+
+
+def make_directory_with_mkdir(destdir):
+	"""The old way of making a directory on Linux: mkdir -p, then changing into
+	it, which makes the kernel look it up so a share shows it straight away."""
+	try:
+		if subprocess.call(['mkdir', '-p', destdir]) != 0:
+			log.error("There was an error calling mkdir -p")
+		cwd = os.getcwd()
+		os.chdir(destdir)
+		os.chdir(cwd)
+	except OSError:
+		log.warning('mkdir -p could not make directory %s either: %s', destdir, sys.exc_info()[1])
+
+
 def create_directory_for_file(dest):
 	destdir = os.path.dirname(dest)
+	if destdir in known_directories:
+		return True
 	if not os.path.exists(destdir):
 		log.info('Making directory: %s', destdir)
-		if not dry_run:
-			try:
-				if platform.system() == 'Linux':
-					# os.makedirs doesn't work well on Linux (over shares)
-					proc = subprocess.Popen(['mkdir', '-p', destdir])
-					proc.communicate()
-					proc.wait()
-					if proc.returncode != 0:
-						log.error("There was an error calling mkdir -p")
-					cwd = os.getcwd()
-					os.chdir(destdir)
-					os.chdir(cwd)
-				else:
-					os.makedirs(destdir, mode=0o775)
-			except:
-				# give the file system / network a couple of seconds to recognise the new directory
-				time.sleep(2)
-				if not os.path.exists(destdir):
-					log.error('There was a problem creating directory %s: %s', destdir, sys.exc_info()[0])
-					return False
-				else:
-					log.warning('A problem was reported when creating directory %s: %s', destdir, sys.exc_info()[0])
-				#return False
+		try:
+			os.makedirs(destdir, mode=0o775, exist_ok=True)
+		except OSError:
+			# Over a share the directory may turn up anyway, so check below
+			log.warning('A problem was reported when creating directory %s: %s', destdir, sys.exc_info()[1])
+			if platform.system() == 'Linux':
+				# os.makedirs hasn't always worked well on Linux over shares
+				make_directory_with_mkdir(destdir)
+		if not wait_for_directory(destdir):
+			log.error('There was a problem creating directory %s', destdir)
+			return False
 	elif not os.path.isdir(destdir):
 			log.error('%s exists but is not a directory!' % destdir)
 			return False
-	# give the file system / network a couple of seconds to recognise the new directory
-	time.sleep(2)
-	return os.path.exists(destdir)
+	known_directories.add(destdir)
 	return True
 
 
 def copy_file(source, dest):
 	log.info('Copying file %s to %s', source, dest)
 	if not create_directory_for_file(dest):
-		return
-	if not dry_run:
-		shutil.copyfile(source, dest)
+		return False
+	with metrics.stage('copy'):
+		how = fastcopy.copy(source, dest, hardlink, flac2mp3.set_mtime)
+	return {'action': how, 'bytes': os.path.getsize(dest)}
 
 
 #from flac2mp3 import maybe_encode_file as flac_to_mp3
 def flac_to_mp3(source, dest):
 	log.info('Converting %s to %s' % (source, dest))
 	if not create_directory_for_file(dest):
-		return
-	if not dry_run:
-		from flac2mp3 import maybe_encode_file
-		maybe_encode_file(source, dest)
+		return False
+	from flac2mp3 import maybe_encode_file
+	return maybe_encode_file(source, dest)
+
+
+def convert_playlist_line(line):
+	"""Rewrites one line of an m3u/m3u8 playlist to refer to the mirrored files.
+	Comments (e.g. #EXTINF), blank lines, URLs and files that aren't mirrored
+	are left alone, as are relative paths other than their extension. The
+	line ending is kept."""
+	text = line.rstrip('\r\n')
+	ending = line[len(text):]
+	path = text.strip()
+	if len(path) == 0 or path.startswith('#') or '://' in path:
+		return line
+	conversion = lookup_conversion(path)
+	if conversion is None:
+		return line
+	(ext, dest_ext, convert_fn, priority) = conversion
+	if path.startswith(source_root):
+		path = dest_root + path[len(source_root):]
+	return path[:-len(ext)] + dest_ext + ending
+
+
+def file_digest(path):
+	h = hashlib.sha1()
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(1024 * 1024), b''):
+			h.update(block)
+	return h.digest()
 
 
 def copy_playlist(source, dest):
 	"""Copies m3u files, changing the any file paths within it to match
-	the converted extentions."""
+	the converted extentions. The playlist is streamed to a temporary file, and
+	if that turns out to be the same as dest it is thrown away so that dest
+	(and its mtime) are left alone."""
 	log.info('Converting playlist %s to %s' % (source, dest))
 	if not create_directory_for_file(dest):
-		return
-	if dry_run:
-		return
-	global conversions
-	src = open(source)
-	dest = open(dest, "w")
-	for line in src:
-		line = line.strip()
-		for ext in list(conversions.keys()):
-			if line.endswith(ext):
-				(dest_ext, convert_fn) = conversions[ext]
-				line = line.replace(source_root, dest_root)[:-len(ext)] + dest_ext
-		print(line, file=dest)
+		return False
+	temp = flac2mp3.temp_name(dest)
+	h = hashlib.sha1()
+	try:
+		# surrogateescape round trips whatever encoding an m3u was written in
+		with open(source, newline='', encoding='utf-8', errors='surrogateescape') as src, \
+		     open(temp, 'w', newline='', encoding='utf-8', errors='surrogateescape') as out:
+			for line in src:
+				line = convert_playlist_line(line)
+				out.write(line)
+				h.update(line.encode('utf-8', 'surrogateescape'))
+		try:
+			unchanged = (os.path.getsize(dest) == os.path.getsize(temp) and
+			             file_digest(dest) == h.digest())
+		except OSError:
+			unchanged = False
+		if unchanged:
+			log.debug('Playlist %s is unchanged' % dest)
+			os.remove(temp)
+			return {'action': 'unchanged'}
+		os.replace(temp, dest)
+	except BaseException:
+		if os.path.exists(temp):
+			os.remove(temp)
+		raise
+	return {'action': 'rewritten'}
 
 
 #
 # Setup the default behaviour for handling.
 #
-conversions = {
-	'flac': ('mp3', flac_to_mp3),
-	'mp3' : ('mp3', copy_file),
-	'm4a' : ('m4a', copy_file),
-	'jpg' : ('jpg', copy_file),
-	'png' : ('png', copy_file),
-	'm3u' : ('m3u', copy_playlist),
+# Maps a (lower case) source file extension to (dest_ext, convert_fn, priority).
+# convert_fn(source, dest) is run on a scheduler, so it must be a module level
+# function. When two source files would be mirrored to the same destination
+# (e.g. song.flac and song.mp3) the conversion with the higher priority wins.
+conversions = dict()
+
+def register_conversion(source_ext, dest_ext, convert_fn, priority=0):
+	"""Mirror files with the extension source_ext to ones with dest_ext using convert_fn."""
+	conversions[source_ext.lower().lstrip('.')] = (dest_ext.lstrip('.'), convert_fn, priority)
+
+register_conversion('flac', 'mp3', flac_to_mp3, 10)
+register_conversion('mp3', 'mp3', copy_file)
+register_conversion('m4a', 'm4a', copy_file)
+register_conversion('jpg', 'jpg', copy_file)
+register_conversion('png', 'png', copy_file)
+register_conversion('m3u', 'm3u', copy_playlist)
+register_conversion('m3u8', 'm3u8', copy_playlist)
+
+# Handlers that --conversion can refer to by name
+conversion_handlers = {
+	'transcode': flac_to_mp3,
+	'copy': copy_file,
+	'playlist': copy_playlist,
 	}
 
+def parse_conversion(spec):
+	"""Registers a conversion given as SRC=DEST:HANDLER[:PRIORITY], where HANDLER
+	is one of conversion_handlers or module.function."""
+	(source_ext, sep, rest) = spec.partition('=')
+	parts = rest.split(':')
+	if not sep or len(parts) not in (2, 3) or not source_ext or not parts[0]:
+		raise ValueError("Conversions should look like SRC=DEST:HANDLER[:PRIORITY]: %s" % spec)
+	convert_fn = find_handler(parts[1])
+	priority = 0
+	if len(parts) == 3:
+		priority = int(parts[2])
+	register_conversion(source_ext, parts[0], convert_fn, priority)
+
+def find_handler(handler):
+	"""Returns the conversion function named handler, one of conversion_handlers
+	or module.function."""
+	if handler in conversion_handlers:
+		return conversion_handlers[handler]
+	import importlib
+	(module, dot, name) = handler.rpartition('.')
+	if not dot:
+		raise ValueError("Unknown conversion handler %s" % handler)
+	return getattr(importlib.import_module(module), name)
+
+def handler_name(convert_fn):
+	"""The name find_handler knows convert_fn by."""
+	for (name, fn) in conversion_handlers.items():
+		if fn is convert_fn:
+			return name
+	return '%s.%s' % (convert_fn.__module__, convert_fn.__name__)
+
+def lookup_conversion(filename):
+	"""Returns (ext, dest_ext, convert_fn, priority) for a file name, or None if
+	files like it aren't mirrored. ext is the extension as it appears in filename."""
+	(base, dot, ext) = filename.rpartition('.')
+	if not dot:
+		return None
+	conversion = conversions.get(ext.lower())
+	if conversion is None:
+		return None
+	return (ext,) + conversion
+
 
 def source_is_newer(source, dest):
 	"""Returns True if the source path is newer than dest (or dest does not exist)."""
@@ -118,75 +292,639 @@ def source_is_newer(source, dest):
 		return (source_mtime > dest_mtime)
 
 
-def get_path_hierachy(path):
-	s = set()
-	s.add(path)
-	(head, tail) = os.path.split(path)
-	if len(tail) > 0:
-		# There was a tail, so the head might still have something useful
-		s |= get_path_hierachy(head)
-	return s
+# Maintain a set of all files (and their directories) that should be present
+# in the mirror so we can figure out which ones to delete. A PathTree stores
+# each directory's path once, rather than in full for every file below it.
+mirrored = PathTree(os.sep)
 
-# Maintain a list of all files that should be present in the mirror
-# so we can figure out which ones to delete. NB: A set might be
-# quicker than a list
-mirrored = set()
+# How many paths each prune thread deletes at a time
+prune_batch_size = 64
 
+# When pruning, the steps for destinations that are missing, which may turn
+# out to be files that have moved in the source
+move_candidates = None
 
 
-def update_single_dir(directory):
+
+def record_state(source, st, dest, md5=None, dest_st=None):
+	"""Remembers that dest is up to date with source, as it was when stat'ed.
+	dest_st is dest's stat, if the caller already has it."""
+	if state is None or dry_run:
+		return
+	if dest_st is not None:
+		dest_mtime = dest_st.st_mtime
+	else:
+		try:
+			dest_mtime = os.path.getmtime(dest)
+		except OSError:
+			return
+	if md5 is None and rebuild_state and source.lower().endswith('.flac'):
+		md5 = flac2mp3.flac_md5(source)
+	state.record(source, st.st_size, st.st_mtime, dest, dest_mtime, md5)
+
+
+def state_recorder(source, st, dest, directory_jobs=None):
+	"""Returns a scheduler callback recording the state of a finished job."""
+	if state is None:
+		return None
+	def finished(ok, result):
+		if ok:
+			record_state(source, st, dest, result.get('md5') if result else None)
+		if directory_jobs is not None:
+			directory_jobs.finished(ok)
+	return finished
+
+
+class DirectoryJobs(object):
+	"""Counts the outstanding jobs for a directory so its fingerprint is only
+	recorded once everything in it has been mirrored successfully."""
+	def __init__(self, directory, fingerprint):
+		self.directory = directory
+		self.fingerprint = fingerprint
+		# One for plan_directory itself, released once everything is planned
+		self.pending = 1
+		self.failed = False
+
+	def queued(self):
+		self.pending += 1
+
+	def finished(self, ok=True):
+		self.pending -= 1
+		if not ok:
+			self.failed = True
+		if self.pending == 0 and not self.failed and not dry_run:
+			state.set_fingerprint(self.directory, self.fingerprint)
+
+
+def fingerprint_salt():
+	"""Settings that change what a directory is mirrored to."""
+	return repr((dest_root, sorted((ext, conversions[ext][0], conversions[ext][1].__name__, conversions[ext][2])
+	                               for ext in conversions),
+	             flac2mp3.max_art_size, flac2mp3.encoder_settings()))
+
+
+def conversion_action(convert_fn, source, dest, row=None, exists=None):
+	"""Names what convert_fn will do to bring dest up to date with source, as
+	one of plan.actions. A flac whose audio (going by its MD5, as recorded in
+	the state row or tagged in dest) hasn't changed just needs its tags syncing.
+	exists says whether dest exists, if that is already known.
+
+	Telling those apart means reading both files, which the conversion does
+	anyway, so it's only worth it for a plan that is written out (a dry run).
+	Otherwise a flac is just labelled a transcode."""
+	if convert_fn is copy_file:
+		return 'copy'
+	if convert_fn is copy_playlist:
+		return 'rewrite-playlist'
+	if convert_fn is not flac_to_mp3:
+		return 'convert'
+	if not dry_run:
+		return 'transcode'
+	if exists is None:
+		exists = os.path.exists(dest)
+	if not exists:
+		return 'transcode'
+	try:
+		md5 = flac2mp3.flac_md5(source)
+	except Exception:
+		return 'transcode'
+	known = None
+	if row is not None and row[4] == os.path.relpath(dest, dest_root):
+		known = row[3]
+	if known is None:
+		known = read_md5(dest)
+	if md5 != '0' and md5 == known:
+		return 'tag-sync'
+	return 'transcode'
+
+
+def plan_directory(directory, entries=None):
+	"""Yields the steps that mirror the files in a source directory. entries
+	maps the names of the files (not dirs) in it to their os.DirEntry, if the
+	caller already has them. When pruning, the steps for files missing from the
+	destination are held back in move_candidates instead."""
 	log.debug('Checking %s' % directory)
-	global mirrored
-	start_size = len(mirrored)
 
 	# Find all files (not dirs) in this directory
-	filenames = list()
-	allnames = os.listdir(directory)
-	for name in allnames:
-		if not os.path.isdir(os.path.join(directory, name)):
-			filenames.append(name)
-	filenames.sort()
-
-	# find all media files we are interested in
-	for ext in list(conversions.keys()):
-		(dest_ext, convert_fn) = conversions[ext]
-		for filename in filenames:
-			if not filename.endswith(ext):
+	if entries is None:
+		entries = walker.scan(directory).files
+	filenames = sorted(entries.keys())
+
+	known = dict()
+	unchanged = False
+	directory_jobs = None
+	if state is not None:
+		# If nothing in the directory has changed since it was last mirrored
+		# there's no need to check the files individually. That takes the stat
+		# of every file, so get them all at once.
+		with metrics.stage('stat'):
+			io_engine.map(stat_entry, entries.values())
+		fingerprint = directory_fingerprint(directory, entries, fingerprint_salt())
+		unchanged = (state.fingerprint(directory) == fingerprint)
+		if unchanged:
+			log.debug('Unchanged since last run: %s' % directory)
+		else:
+			directory_jobs = DirectoryJobs(directory, fingerprint)
+			known = state.directory(directory)
+			for name in known:
+				if name not in entries and not dry_run:
+					state.forget(os.path.join(directory, name))
+
+	# find all media files we are interested in, keeping the highest priority
+	# source for each destination
+	wanted = dict()
+	for filename in filenames:
+		conversion = lookup_conversion(filename)
+		if conversion is None:
+			continue
+		(ext, dest_ext, convert_fn, priority) = conversion
+		srcfilepath = os.path.join(directory, filename)
+		dest = srcfilepath.replace(source_root, dest_root)[:-len(ext)] + dest_ext
+		if dest not in wanted or wanted[dest][0] < priority:
+			wanted[dest] = (priority, filename, srcfilepath, convert_fn)
+
+	metrics.count('files_scanned', len(wanted))
+	to_check = list()
+	for dest in sorted(wanted.keys()):
+		(priority, filename, srcfilepath, convert_fn) = wanted[dest]
+		# Add to the list of files that should be in the mirror
+		mirrored.add(dest)
+		if unchanged:
+			continue
+		if state is not None:
+			# Unchanged since it was last mirrored, so no need to look at dest
+			st = stat_entry(entries[filename])
+			if st is not None and state.is_current(known.get(filename), st, dest):
 				continue
-			srcfilepath = os.path.join(directory, filename)
-			dest = srcfilepath.replace(source_root, dest_root)[:-len(ext)] + dest_ext
-			# Add to the list of files that should be in the mirror
-			mirrored.add(dest)
-			# See if we need to do anything? Basic check for the date here
-			if source_is_newer(srcfilepath, dest):
-				#log.debug('Newer file found: %s' % srcfilepath)
-				convert_fn(srcfilepath, dest)
-
-	# Add the destination directory hierachy to the list of things that are mirrored,
-	# but only if an item was added to the list of valid mirrored files.
-	if len(mirrored) > start_size:
-		dest_directory = directory.replace(source_root, dest_root)
-		mirrored |= get_path_hierachy(dest_directory)
+		to_check.append(dest)
+
+	# See if we need to do anything? Basic check for the date here. Each stat
+	# is a round trip on a share, so the sources and destinations are all
+	# stat'ed at once.
+	with metrics.stage('stat'):
+		if state is None:
+			io_engine.map(stat_entry, [ entries[wanted[dest][1]] for dest in to_check ])
+		dest_stats = io_engine.map(stat_or_none, to_check)
+	for (dest, dest_st) in zip(to_check, dest_stats):
+		(priority, filename, srcfilepath, convert_fn) = wanted[dest]
+		try:
+			st = entries[filename].stat()
+		except OSError:
+			log.warning('Cannot read %s: %s', srcfilepath, sys.exc_info()[1])
+			continue
+		if dest_st is None or st.st_mtime > dest_st.st_mtime:
+			if directory_jobs is not None:
+				directory_jobs.queued()
+			step = Step(conversion_action(convert_fn, srcfilepath, dest, known.get(filename), dest_st is not None),
+			            srcfilepath, dest, convert_fn, state_recorder(srcfilepath, st, dest, directory_jobs))
+			if dest_st is None and move_candidates is not None:
+				# This may have been moved rather than be new, so hold it back
+				# until the prune has looked for it in the destination
+				move_candidates.append(step)
+			else:
+				yield step
+		else:
+			record_state(srcfilepath, st, dest, dest_st=dest_st)
+
+	if directory_jobs is not None:
+		directory_jobs.finished()
 
 # Exclude .@__thumb
 excluded_paths = [ ".@__thumb", "_fresh" ]
 
-def isWanted(path):
-	for pattern in excluded_paths:
-		if pattern in path:
-			log.debug('Ignoring path: %s' % path)
-			return False
-	return True;
 
-def dirwalk(dir):
-	"""walk a directory tree returning each directory, using a generator"""
-	yield dir
-	for f in sorted( os.listdir(dir) ):
-		fullpath = os.path.join(dir,f)
-		if os.path.isdir(fullpath) and not os.path.islink(fullpath):
-			for x in dirwalk(fullpath):  # recurse into subdir
-				if isWanted(x):
-					yield x
+def find_unmirrored(tops=None):
+	"""Walks the destination (or just the directories tops in it) for things
+	that shouldn't be there. Returns the paths to prune (not including anything
+	below a directory being pruned) and every unwanted file, including those
+	inside directories being pruned."""
+	to_prune = list()
+	orphans = list()
+	# Directories being pruned and everything below them. The walk lists a
+	# directory before its contents, so a single lookup of the directory being
+	# listed says whether an ancestor is already going to be pruned.
+	pruned_dirs = set()
+	if tops is None:
+		tops = [ dest_root ]
+	for top in tops:
+		if not os.path.isdir(top):
+			continue
+		for d in metrics.timed(walker.walk(top, io=io_engine), 'prune_scan'):
+			inside = d.path in pruned_dirs
+			wanted = mirrored.children(d.path)
+			for entry in d.dirs:
+				if inside:
+					pruned_dirs.add(entry.path)
+				elif entry.name not in wanted:
+					log.debug('Will prune directory: %s' % entry.path)
+					to_prune.append(entry.path)
+					pruned_dirs.add(entry.path)
+			for entry in d.links:
+				if not inside and entry.name not in wanted:
+					log.debug('Will prune directory: %s' % entry.path)
+					to_prune.append(entry.path)
+			for filename in d.filenames():
+				filepath = os.path.join(d.path, filename)
+				if journals.is_temporary(filename):
+					# Being written by a job still in flight. One that a
+					# killed run left behind is removed by recover().
+					continue
+				if filename not in wanted:
+					orphans.append((filepath, d.files[filename]))
+					if not inside:
+						log.debug('Will prune file: %s' % filepath)
+						to_prune.append(filepath)
+	to_prune.sort()
+	return (to_prune, orphans)
+
+
+def delete_paths(paths):
+	"""Deletes a batch of files and directory trees."""
+	for path in paths:
+		if os.path.isdir(path) and not os.path.islink(path):
+			try:
+				shutil.rmtree(path)
+			except OSError:
+				log.error('Error deleting tree %s' % path)
+		else:
+			try:
+				os.remove(path)
+			except OSError:
+				log.error('Error deleting file %s' % path)
+
+
+def prune(paths, jobs=1):
+	"""Deletes paths (none of which are inside another), in batches spread
+	over jobs threads, since deleting is mostly waiting on the file system."""
+	for path in paths:
+		log.info('Deleting: %s' % path)
+		metrics.event('prune', path=path)
+	if len(paths) == 0:
+		return
+	metrics.count('paths_pruned', len(paths))
+	batches = [ paths[i:i + prune_batch_size] for i in range(0, len(paths), prune_batch_size) ]
+	if jobs <= 1 or len(batches) == 1:
+		with metrics.stage('prune'):
+			for batch in batches:
+				delete_paths(batch)
+		return
+	with metrics.stage('prune'):
+		with ThreadPoolExecutor(min(jobs, len(batches))) as executor:
+			for result in executor.map(delete_paths, batches):
+				pass
+
+
+def read_md5(mp3_name):
+	"""Returns the audio MD5 tagged in a transcoded file, if there is one."""
+	(read_fn, sync_fn) = flac2mp3.tag_formats[flac2mp3.encoder_profiles[flac2mp3.encoder_profile][2]]
+	try:
+		return read_fn(mp3_name)[0]
+	except Exception:
+		return None
+
+
+def find_move(step, orphans_by_md5, orphans_by_size, used):
+	"""Returns an unwanted destination file that is what step would make, if any."""
+	(source, dest) = (step.source, step.dest)
+	ext = os.path.splitext(dest)[1]
+	if step.convert_fn is flac_to_mp3:
+		try:
+			md5 = flac2mp3.flac_md5(source)
+		except Exception:
+			return None
+		# An MD5 of zero means the encoder didn't record one
+		if md5 == '0':
+			return None
+		candidates = orphans_by_md5.get((ext, md5), [])
+		is_match = lambda path: True
+	elif step.convert_fn is copy_file:
+		candidates = orphans_by_size.get((ext, os.path.getsize(source)), [])
+		is_match = lambda path: filecmp.cmp(source, path, shallow=False)
+	else:
+		return None
+	# Prefer a file with the same name (e.g. a whole album that was moved)
+	name = os.path.basename(dest)
+	candidates = sorted(candidates, key=lambda path: os.path.basename(path) != name)
+	for path in candidates:
+		if path not in used and is_match(path):
+			return path
+	return None
+
+
+def plan_moves(orphans, candidates):
+	"""Yields the candidate steps, turning those that an unwanted destination
+	file matches into moves of that file, so files moved or renamed in the
+	source aren't transcoded or copied again."""
+	if len(candidates) == 0 or len(orphans) == 0:
+		yield from candidates
+		return
+	log.info('Looking for moved files')
+	wanted_exts = set(os.path.splitext(step.dest)[1] for step in candidates)
+	orphans = [ (path, entry) for (path, entry) in orphans if os.path.splitext(path)[1] in wanted_exts ]
+	transcoded = '.' + conversions['flac'][0]
+	# Reading these is mostly waiting on the destination, so do it all at once
+	sizes = io_engine.map(stat_entry, [ entry for (path, entry) in orphans ])
+	transcodes = [ path for (path, entry) in orphans if path.endswith(transcoded) ]
+	md5s = dict(zip(transcodes, io_engine.map(read_md5, transcodes)))
+	orphans_by_md5 = dict()
+	orphans_by_size = dict()
+	for ((path, entry), st) in zip(orphans, sizes):
+		ext = os.path.splitext(path)[1]
+		if st is not None:
+			orphans_by_size.setdefault((ext, st.st_size), []).append(path)
+		if ext == transcoded:
+			md5 = md5s[path]
+			if md5 is not None:
+				orphans_by_md5.setdefault((ext, md5), []).append(path)
+
+	used = set()
+	for step in candidates:
+		orphan = find_move(step, orphans_by_md5, orphans_by_size, used)
+		if orphan is not None:
+			used.add(orphan)
+			step = Step('move', step.source, step.dest, step.convert_fn, step.callback, orphan)
+		yield step
+
+
+def in_generation(generation, convert_fn, source, dest):
+	"""Runs convert_fn (in a worker), first forgetting the destination
+	directories known to exist if they were found in an earlier generation."""
+	global known_generation
+	if generation != known_generation:
+		known_directories.clear()
+		known_generation = generation
+	return convert_fn(source, dest)
+
+
+def new_generation():
+	"""Starts a new generation of known_directories, here and in the workers."""
+	global directory_generation
+	directory_generation += 1
+	known_directories.clear()
+
+
+def submit(step):
+	"""Queues a step's conversion on the scheduler, journalling it."""
+	fn = functools.partial(in_generation, directory_generation, step.convert_fn)
+	if journal is None:
+		scheduler.submit(fn, step.source, step.dest, step.callback)
+		return
+	entry = journal.begin(step.dest)
+	def finished(ok, result):
+		journal.end(entry)
+		if step.callback is not None:
+			step.callback(ok, result)
+	scheduler.submit(fn, step.source, step.dest, finished)
+
+
+def recover(journal_path):
+	"""Cleans up after the last run, if it was interrupted."""
+	(dests, removed) = journals.recover(journal_path, dest_root)
+	if dests:
+		log.info('Cleaned up after %d unfinished jobs, removing %d files', len(dests), removed)
+		metrics.count('jobs_recovered', len(dests))
+		metrics.count('partial_files_removed', removed)
+		metrics.event('recover', jobs=len(dests), removed=removed)
+
+
+def move_file(step):
+	"""Carries out a move step, converting the source instead if the move fails."""
+	log.info('Moving %s to %s' % (step.orphan, step.dest))
+	metrics.event('move', source=step.orphan, dest=step.dest)
+	if not create_directory_for_file(step.dest):
+		submit(step)
+		return
+	try:
+		os.rename(step.orphan, step.dest)
+	except OSError:
+		log.error('Error moving %s to %s: %s', step.orphan, step.dest, sys.exc_info()[1])
+		submit(step)
+		return
+	metrics.count('files_moved')
+	if source_is_newer(step.source, step.dest):
+		# e.g. the tags were changed too
+		submit(step)
+	elif step.callback is not None:
+		step.callback(True, None)
+
+
+def plan_mirror(tops, prune_dest=False):
+	"""Walks the source directories tops (and everything below them), yielding
+	the steps that mirror them as it goes. With prune_dest it then yields the
+	steps held back in case they were moves (as moves, where they were) and
+	deletes for everything else in the matching destination directories that
+	isn't wanted. Once the walk is done the state forgets the directories
+	below tops that it didn't see.
+
+	Holding back new files means none of them is converted until the whole
+	walk and the destination scan are done, so when the destination has
+	nothing in it to have been moved (e.g. the first run) they aren't."""
+	global move_candidates
+	move_candidates = list() if prune_dest and not empty_destination(tops) else None
+	seen = list()
+	for top in tops:
+		for d in metrics.timed(walker.walk(top, excluded_paths, io_engine), 'walk'):
+			if owned(d.path):
+				seen.append(d.path)
+				yield from plan_directory(d.path, d.files)
+	if state is not None and not dry_run:
+		state.keep_directories(seen, tops)
+	if not prune_dest:
+		return
+	(to_prune, orphans) = find_unmirrored([ top.replace(source_root, dest_root, 1) for top in tops ])
+	moved = set()
+	for step in plan_moves(orphans, move_candidates or []):
+		if step.action == 'move':
+			moved.add(step.orphan)
+		yield step
+	for path in to_prune:
+		if path not in moved:
+			yield Step('delete', None, path)
+
+
+def empty_destination(tops):
+	"""True if the destination directories of the source directories tops
+	hold nothing but the paths already in mirrored (those reserved), so there
+	is nothing in them that a new file could have been moved from."""
+	for top in tops:
+		dest = top.replace(source_root, dest_root, 1)
+		reserved = mirrored.children(dest)
+		try:
+			with os.scandir(dest) as it:
+				if any(entry.name not in reserved for entry in it):
+					return False
+		except FileNotFoundError:
+			pass
+	return True
+
+
+def owned(directory):
+	"""False if the source directory is mirrored by another --shard."""
+	if shard is None:
+		return True
+	return shards.owner(os.path.relpath(directory, source_root), shard[1]) == shard[0]
+
+
+def plan_prune():
+	"""Yields deletes for everything in the destination that isn't in mirrored."""
+	(to_prune, orphans) = find_unmirrored()
+	for path in to_prune:
+		yield Step('delete', None, path)
+
+
+def reserved_paths(state_path, journal_path):
+	"""Paths that must never be pruned: the state database (and SQLite's
+	journal next to it) and our journal."""
+	return ([ state_path + suffix for suffix in [ '', '-journal', '-wal', '-shm' ] ] +
+	        [ journal_path, journal_path + '.new' ])
+
+
+def execute(steps, jobs=1):
+	"""Carries out steps as they come. Conversions go to the scheduler, so with
+	worker processes they run while the steps after them are being planned.
+	Moves are made straight away and deletes once everything else is done."""
+	deletes = list()
+	for step in steps:
+		if step.action == 'delete':
+			deletes.append(step.dest)
+		elif step.action == 'move':
+			move_file(step)
+		else:
+			submit(step)
+	scheduler.wait()
+	if state is not None:
+		state.commit()
+	if deletes:
+		log.info('Pruning to remove old/unwanted files')
+		prune(deletes, jobs)
+		if state is not None:
+			state.forget_dests(deletes)
+			state.commit()
+
+
+def run_steps(steps, writer, jobs=1):
+	"""Carries out steps, or for a dry run writes them out with writer (a
+	PlanWriter) instead."""
+	if writer is None:
+		execute(steps, jobs)
+		return
+	for step in steps:
+		writer.write(step, handler_name(step.convert_fn) if step.convert_fn is not None else None)
+
+
+def report_progress(writer):
+	"""Logs what has been done so far, or for a dry run what has been planned."""
+	if writer is None:
+		scheduler.summary()
+	else:
+		log.info('Planned %s', writer.summary())
+
+
+def inside_dest(path):
+	return os.path.abspath(path).startswith(os.path.abspath(dest_root) + os.sep)
+
+
+def steps_from_plan(entries):
+	"""Turns the steps read from a saved plan back into Steps, skipping those
+	that no longer make sense (e.g. the source has since been deleted)."""
+	for entry in entries:
+		(action, dest) = (entry['action'], entry['dest'])
+		orphan = entry.get('from')
+		if not inside_dest(dest) or (orphan is not None and not inside_dest(orphan)):
+			log.error('Ignoring a step outside the destination: %s', dest)
+			continue
+		if action == 'delete':
+			if os.path.lexists(dest):
+				yield Step(action, None, dest)
+			continue
+		source = entry['source']
+		try:
+			st = os.stat(source)
+			convert_fn = find_handler(entry.get('handler', 'copy'))
+		except OSError:
+			log.warning('Skipping %s, as %s is no longer there', dest, source)
+			continue
+		except (ValueError, ImportError, AttributeError):
+			log.error('Skipping %s: %s', dest, sys.exc_info()[1])
+			continue
+		if action == 'move' and (orphan is None or not os.path.exists(orphan)):
+			log.info('%s is no longer there to move, so converting %s', orphan, source)
+			(action, orphan) = (conversion_action(convert_fn, source, dest), None)
+		yield Step(action, source, dest, convert_fn, state_recorder(source, st, dest), orphan)
+
+
+def use_encoder_profile(name, profile):
+	"""Transcode flac files with the given encoder profile (see flac2mp3)."""
+	flac2mp3.encoder_profiles[name] = profile
+	flac2mp3.encoder_profile = name
+	(dest_ext, convert_fn, priority) = conversions['flac']
+	if convert_fn is flac_to_mp3:
+		# Leave a --conversion that does something else with flac files alone
+		register_conversion('flac', flac2mp3.encoder_extension(), convert_fn, priority)
+
+
+def existing_source_directory(path):
+	"""Returns path, or the closest directory above it that still exists, as a
+	path that starts with source_root."""
+	while (path + os.sep).startswith(source_root) and path + os.sep != source_root:
+		if os.path.isdir(path):
+			return path
+		path = os.path.dirname(path)
+	return source_root
+
+
+def plan_directories(directories, reserved, prune_dest=False):
+	"""Plans mirroring just the given source directories and everything below
+	them, then (if prune_dest) pruning the matching destination directories.
+	reserved are destination paths that must never be pruned."""
+	global mirrored
+	tops = watcher.outermost(existing_source_directory(path) for path in directories)
+	mirrored = PathTree(dest_root)
+	for path in reserved:
+		mirrored.add(path)
+	tops = [ top for top in tops if not walker.is_excluded(top, excluded_paths) ]
+	return plan_mirror(tops, prune_dest)
+
+
+def publish_metrics(prometheus_path):
+	"""Writes out the events and (if wanted) the Prometheus textfile so far."""
+	metrics.flush_events()
+	if prometheus_path != None and not dry_run:
+		try:
+			metrics.write_prometheus(prometheus_path)
+		except OSError:
+			log.error('Could not write metrics to %s: %s', prometheus_path, sys.exc_info()[1])
+
+
+def report_metrics(prometheus_path):
+	"""Logs the metrics at the end of a run, and publishes them."""
+	log.info('Metrics: %s', metrics.summary())
+	metrics.event('run', counters=dict(metrics.counters),
+	              stages=dict((name, round(metrics.stages[name][1], 3)) for name in metrics.stages))
+	publish_metrics(prometheus_path)
+	metrics.close()
+
+
+def init_worker(settings):
+	"""Copies the run settings into a worker process of the scheduler."""
+	global source_root, dest_root, settle_strategy, settle_timeout, hardlink
+	source_root = settings['source_root']
+	dest_root = settings['dest_root']
+	flac2mp3.flac_exe = settings['flac_exe']
+	flac2mp3.lame_exe = settings['lame_exe']
+	flac2mp3.max_art_size = settings['max_art_size']
+	hardlink = settings['hardlink']
+	if settings['events']:
+		metrics.keep_events()
+	for spec in settings['conversions']:
+		parse_conversion(spec)
+	use_encoder_profile(*settings['encoder'])
+	if settings['cache_dir'] != None:
+		flac2mp3.transcode_cache = TranscodeCache(settings['cache_dir'], settings['cache_bytes'])
+	settle_strategy = settings['settle_strategy']
+	settle_timeout = settings['settle_timeout']
+	log.setLevel(settings['level'])
+	flac2mp3.log.setLevel(settings['level'])
 
 
 #
@@ -199,8 +937,8 @@ def main():
 			"\n" +
 			"Mirrors media files from a HD/Lossless source directory to a " +
 			"lossy-compressed destination directory (e.g. for portable media devices). " +
-			"The behaviour is hard-coded to convert flac files to 192 VBR mp3, " +
-			"copy wav, m4a, mp3, jpg, png and ignore the rest.")
+			"The behaviour is hard-coded to convert flac files (by default to VBR mp3, " +
+			"see --profile), copy m4a, mp3, jpg, png, rewrite m3u/m3u8 and ignore the rest.")
 
 	parser = OptionParser(usage=usage, version="%prog v0.1")
 	parser.add_option("-d", "--dest", dest="destdir",
@@ -211,10 +949,24 @@ def main():
 					  help="The root of the source media tree.")
 	parser.add_option("-n", "--dry-run", dest="dryrun", action="store_true",
 					  default=False,
-					  help="Don't make any changes, just show what would happen.")
+					  help="Don't make any changes, just write out the plan of what would happen " +
+					  "(as JSON lines) for review or --apply-plan.")
+	parser.add_option("--plan", dest="plan_file",
+					  help="With --dry-run, write the plan to this file rather than standard output.")
+	parser.add_option("--apply-plan", dest="apply_plan",
+					  help="Carry out a plan written by --dry-run, rather than working out what to do. " +
+					  "Steps that no longer make sense (e.g. the source file has gone) are skipped.")
 	parser.add_option("-p", "--prune", dest="prune", action="store_true",
 					  default=False,
-					  help="Remove old files from the destination that no longer have counterparts in the source.")
+					  help="Remove old files from the destination that no longer have counterparts in the source. " +
+					  "Files that have been moved or renamed in the source are moved to match rather than recreated.")
+	parser.add_option("--shard", dest="shard",
+					  help="Mirror only the source directories that fall to shard i of N, given as i/N " +
+					  "(e.g. 1/4), so N processes or hosts can share the work. Each keeps its own state and " +
+					  "journal; once all N have finished, prune with --merge-shards N.")
+	parser.add_option("--merge-shards", dest="merge_shards", type="int",
+					  help="Once all N --shard runs have finished, prune the destination of everything " +
+					  "none of them mirrored (going by the manifests they leave in the destination).")
 	parser.add_option("-v", "--verbose", dest="debug",
 					  action="store_true", default=False,
 					  help="Print more information for debugging purposes")
@@ -224,7 +976,91 @@ def main():
 	parser.add_option("--lame", dest="lame", help="The lame executable to use.",
 #	                  default="C:/Program Files/Lame/lame.exe"
 					  )
+	parser.add_option("--profile", dest="profile", type="choice",
+					  choices=sorted(flac2mp3.encoder_profiles.keys()), default=flac2mp3.encoder_profile,
+					  help="How to transcode flac files, one of: %s [default: %%default]." %
+					  ', '.join(sorted(flac2mp3.encoder_profiles.keys())))
+	parser.add_option("--encoder-command", dest="encoder_command",
+					  help="Transcode with this command instead of a --profile. It is given WAV " +
+					  "on stdin and must write to {output}, e.g. \"ffmpeg -i - -c:a libfdk_aac -vbr 4 -f ipod {output}\" " +
+					  "with --encoder-ext m4a --encoder-tags mp4.")
+	parser.add_option("--encoder-ext", dest="encoder_ext", default="mp3",
+					  help="The extension of the files made by --encoder-command [default: %default].")
+	parser.add_option("--encoder-tags", dest="encoder_tags", type="choice",
+					  choices=sorted(flac2mp3.tag_formats.keys()), default="id3",
+					  help="How to tag the files made by --encoder-command: id3, mp4 or vorbis [default: %default].")
+	parser.add_option("--conversion", dest="conversions", action="append", default=[],
+					  help="Also mirror files with the extension SRC, as SRC=DEST:HANDLER[:PRIORITY]. " +
+					  "HANDLER is transcode, copy, playlist or module.function, e.g. ogg=ogg:copy. " +
+					  "May be given more than once.")
+	parser.add_option("--hardlink", dest="hardlink", action="store_true", default=False,
+					  help="Hard link copied files (mp3, m4a, jpg, ...) rather than copy them, " +
+					  "when the source and destination are on the same file system. " +
+					  "Changing a linked file then changes it in both places.")
+	parser.add_option("--max-art-size", dest="max_art_size", type="int",
+					  help="Scale embedded cover art down to fit within this many pixels " +
+					  "(needs Pillow).")
+	parser.add_option("--cache-dir", dest="cache_dir",
+					  help="Keep a copy of every transcode in this directory (outside the " +
+					  "destination), so moved or renamed tracks don't need transcoding again.")
+	parser.add_option("--cache-size", dest="cache_size", type="int", default=20480,
+					  help="The size in MB the transcode cache is trimmed to [default: %default].")
+	parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+					  help="The number of files to convert/copy (and threads deleting files " +
+					  "when pruning) in parallel.")
+	parser.add_option("--io-concurrency", dest="io_concurrency", type="int", default=1,
+					  help="How many file system operations (stat calls and directory listings) " +
+					  "to have in flight at once. Raise it (e.g. to 32) when the source or destination " +
+					  "is a network share, where each one is a round trip [default: %default].")
+	parser.add_option("--watch", dest="watch", action="store_true", default=False,
+					  help="After mirroring everything, keep running and mirror (and, with " +
+					  "--prune, prune) just the directories that change in the source.")
+	parser.add_option("--watch-delay", dest="watch_delay", type="float", default=2.0,
+					  help="With --watch, wait until there have been no changes for this many " +
+					  "seconds before mirroring them [default: %default].")
+	parser.add_option("--poll", dest="poll", action="store_true", default=False,
+					  help="With --watch, look for changes by listing the source every " +
+					  "--poll-interval seconds, for shares that don't report changes (inotify).")
+	parser.add_option("--poll-interval", dest="poll_interval", type="float", default=60.0,
+					  help="How often --poll lists the source, in seconds [default: %default].")
+	parser.add_option("--events", dest="events", default=None,
+					  help="Append a JSON object per line to this file for each file converted, " +
+					  "copied, moved or pruned, and a summary at the end of the run.")
+	parser.add_option("--prometheus", dest="prometheus", default=None,
+					  help="Write counters and stage timings to this file in Prometheus' text " +
+					  "format (e.g. for node_exporter's textfile collector).")
+	parser.add_option("--settle", dest="settle", type="choice",
+					  choices=settle_strategies, default='verify',
+					  help="How to wait for new directories to appear on the destination: " +
+					  "'verify' polls for up to --settle-timeout seconds, 'sleep' always waits " +
+					  "--settle-timeout seconds, 'none' doesn't wait [default: %default].")
+	parser.add_option("--settle-timeout", dest="settle_timeout", type="float",
+					  default=2.0,
+					  help="Seconds to wait for a new directory to appear [default: %default].")
+	parser.add_option("--state", dest="state", action="store_true",
+					  default=False,
+					  help="Keep a record of mirrored files (in %s in the destination) " % state_filename +
+					  "so unchanged files can be skipped without checking the destination.")
+	parser.add_option("--state-file", dest="state_file",
+					  help="Where to keep the record of mirrored files (implies --state).")
+	parser.add_option("--rebuild-state", dest="rebuild_state", action="store_true",
+					  default=False,
+					  help="Discard the record of mirrored files and rebuild it from the " +
+					  "source and destination trees (implies --state).")
 	(options, args) = parser.parse_args()
+	if options.plan_file != None and not options.dryrun:
+		parser.error("--plan is only used with --dry-run.")
+	if options.shard != None:
+		if options.prune or options.merge_shards != None:
+			parser.error("A --shard only knows what it mirrors, so can't prune; " +
+			             "run --merge-shards N once all N shards have finished.")
+		if options.watch or options.apply_plan != None:
+			parser.error("--shard can't be used with --watch or --apply-plan.")
+	if options.merge_shards != None:
+		if options.merge_shards < 1:
+			parser.error("--merge-shards needs the number of shards.")
+		if options.watch or options.apply_plan != None:
+			parser.error("--merge-shards can't be used with --watch or --apply-plan.")
 
 	if options.debug:
 		log.setLevel(logging.DEBUG)
@@ -234,10 +1070,19 @@ def main():
 		flac2mp3.log.setLevel(logging.INFO)
 
 	# Read the options into the global variables
-	global source_root, dest_root, flac, lame, dry_run
+	global source_root, dest_root, flac, lame, dry_run, scheduler, state, rebuild_state
+	global settle_strategy, settle_timeout, mirrored, hardlink, io_engine, journal, shard
 	source_root = options.sourcedir
 	dest_root = options.destdir
 	dry_run = options.dryrun
+	settle_strategy = options.settle
+	settle_timeout = options.settle_timeout
+	hardlink = options.hardlink
+	if options.shard != None:
+		try:
+			shard = shards.parse(options.shard)
+		except ValueError as e:
+			parser.error(str(e))
 	if dry_run:
 		log.info('Performing a dry-run of what would happen.')
 	if options.flac != None:
@@ -246,6 +1091,35 @@ def main():
 	if options.lame != None:
 		log.info("Setting LAME encoder to %s", options.lame)
 		flac2mp3.lame_exe = options.lame
+	for spec in options.conversions:
+		try:
+			parse_conversion(spec)
+		except (ValueError, ImportError, AttributeError) as e:
+			parser.error(str(e))
+	if options.encoder_command != None:
+		import shlex
+		encoder = ('custom', (shlex.split(options.encoder_command), options.encoder_ext, options.encoder_tags))
+	else:
+		encoder = (options.profile, flac2mp3.encoder_profiles[options.profile])
+	log.info("Transcoding flac files with the %s profile", encoder[0])
+	use_encoder_profile(*encoder)
+	if options.max_art_size != None:
+		log.info("Limiting cover art to %d pixels", options.max_art_size)
+		flac2mp3.max_art_size = options.max_art_size
+
+	plan_steps = None
+	if options.apply_plan != None:
+		if options.watch:
+			parser.error("--apply-plan can't be used with --watch.")
+		try:
+			(header, plan_steps) = read_plan(open(options.apply_plan, encoding='utf-8'))
+		except (OSError, PlanError) as e:
+			parser.error(str(e))
+		for (root, key, name) in [ (source_root, 'source', 'Source'), (dest_root, 'dest', 'Destination') ]:
+			if root != None and os.path.join(root, '') != header[key]:
+				parser.error("%s root %s doesn't match the plan's, %s" % (name, root, header[key]))
+		source_root = header['source']
+		dest_root = header['dest']
 
 	#
 	# Check for required 'options'
@@ -261,50 +1135,159 @@ def main():
 		source_root = source_root + os.sep
 	if dest_root[-1:] != os.sep:
 			dest_root = dest_root + os.sep
+	mirrored = PathTree(dest_root)
 
-	#
-	# Check all directories that lie under the source root
-	#
-	log.info('Starting to mirror from %s to %s' % (source_root, dest_root))
-	for x in dirwalk(source_root):
-		update_single_dir(x)
+	if options.jobs < 1:
+		parser.error("The number of jobs must be at least 1.")
+	if options.io_concurrency < 1:
+		parser.error("--io-concurrency must be at least 1.")
+	io_engine = IOEngine(options.io_concurrency)
+	if options.cache_dir != None:
+		cache_dir = os.path.abspath(options.cache_dir)
+		if (cache_dir + os.sep).startswith(os.path.abspath(dest_root) + os.sep):
+			parser.error("The transcode cache must not be inside the destination.")
+		log.info("Using transcode cache in %s", cache_dir)
+		flac2mp3.transcode_cache = TranscodeCache(cache_dir, options.cache_size * 1024 * 1024)
+	settings = {
+		'source_root': source_root,
+		'dest_root': dest_root,
+		'flac_exe': flac2mp3.flac_exe,
+		'lame_exe': flac2mp3.lame_exe,
+		'max_art_size': flac2mp3.max_art_size,
+		'encoder': encoder,
+		'conversions': options.conversions,
+		'hardlink': hardlink,
+		'events': options.events != None,
+		'cache_dir': options.cache_dir,
+		'cache_bytes': options.cache_size * 1024 * 1024,
+		'settle_strategy': settle_strategy,
+		'settle_timeout': settle_timeout,
+		'level': log.level,
+		}
+	if options.events != None:
+		metrics.open_events(options.events)
+	# Even with one job, convert files in a worker so planning can carry on meanwhile
+	scheduler = Scheduler(options.jobs, init_worker, (settings,), background=not dry_run)
+	writer = None
+	if dry_run:
+		plan_out = sys.stdout
+		if options.plan_file != None:
+			plan_out = open(options.plan_file, 'w', encoding='utf-8')
+		writer = PlanWriter(plan_out, source_root, dest_root)
+
+	(state_name, journal_name) = (state_filename, journal_filename)
+	if shard is not None:
+		# Each shard has its own, so they never contend for them
+		(state_name, journal_name) = (shards.shard_name(state_filename, *shard),
+		                              shards.shard_name(journal_filename, *shard))
+	state_path = options.state_file
+	if state_path == None:
+		state_path = os.path.join(dest_root, state_name)
+	journal_path = os.path.join(dest_root, journal_name)
+	reserved = reserved_paths(state_path, journal_path)
+	if options.merge_shards != None:
+		# Every shard's files, and what each of them mirrored
+		count = options.merge_shards
+		for index in range(1, count + 1):
+			manifest = shards.manifest_path(dest_root, index, count)
+			reserved += reserved_paths(os.path.join(dest_root, shards.shard_name(state_filename, index, count)),
+			                           os.path.join(dest_root, shards.shard_name(journal_filename, index, count)))
+			reserved += [ manifest, manifest + '.new' ]
+		log.info('Merging what the %d shards mirrored', count)
+		try:
+			for path in shards.read_manifests(dest_root, count):
+				mirrored.add(path)
+		except (OSError, ValueError, ShardError) as e:
+			log.error('Cannot merge the shards: %s', e)
+			sys.exit(1)
+	for path in reserved:
+		mirrored.add(path)
+	if (options.state or options.state_file or options.rebuild_state) and options.merge_shards == None:
+		if dry_run and not os.path.exists(state_path):
+			log.info('No mirror state in %s yet', state_path)
+		else:
+			if not dry_run:
+				os.makedirs(os.path.dirname(state_path), exist_ok=True)
+			state = MirrorState(state_path, source_root, dest_root)
+			rebuild_state = options.rebuild_state
+			if rebuild_state and not dry_run:
+				state.clear()
+	# (A merge only deletes, which needs no journal)
+	if dry_run:
+		if os.path.exists(journal_path):
+			log.info('The last run was interrupted; the next real run will clean up after it')
+	elif options.merge_shards == None:
+		os.makedirs(dest_root, exist_ok=True)
+		recover(journal_path)
+		journal = Journal(journal_path, dest_root)
 
 	#
-	# Prune directories/files in the dest that shouldn't be there
+	# Check all directories that lie under the source root
 	#
-	if options.prune:
-		log.info('Pruning to remove old/unwanted files')
-		to_prune = set()
-		for dirname, dirnames, filenames in os.walk(dest_root):
-			for subdirname in dirnames:
-				dirpath = os.path.join(dirname, subdirname)
-				if dirpath not in mirrored:
-					parents = get_path_hierachy(dirpath)
-					if len(to_prune & parents) == 0:
-						log.debug('Will prune directory: %s' % dirpath)
-						to_prune.add(dirpath)
-			for filename in filenames:
-				filepath = os.path.join(dirname, filename)
-				if filepath not in mirrored:
-					parents = get_path_hierachy(filepath)
-					if len(to_prune & parents) == 0:
-						log.debug('Will prune file: %s' % filepath)
-						to_prune.add(filepath)
-
-		for path in to_prune:
-			log.info('Deleting: %s' % path)
-			if os.path.isdir(path):
-				if not dry_run:
-					try:
-						shutil.rmtree(path)
-					except:
-						log.error('Error deleting tree %s' % path)
-			else:
-				if not dry_run:
-					try:
-						os.remove(path)
-					except:
-						log.error('Error deleting file %s' % path)
+	changes = None
+	if options.watch:
+		# Start watching first, so nothing changed during the full sync is missed
+		changes = watcher.create(source_root, excluded_paths, options.poll, options.poll_interval, io_engine)
+	manifest_path = None
+	if shard is not None:
+		manifest_path = shards.manifest_path(dest_root, *shard)
+		if not dry_run:
+			shards.remove_manifest(manifest_path)
+	if plan_steps is not None:
+		log.info('Applying the plan in %s' % options.apply_plan)
+		steps = steps_from_plan(plan_steps)
+	elif options.merge_shards != None:
+		log.info('Pruning %s' % dest_root)
+		steps = plan_prune()
+	else:
+		log.info('Starting to mirror from %s to %s' % (source_root, dest_root))
+		if shard is not None:
+			log.info('Mirroring shard %d of %d' % shard)
+		steps = plan_mirror([ source_root ], options.prune)
+	try:
+		run_steps(steps, writer, options.jobs)
+		if changes is not None:
+			report_progress(writer)
+			publish_metrics(options.prometheus)
+			log.info('Watching %s for changes' % source_root)
+			for directories in watcher.batches(changes, options.watch_delay):
+				log.info('Changed: %s' % ', '.join(directories))
+				# The last batch may have pruned directories the workers know of
+				new_generation()
+				try:
+					run_steps(plan_directories(directories, reserved, options.prune), writer, options.jobs)
+				except Exception:
+					# e.g. a directory removed while it was being walked; the
+					# change that removed it will come in a later batch
+					log.exception('Error mirroring the changes to %s', ', '.join(directories))
+				publish_metrics(options.prometheus)
+		scheduler.finish()
+		if manifest_path is not None and not dry_run:
+			shards.write_manifest(manifest_path, source_root, dest_root, shard[0], shard[1], mirrored)
+	except KeyboardInterrupt:
+		scheduler.abort()
+		if changes is None:
+			log.error('Mirroring was interrupted')
+			report_metrics(options.prometheus)
+			sys.exit(1)
+		log.info('Stopped watching')
+	except PlanError as e:
+		log.error('Stopped applying the plan: %s', e)
+		scheduler.finish()
+		report_metrics(options.prometheus)
+		sys.exit(1)
+	finally:
+		if state is not None:
+			state.close()
+		if journal is not None:
+			journal.close()
+		if changes is not None:
+			changes.close()
+		if writer is not None and writer.out is not sys.stdout:
+			writer.out.close()
+		io_engine.close()
+	report_progress(writer)
+	report_metrics(options.prometheus)
 
 if __name__ == "__main__":
-	main()
+	main()
\ No newline at end of file
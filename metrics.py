@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""Counters, stage timings and events describing a mirror run, for monitoring.
+Recording is a dict update, so it is always on; the numbers are logged at the
+end of a run and can also be written as a JSON-lines event log (--events) and
+a Prometheus textfile (--prometheus, for node_exporter's textfile collector).
+
+Worker processes record into their own copy of this module. The scheduler
+sends each job's numbers back with its output (see take() and merge())."""
+
+import os
+import json
+import time
+import contextlib
+
+# Counters, e.g. files_scanned, files_transcoded, bytes_out
+counters = dict()
+
+# Stage name -> [times entered, total seconds]
+stages = dict()
+
+# Events waiting to be written, or None if events aren't wanted
+events = None
+
+# Where events are written, once opened with open_events
+_events_file = None
+
+started = time.time()
+
+
+def count(name, n=1):
+	counters[name] = counters.get(name, 0) + n
+
+
+@contextlib.contextmanager
+def stage(name):
+	"""Times a block of code as (part of) a stage such as 'walk' or 'transcode'."""
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		elapsed = time.perf_counter() - start
+		totals = stages.get(name)
+		if totals is None:
+			stages[name] = [ 1, elapsed ]
+		else:
+			totals[0] += 1
+			totals[1] += elapsed
+
+
+def timed(iterable, name):
+	"""Iterates over iterable, timing how long it takes to produce each item
+	(but not what is done with it) as the stage name."""
+	it = iter(iterable)
+	while True:
+		with stage(name):
+			try:
+				item = next(it)
+			except StopIteration:
+				return
+		yield item
+
+
+def event(kind, **fields):
+	"""Records an event, if events are being kept."""
+	if events is None:
+		return
+	fields['event'] = kind
+	fields['time'] = round(time.time(), 3)
+	events.append(fields)
+	if _events_file is not None:
+		flush_events()
+
+
+def keep_events():
+	"""Starts keeping events (in a worker, to hand back to the parent)."""
+	global events
+	events = list()
+
+
+def open_events(path):
+	"""Appends events to path as JSON lines."""
+	global _events_file
+	keep_events()
+	_events_file = open(path, 'a', buffering=1)
+
+
+def flush_events():
+	if _events_file is None or not events:
+		return
+	for fields in events:
+		_events_file.write(json.dumps(fields, sort_keys=True) + '\n')
+	del events[:]
+
+
+def take():
+	"""Returns, and resets, everything recorded since the last call."""
+	global counters, stages
+	taken = (counters, stages, events[:] if events is not None else None)
+	counters = dict()
+	stages = dict()
+	if events is not None:
+		del events[:]
+	return taken
+
+
+def merge(taken):
+	"""Adds numbers returned by take() (in another process) to these ones."""
+	(other_counters, other_stages, other_events) = taken
+	for (name, n) in other_counters.items():
+		count(name, n)
+	for (name, (calls, seconds)) in other_stages.items():
+		totals = stages.setdefault(name, [ 0, 0.0 ])
+		totals[0] += calls
+		totals[1] += seconds
+	if other_events and events is not None:
+		events.extend(other_events)
+		if _events_file is not None:
+			flush_events()
+
+
+def summary():
+	"""Returns the counters and stage timings as a line of text."""
+	parts = [ '%s=%d' % (name, counters[name]) for name in sorted(counters) ]
+	parts += [ '%s=%.1fs' % (name, stages[name][1]) for name in sorted(stages) ]
+	return ' '.join(parts)
+
+
+def write_prometheus(path, prefix='mediamirror'):
+	"""Writes the numbers in Prometheus' text format. The file is written under a
+	temporary name and renamed, so the collector never sees half of it."""
+	lines = list()
+	for name in sorted(counters):
+		metric = '%s_%s_total' % (prefix, name)
+		lines.append('# TYPE %s counter' % metric)
+		lines.append('%s %d' % (metric, counters[name]))
+	if stages:
+		lines.append('# TYPE %s_stage_seconds_total counter' % prefix)
+		for name in sorted(stages):
+			lines.append('%s_stage_seconds_total{stage="%s"} %.6f' % (prefix, name, stages[name][1]))
+		lines.append('# TYPE %s_stage_calls_total counter' % prefix)
+		for name in sorted(stages):
+			lines.append('%s_stage_calls_total{stage="%s"} %d' % (prefix, name, stages[name][0]))
+	lines.append('# TYPE %s_run_seconds gauge' % prefix)
+	lines.append('%s_run_seconds %.3f' % (prefix, time.time() - started))
+	lines.append('# TYPE %s_last_update_timestamp_seconds gauge' % prefix)
+	lines.append('%s_last_update_timestamp_seconds %.3f' % (prefix, time.time()))
+	temp = '%s.%d.part' % (path, os.getpid())
+	with open(temp, 'w') as f:
+		f.write('\n'.join(lines) + '\n')
+	os.replace(temp, path)
+
+
+def close():
+	global _events_file
+	flush_events()
+	if _events_file is not None:
+		_events_file.close()
+		_events_file = None
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""Compact set of the paths expected in the mirror. Rather than holding the full
+absolute path of every file and directory, paths below the root are kept as a
+tree of nested dicts keyed by path component, so the root and each directory
+name are stored once however many files are below them."""
+
+import os
+
+
+class PathTree(object):
+	"""A set of paths below root. Adding a path implicitly adds its parent
+	directories, as mediamirror always wants them kept too.
+
+	Each directory is a dict mapping the names in it to the dict for a
+	sub-directory, or to None for a file (or a directory with nothing added
+	below it yet). Paths that aren't below root are kept in a plain set."""
+	__slots__ = ('root', 'prefix', 'tree', 'others', 'count')
+
+	def __init__(self, root):
+		self.root = root
+		self.prefix = root if root.endswith(os.sep) else root + os.sep
+		self.tree = dict()
+		self.others = set()
+		self.count = 0
+
+	def _parts(self, path):
+		if path.startswith(self.prefix):
+			rel = path[len(self.prefix):]
+			if len(rel) == 0:
+				return []
+			return rel.split(os.sep)
+		if path + os.sep == self.prefix:
+			return []
+		return None
+
+	def add(self, path):
+		parts = self._parts(path)
+		if parts is None:
+			if path not in self.others:
+				self.others.add(path)
+				self.count += 1
+			return
+		node = self.tree
+		last = len(parts) - 1
+		for (i, name) in enumerate(parts):
+			child = node.get(name, False)
+			if child is False:
+				self.count += 1
+			if i == last:
+				if child is False:
+					node[name] = None
+				return
+			if child is None or child is False:
+				child = node[name] = dict()
+			node = child
+
+	def children(self, path):
+		"""Returns the names below a directory: a dict (which mustn't be
+		changed) whose keys are the names of the files and directories in it."""
+		parts = self._parts(path)
+		if parts is None:
+			return {}
+		node = self.tree
+		for name in parts:
+			node = node.get(name)
+			if node is None:
+				return {}
+		return node
+
+	def __contains__(self, path):
+		parts = self._parts(path)
+		if parts is None:
+			return path in self.others
+		node = self.tree
+		for name in parts:
+			if node is None or name not in node:
+				return False
+			node = node[name]
+		return True
+
+	def __iter__(self):
+		"""Yields the paths that have been added (but not the parent
+		directories added along with them)."""
+		stack = [ (self.prefix, self.tree) ]
+		while stack:
+			(path, node) = stack.pop()
+			for (name, child) in node.items():
+				if child is None:
+					yield path + name
+				else:
+					stack.append((path + name + os.sep, child))
+		yield from self.others
+
+	def __len__(self):
+		return self.count
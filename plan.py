@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Sync plans: the steps that bring the destination up to date with the source.
+mediamirror's planner yields them while it is still walking the source and its
+executor carries each out as it comes. --dry-run writes them out instead, as
+JSON lines, and --apply-plan reads such a file back and carries it out."""
+
+import json
+import time
+
+# Bump when the format changes in a way older versions can't read
+format_version = 1
+
+# What a step can do to the destination
+actions = [ 'copy', 'transcode', 'tag-sync', 'rewrite-playlist', 'convert', 'move', 'delete' ]
+
+
+class PlanError(Exception):
+	pass
+
+
+class Step(object):
+	"""One action on the destination path dest. Conversions make dest from
+	source with convert_fn and then call callback(ok, result). A move renames
+	orphan, an unwanted file in the destination, to dest (converting source if
+	that fails). A delete removes dest and everything below it."""
+	__slots__ = ('action', 'source', 'dest', 'convert_fn', 'callback', 'orphan')
+
+	def __init__(self, action, source, dest, convert_fn=None, callback=None, orphan=None):
+		self.action = action
+		self.source = source
+		self.dest = dest
+		self.convert_fn = convert_fn
+		self.callback = callback
+		self.orphan = orphan
+
+
+class PlanWriter(object):
+	"""Writes steps to the file object out, one JSON object per line, after a
+	line recording the roots they were planned for."""
+
+	def __init__(self, out, source_root, dest_root):
+		self.out = out
+		self.counts = dict()
+		self._write(dict(plan=format_version, source=source_root, dest=dest_root,
+		                 created=round(time.time(), 3)))
+
+	def write(self, step, handler=None):
+		"""Writes a step; handler names its convert_fn, if it has one."""
+		fields = dict(action=step.action, dest=step.dest)
+		if step.source is not None:
+			fields['source'] = step.source
+		if handler is not None:
+			fields['handler'] = handler
+		if step.orphan is not None:
+			fields['from'] = step.orphan
+		self._write(fields)
+		self.counts[step.action] = self.counts.get(step.action, 0) + 1
+
+	def summary(self):
+		"""Returns how many of each action have been written, as text."""
+		return ', '.join('%s %d' % (action, self.counts[action])
+		                 for action in actions if action in self.counts) or 'nothing'
+
+	def _write(self, fields):
+		# Paths that aren't valid UTF-8 are escaped, and come back the same from read_plan()
+		self.out.write(json.dumps(fields, sort_keys=True) + '\n')
+		self.out.flush()
+
+
+def read_plan(f):
+	"""Reads a plan written by PlanWriter from the file object f. Returns its
+	header (a dict with the 'source' and 'dest' roots) and an iterator over its
+	steps, as dicts with the same keys PlanWriter writes."""
+	try:
+		header = json.loads(f.readline())
+	except ValueError:
+		header = None
+	if not isinstance(header, dict) or 'plan' not in header:
+		raise PlanError('%s is not a mediamirror plan' % getattr(f, 'name', 'The file'))
+	if header['plan'] > format_version:
+		raise PlanError('The plan is in a newer format (%s) than this version can read' % header['plan'])
+	return (header, _steps(f))
+
+
+def _steps(f):
+	# The header was line 1
+	for (number, line) in enumerate(f, 2):
+		if not line.strip():
+			continue
+		try:
+			fields = json.loads(line)
+		except ValueError as e:
+			raise PlanError('Line %d of the plan is not valid JSON: %s' % (number, e))
+		if fields.get('action') not in actions or 'dest' not in fields:
+			raise PlanError('Line %d of the plan is not a step: %s' % (number, line.strip()))
+		if fields['action'] != 'delete' and 'source' not in fields:
+			raise PlanError('Line %d of the plan has no source: %s' % (number, line.strip()))
+		yield fields
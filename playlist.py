@@ -1,9 +1,17 @@
 #!/usr/bin/env python3
 
 import os
+import time
+import filecmp
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 import mutagen
+
+import walker
+from playlistcache import MetadataCache, cache_filename
+from state import directory_fingerprint
+from ioengine import stat_entry
 #from mutagen.id3 import ID3, ID3NoHeaderError, TALB, TPE1, TPE2, TBPM, COMM, TCMP, TCOM, TPE3, TDRC, TPOS, TCON, TSRC, TEXT, TPUB, TIT2, TRCK, UFID, TXXX, TSOP, TSO2, APIC, TSOT, TSOA
 #from mutagen.flac import FLAC
 
@@ -17,16 +25,6 @@ log_console.setFormatter(log_formatter)
 log.addHandler(log_console)
 
 
-def dirwalk(dir):
-	"""walk a directory tree returning each directory, using a generator"""
-	yield dir
-	for f in sorted( os.listdir(dir) ):
-		fullpath = os.path.join(dir,f)
-		if os.path.isdir(fullpath) and not os.path.islink(fullpath):
-			for x in dirwalk(fullpath):  # recurse into subdir
-				yield x
-
-
 def date_from_string(s):
 	if len(s) == 4: # e.g. 2004
 		return datetime.strptime(s, '%Y')
@@ -40,95 +38,206 @@ def date_from_string(s):
 		log.warning("Unknown format: %s", s)
 		return None
 		
-def get_date(meta):
-	'''Return a datetime of the original recording for this meta data'''
+def get_date_string(meta):
+	'''Return the tag holding the date of the original recording for this meta data'''
 	if 'originaldate' in meta:
-		return date_from_string(meta['originaldate'][0])
+		return meta['originaldate'][0]
 	elif 'date' in meta:
-		return date_from_string(meta['date'][0])
+		return meta['date'][0]
 	elif 'TDRC' in meta:
 # TDRC: "Recording time [...] when the audio was recorded".
 # TDRL: "Release time [...] when the audio was first released"
 # TDOR: "Original release time [...] when the original recording of the audio was released"
-		return date_from_string(str(meta['TDRC']))
-		return None #meta['TDRC']
+		return str(meta['TDRC'])
 	else:
 		# TODO Consider having a default date (epoch, now, user-specified)
 		return None
 
-all = dict()
+def get_date(meta):
+	'''Return a datetime of the original recording for this meta data'''
+	s = get_date_string(meta)
+	if s == None:
+		return None
+	return date_from_string(s)
+
+def read_track(filepath):
+	'''Parses a track (just once), returning its (length, date string)'''
+	try:
+		meta = mutagen.File(filepath)
+	except:
+		log.error("Error parsing data from %s", filepath)
+		return (None, None)
+	if meta == None:
+		return (None, None)
+	return (meta.info.length, get_date_string(meta))
 
-def parse_single_dir(directory):
-	global all
-	
+media_extensions = ( ".flac", ".mp3" )
+
+def released_string(date_string):
+	'''Turns a date tag into a string that sorts by date (that of a datetime)'''
+	if date_string == None:
+		return None
+	try:
+		date = date_from_string(date_string)
+	except ValueError:
+		log.warning("Invalid date: %s", date_string)
+		return None
+	if date == None:
+		return None
+	return str(date)
+
+def parse_single_dir(directory, entries=None, cache=None):
+	'''Compares the media in a directory with the cache, forgetting tracks that
+	have gone. Returns the (filepath, size, mtime) of the tracks that need parsing
+	and the directory's new fingerprint, or ([], None) if it hasn't changed'''
 	# Find all files (not dirs) in this directory
-	filenames = list()
-	allnames = os.listdir(directory)
-	for name in allnames:
-		if not os.path.isdir(os.path.join(directory, name)):
-			filenames.append(name)
-	filenames.sort()
-
-	media = list()
-	
-	runtime = 0.0
-	for name in filenames:
-		if name.lower().endswith(".flac") or name.lower().endswith(".mp3"):
-			media.append(name)
-
-			try:
-				filepath = os.path.join(directory, name)
-				meta = mutagen.File(filepath)
-				if meta != None:
-					runtime = runtime + meta.info.length
-			except:
-				pass
-
-	# Check there are some media files in this directory
-	if len(media) == 0:
-		return;
-
-	log.debug("%s %s minutes", directory, int(runtime / 60))
-
-	for filename in media:
-		filepath = os.path.join(directory, filename)
-		try:
-			meta = mutagen.File(filepath)
-		except:
-			log.error("Error parsing data from %s", filepath)
+	if entries is None:
+		entries = walker.scan(directory).files
+
+	fingerprint = directory_fingerprint(directory, entries)
+	if cache.fingerprint(directory) == fingerprint:
+		return ([], None)
+
+	known = cache.directory(directory)
+	stale = list()
+	for name in sorted(entries.keys()):
+		if not name.lower().endswith(media_extensions):
 			continue
-		
-		date = get_date(meta)
-		
-		if filename.startswith("01"):
-			#print date, filepath
-			log.debug("%s %s", date, filepath)
-		
-		if date == None:
-			#if filename.startswith("01"):
-			#	print sorted(meta.keys()), meta['TDRC'], type(meta['TDRC']), dir(meta['TDRC'])
-				#print meta
+		st = stat_entry(entries[name])
+		if st == None:
+			log.warning("Cannot read %s", os.path.join(directory, name))
 			continue
-		
-		if date not in all:
-			all[date] = list()
-		
-		all[date].append(filepath)
-	
-		
-def make_chrono_list(source_root, playlist_path = None):
-	for x in dirwalk(source_root):
-		parse_single_dir(x)
+		if known.pop(name, None) != (st.st_size, st.st_mtime):
+			stale.append((os.path.join(directory, name), st.st_size, st.st_mtime))
+	cache.forget(directory, known.keys())
+	return (stale, fingerprint)
+
+def update_cache(source_root, cache, jobs=1):
+	'''Brings the cache up to date with the tracks under source_root, only
+	looking inside directories that have changed and parsing the new and changed
+	tracks on a pool of jobs threads'''
+	directories = list()
+	fingerprints = list()
+	stale = list()
+	for d in walker.walk(source_root):
+		directories.append(d.path)
+		(tracks, fingerprint) = parse_single_dir(d.path, d.files, cache)
+		stale.extend(tracks)
+		if fingerprint != None:
+			fingerprints.append((d.path, fingerprint))
+	cache.keep_directories(directories)
 
-	# Write a playlist
+	log.info("Reading %d new or changed tracks", len(stale))
+	with ThreadPoolExecutor(jobs) as pool:
+		results = pool.map(read_track, [ filepath for (filepath, size, mtime) in stale ])
+		for ((filepath, size, mtime), (length, date)) in zip(stale, results):
+			cache.record(filepath, size, mtime, length, date, released_string(date))
+	# Only now is everything in these directories in the cache
+	for (directory, fingerprint) in fingerprints:
+		cache.set_fingerprint(directory, fingerprint)
+	cache.commit()
+
+
+class Playlist(object):
+	'''A playlist that is written a track at a time, in date order. It is written
+	to a temporary file and only replaces the existing playlist if it differs,
+	so an unchanged playlist keeps its mtime'''
+	def __init__(self, path, source_root):
+		self.path = path
+		self.source_root = source_root
+		self.temp = "%s.%d.part" % (path, os.getpid())
+		self.released = None
+		self.count = 0
+		self.f = open(self.temp, "w")
+
+	def add(self, filepath, released):
+		if released != self.released:
+			self.f.write("# tracks released %s\n" % (released))
+			self.released = released
+		self.f.write(filepath[len(self.source_root):] + "\n")
+		self.count += 1
+
+	def close(self):
+		self.f.close()
+		if os.path.exists(self.path) and filecmp.cmp(self.temp, self.path, shallow=False):
+			log.debug("%s is unchanged", self.path)
+			os.remove(self.temp)
+		else:
+			log.info("Writing %d tracks to %s", self.count, self.path)
+			os.replace(self.temp, self.path)
+
+
+class PlaylistSeries(object):
+	'''Splits tracks, given in date order, into a playlist per year, decade, etc.
+	name(released) gives the file name for a track; as the tracks are in order,
+	only one of the playlists is open at a time'''
+	def __init__(self, directory, source_root, name):
+		self.directory = directory
+		self.source_root = source_root
+		self.name = name
+		self.current = None
+		os.makedirs(directory, exist_ok=True)
+
+	def add(self, filepath, released):
+		path = os.path.join(self.directory, self.name(released))
+		if self.current == None or self.current.path != path:
+			self.close()
+			self.current = Playlist(path, self.source_root)
+		self.current.add(filepath, released)
+
+	def close(self):
+		if self.current != None:
+			self.current.close()
+			self.current = None
+
+
+class RecentPlaylist(Playlist):
+	'''The tracks added to the cache in the last few days'''
+	def __init__(self, path, source_root, days):
+		Playlist.__init__(self, path, source_root)
+		self.since = time.time() - days * 24 * 60 * 60
+
+	def add(self, filepath, released, added):
+		if added >= self.since:
+			Playlist.add(self, filepath, released)
+
+
+def make_chrono_list(source_root, playlist_path = None, cache = None, jobs = 1,
+                     year_dir = None, decade_dir = None, recent_path = None, recent_days = 30):
+	'''Writes the chronological playlist, plus playlists by year (into year_dir),
+	by decade (into decade_dir) and of recently added tracks (to recent_path),
+	in one pass over the tracks in release date order'''
+	if cache == None:
+		cache = MetadataCache(':memory:', source_root)
+	update_cache(source_root, cache, jobs)
+
+	if log.isEnabledFor(logging.DEBUG):
+		for (directory, runtime) in cache.runtimes():
+			log.debug("%s %s minutes", directory, int(runtime / 60))
+
+	outputs = list()
 	if playlist_path != None:
-		log.info("Writing a playlist to %s", playlist_path)
-		f  = open(playlist_path, "w")
-		for date in sorted(all.keys()):
-			f.write("# tracks released %s\n" % (date))
-			for filepath in sorted(all[date]):
-				f.write(filepath[len(source_root):] + "\n")
-		f.close()
+		outputs.append(Playlist(playlist_path, source_root))
+	if year_dir != None:
+		outputs.append(PlaylistSeries(year_dir, source_root, lambda released: released[:4] + ".m3u"))
+	if decade_dir != None:
+		outputs.append(PlaylistSeries(decade_dir, source_root, lambda released: released[:3] + "0s.m3u"))
+	recent = None
+	if recent_path != None:
+		recent = RecentPlaylist(recent_path, source_root, recent_days)
+
+	for (filepath, released, added) in cache.released():
+		if os.path.basename(filepath).startswith("01"):
+			log.debug("%s %s", released, filepath)
+		for output in outputs:
+			output.add(filepath, released)
+		if recent != None:
+			recent.add(filepath, released, added)
+
+	for output in outputs:
+		output.close()
+	if recent != None:
+		recent.close()
 
 
 #
@@ -148,6 +257,28 @@ def main():
 	parser.add_option("-s", "--source", dest="sourcedir",
 #					  default="Y:/music",
 					  help="The root of the source media tree.")
+	parser.add_option("-c", "--cache-file", dest="cache_file",
+					  default=None,
+					  help="Where to keep the length and date of each track, so only new or " +
+					  "changed tracks are read [default: %s in the source root]" % cache_filename)
+	parser.add_option("--no-cache", dest="no_cache",
+					  action="store_true", default=False,
+					  help="Read every track, without keeping a cache")
+	parser.add_option("-j", "--jobs", dest="jobs", type="int",
+					  default=4,
+					  help="The number of tracks to read at once [default: %default]")
+	parser.add_option("--by-year", dest="year_dir",
+					  default=None,
+					  help="Also write a playlist for each year (e.g. 1999.m3u) into this directory")
+	parser.add_option("--by-decade", dest="decade_dir",
+					  default=None,
+					  help="Also write a playlist for each decade (e.g. 1990s.m3u) into this directory")
+	parser.add_option("--recent", dest="recent_path",
+					  default=None,
+					  help="Also write a playlist of the tracks added in the last --recent-days days to this path")
+	parser.add_option("--recent-days", dest="recent_days", type="int",
+					  default=30,
+					  help="How recently a track must have been added to be in --recent [default: %default]")
 	parser.add_option("-v", "--verbose", dest="debug",
                       action="store_true", default=False,
                       help="Print more information for debugging purposes")
@@ -175,8 +306,20 @@ def main():
 	#
 	# Check all directories that lie under the source root
 	#
+	cache_path = options.cache_file
+	if options.no_cache:
+		cache_path = ':memory:'
+	elif cache_path == None:
+		cache_path = os.path.join(source_root, cache_filename)
+
 	log.info('Starting to create list from %s to %s' % (source_root, playlist_path))
-	make_chrono_list(source_root, playlist_path)
+	cache = MetadataCache(cache_path, source_root)
+	try:
+		make_chrono_list(source_root, playlist_path, cache, max(options.jobs, 1),
+		                 year_dir=options.year_dir, decade_dir=options.decade_dir,
+		                 recent_path=options.recent_path, recent_days=options.recent_days)
+	finally:
+		cache.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""On-disk cache of the track metadata playlist.py needs (length and date), so
+a track is only parsed again when its size or mtime changes."""
+
+import os
+import time
+import sqlite3
+
+import logging
+log = logging.getLogger("playlister")
+
+# Default name of the cache, created in the root of the source
+cache_filename = ".playlist-cache.db"
+
+# Bump when the schema changes; an older cache is thrown away and rebuilt
+schema_version = 1
+
+schema = """
+CREATE TABLE IF NOT EXISTS tracks (
+	dir TEXT NOT NULL,
+	name TEXT NOT NULL,
+	size INTEGER NOT NULL,
+	mtime REAL NOT NULL,
+	length REAL,
+	date TEXT,
+	released TEXT,
+	added REAL NOT NULL,
+	PRIMARY KEY (dir, name)
+);
+CREATE INDEX IF NOT EXISTS tracks_released ON tracks (released, dir, name);
+CREATE TABLE IF NOT EXISTS dirs (
+	dir TEXT PRIMARY KEY,
+	fingerprint TEXT NOT NULL
+);
+"""
+
+
+class MetadataCache(object):
+	"""Maps each track (by directory and name, relative to root) to the size and
+	mtime it had when it was parsed, its length in seconds, the date string from
+	its tags, that date as a sortable 'YYYY-MM-DD HH:MM:SS' string (released)
+	and when it was first seen. Tracks are indexed by release date, so they can
+	be read back in order without sorting. Use ':memory:' as the path for a
+	cache that isn't kept."""
+
+	def __init__(self, path, root):
+		self.path = path
+		self.root = root
+		self.db = sqlite3.connect(path)
+		if self.db.execute("PRAGMA user_version").fetchone()[0] != schema_version:
+			self.db.executescript("DROP TABLE IF EXISTS tracks; DROP TABLE IF EXISTS dirs;")
+			self.db.execute("PRAGMA user_version = %d" % schema_version)
+		self.db.executescript(schema)
+
+	def _dir(self, directory):
+		rel = os.path.relpath(directory, self.root)
+		if rel == os.curdir:
+			rel = ''
+		return rel
+
+	def directory(self, directory):
+		"""Returns {name: (size, mtime)} for the tracks cached for a directory."""
+		rows = self.db.execute("SELECT name, size, mtime FROM tracks WHERE dir = ?", (self._dir(directory),))
+		return dict((row[0], row[1:]) for row in rows)
+
+	def fingerprint(self, directory):
+		"""Returns the fingerprint recorded when directory was last brought up to date."""
+		row = self.db.execute("SELECT fingerprint FROM dirs WHERE dir = ?", (self._dir(directory),)).fetchone()
+		if row is None:
+			return None
+		return row[0]
+
+	def set_fingerprint(self, directory, fingerprint):
+		self.db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?)", (self._dir(directory), fingerprint))
+
+	def record(self, filepath, size, mtime, length, date, released):
+		(head, tail) = os.path.split(filepath)
+		# Keep when the track was first added if it has only been re-tagged
+		self.db.execute("INSERT INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+		                "ON CONFLICT (dir, name) DO UPDATE SET size = excluded.size, mtime = excluded.mtime, "
+		                "length = excluded.length, date = excluded.date, released = excluded.released",
+		                (self._dir(head), tail, size, mtime, length, date, released, time.time()))
+
+	def forget(self, directory, names):
+		d = self._dir(directory)
+		self.db.executemany("DELETE FROM tracks WHERE dir = ? AND name = ?", ((d, name) for name in names))
+
+	def keep_directories(self, directories):
+		"""Forgets the tracks in every directory not in directories."""
+		self.db.execute("CREATE TEMP TABLE IF NOT EXISTS seen (dir TEXT PRIMARY KEY)")
+		self.db.execute("DELETE FROM seen")
+		self.db.executemany("INSERT OR IGNORE INTO seen VALUES (?)", ((self._dir(d),) for d in directories))
+		self.db.execute("DELETE FROM tracks WHERE dir NOT IN (SELECT dir FROM seen)")
+		self.db.execute("DELETE FROM dirs WHERE dir NOT IN (SELECT dir FROM seen)")
+
+	def runtimes(self):
+		"""Yields (directory, total length) for each directory with tracks."""
+		for (d, length) in self.db.execute("SELECT dir, SUM(length) FROM tracks GROUP BY dir ORDER BY dir"):
+			yield (os.path.join(self.root, d), length or 0.0)
+
+	def released(self):
+		"""Yields (path, released, added) for every track with a release date,
+		in order of release date then path, straight from the index."""
+		for (d, name, released, added) in self.db.execute(
+				"SELECT dir, name, released, added FROM tracks WHERE released IS NOT NULL "
+				"ORDER BY released, dir, name"):
+			yield (os.path.join(self.root, d, name), released, added)
+
+	def commit(self):
+		self.db.commit()
+
+	def close(self):
+		self.db.commit()
+		self.db.close()
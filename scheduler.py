@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""Runs mirror jobs (transcodes, copies, playlist rewrites) either inline or on
+a bounded pool of worker processes, replaying each job's output in the order
+the jobs were queued."""
+
+import io
+import os
+import sys
+import time
+import signal
+import contextlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import metrics
+
+import logging
+log = logging.getLogger("mediamirror")
+
+# Loggers whose records are captured in the workers and replayed by the parent
+captured_loggers = [ "mediamirror", "flac2mp3" ]
+
+# How many jobs may be queued per worker before the walk waits for the oldest
+queue_depth = 4
+
+
+class _CaptureHandler(logging.Handler):
+	"""Collects log records in a worker so they can be sent back to the parent."""
+	def __init__(self):
+		logging.Handler.__init__(self)
+		self.records = []
+
+	def emit(self, record):
+		# Flatten the record so it pickles regardless of what the args were
+		record.msg = record.getMessage()
+		record.args = None
+		if record.exc_info:
+			record.exc_text = logging.Formatter().formatException(record.exc_info)
+			record.exc_info = None
+		self.records.append(record)
+
+_capture = None
+
+
+def _worker_init(initializer, initargs):
+	global _capture
+	# Ctrl-C reaches the whole process group. Leave it to the parent to stop
+	# the pool, rather than have idle workers die with a traceback; running
+	# jobs still fail when their encoder is interrupted.
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	# Forked workers start with a copy of the parent's metrics; only send back their own
+	metrics.take()
+	if initializer is not None:
+		initializer(*initargs)
+	_capture = _CaptureHandler()
+	for name in captured_loggers:
+		logger = logging.getLogger(name)
+		logger.handlers = [ _capture ]
+		logger.propagate = False
+
+
+def _mtime(path):
+	try:
+		return os.path.getmtime(path)
+	except OSError:
+		return None
+
+
+def remove_partial(dest, before):
+	"""Removes dest if it was created or modified since its mtime was 'before'."""
+	after = _mtime(dest)
+	if after is not None and after != before:
+		log.warning('Removing partially written file: %s', dest)
+		try:
+			os.remove(dest)
+		except OSError:
+			log.error('Error deleting file %s' % dest)
+
+
+def _call(fn, source, dest):
+	"""Runs fn, cleaning up dest if it fails part way through.
+	Returns (ok, result); a job that returns False has failed."""
+	before = _mtime(dest)
+	start = time.perf_counter()
+	try:
+		result = fn(source, dest)
+		ok = result is not False
+	except KeyboardInterrupt:
+		remove_partial(dest, before)
+		raise
+	except Exception:
+		log.exception('Error processing %s', source)
+		remove_partial(dest, before)
+		(ok, result) = (False, None)
+	fields = dict()
+	if ok and isinstance(result, dict):
+		fields = dict((key, result[key]) for key in ('action', 'bytes') if key in result)
+		if 'bytes' in result:
+			# Only count the source as read if something was written from it
+			metrics.count('bytes_in', os.path.getsize(source))
+	metrics.event('job', source=source, dest=dest, ok=ok,
+	              seconds=round(time.perf_counter() - start, 3), **fields)
+	return (ok, result)
+
+
+def _run_job(fn, source, dest):
+	"""Worker side of a job: returns (ok, result, log records, stdout text,
+	metrics recorded)."""
+	_capture.records = []
+	out = io.StringIO()
+	try:
+		with contextlib.redirect_stdout(out):
+			(ok, result) = _call(fn, source, dest)
+	except KeyboardInterrupt:
+		# The parent has been interrupted too; just report the job as failed
+		(ok, result) = (False, None)
+	return (ok, result, _capture.records, out.getvalue(), metrics.take())
+
+
+class Scheduler(object):
+	"""Queues jobs of the form fn(source, dest).
+
+	With jobs == 1 everything runs inline as it is queued, unless background is
+	set. Otherwise a pool of worker processes runs them and the output of each
+	job is replayed in queue order, so the log reads the same as a serial run.
+	With background and one job, the caller can get on with something else
+	(e.g. planning what comes next) while a job runs."""
+
+	def __init__(self, jobs=1, initializer=None, initargs=(), background=False):
+		self.jobs = jobs
+		self.pending = deque()
+		self.completed = 0
+		self.failed = 0
+		# How many jobs reported each 'action' (e.g. transcoded vs tag-synced),
+		# and how many 'bytes' they reported
+		self.actions = dict()
+		self.action_bytes = dict()
+		self.started = time.time()
+		self.executor = None
+		if jobs > 1 or background:
+			self.executor = ProcessPoolExecutor(jobs, initializer=_worker_init,
+			                                    initargs=(initializer, initargs))
+
+	def submit(self, fn, source, dest, callback=None):
+		"""Queue fn(source, dest). callback(ok, result) is called, in queue
+		order, once the job has finished."""
+		if self.executor is None:
+			(ok, result) = _call(fn, source, dest)
+			self._finished(ok, result, callback)
+			return
+		future = self.executor.submit(_run_job, fn, source, dest)
+		self.pending.append((future, dest, _mtime(dest), callback))
+		while len(self.pending) > self.jobs * queue_depth:
+			self._collect()
+
+	def _finished(self, ok, result, callback):
+		if ok:
+			self.completed += 1
+			if isinstance(result, dict) and 'action' in result:
+				action = result['action']
+				self.actions[action] = self.actions.get(action, 0) + 1
+				metrics.count('files_' + action.replace('-', '_'))
+				if 'bytes' in result:
+					self.action_bytes[action] = self.action_bytes.get(action, 0) + result['bytes']
+					metrics.count('bytes_out', result['bytes'])
+		else:
+			self.failed += 1
+			metrics.count('files_failed')
+		if callback is not None:
+			callback(ok, result)
+
+	def _collect(self):
+		(future, dest, before, callback) = self.pending.popleft()
+		(ok, result, records, output, taken) = future.result()
+		metrics.merge(taken)
+		self._replay(records, output)
+		self._finished(ok, result, callback)
+
+	def _replay(self, records, output):
+		for record in records:
+			logging.getLogger(record.name).handle(record)
+		if output:
+			sys.stdout.write(output)
+			sys.stdout.flush()
+
+	def wait(self):
+		"""Wait for all queued jobs to complete, leaving the workers running."""
+		while self.pending:
+			self._collect()
+
+	def finish(self):
+		"""Wait for all queued jobs to complete and stop the workers."""
+		self.wait()
+		if self.executor is not None:
+			self.executor.shutdown()
+
+	def abort(self):
+		"""Stop after an interrupt: drop queued jobs, wait for running ones and
+		remove any output they left half written."""
+		log.warning('Interrupted, waiting for running jobs to stop')
+		for (future, dest, before, callback) in self.pending:
+			future.cancel()
+		for (future, dest, before, callback) in self.pending:
+			if future.cancelled():
+				continue
+			try:
+				(ok, result, records, output, taken) = future.result()
+				metrics.merge(taken)
+				self._replay(records, output)
+			except BaseException:
+				ok = False
+			if not ok:
+				remove_partial(dest, before)
+		self.pending.clear()
+		if self.executor is not None:
+			self.executor.shutdown(wait=True, cancel_futures=True)
+
+	def summary(self):
+		elapsed = time.time() - self.started
+		rate = self.completed / elapsed if elapsed > 0 else 0.0
+		log.info('Processed %d files (%d failed) in %.1fs, %.2f files/sec',
+		         self.completed, self.failed, elapsed, rate)
+		if self.actions:
+			log.info('Of which: %s', ', '.join(self._describe(action) for action in sorted(self.actions)))
+
+	def _describe(self, action):
+		if action not in self.action_bytes:
+			return '%s %d' % (action, self.actions[action])
+		return '%s %d (%.1f MB)' % (action, self.actions[action], self.action_bytes[action] / 1048576.0)
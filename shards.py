@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Splitting a mirror between several processes with --shard i/N, e.g. one
+container on each of several hosts, all writing to the same share. Each source
+directory belongs to one shard, picked by a stable hash of its path, so the
+shards need no locks or coordination: each mirrors just its own directories,
+with a state database and journal of its own, and when it has finished writes a
+manifest of the destination paths it mirrored. Once all N have finished,
+--merge-shards N reads the manifests back as the set of everything that should
+be in the mirror, and prunes the rest."""
+
+import os
+import json
+import time
+import zlib
+
+# Bump when the manifest format changes in a way older versions can't read
+format_version = 1
+
+# Name of the manifests, created in the root of the destination
+manifest_filename = ".mediamirror-manifest"
+
+
+class ShardError(Exception):
+	pass
+
+
+def parse(spec):
+	"""Parses a shard given as i/N, where 1 <= i <= N, into (i, N)."""
+	(index, sep, count) = spec.partition('/')
+	try:
+		(index, count) = (int(index), int(count))
+	except ValueError:
+		sep = None
+	if not sep or count < 1 or not 1 <= index <= count:
+		raise ValueError("Shards should be given as i/N, with i from 1 to N: %s" % spec)
+	return (index, count)
+
+
+def owner(directory, count):
+	"""Returns which of count shards (1 to count) mirrors a source directory,
+	given relative to the source root. It depends on nothing but the path, so
+	every shard, on every host, agrees."""
+	key = directory.replace(os.sep, '/').strip('/')
+	if key == os.curdir:
+		key = ''
+	return zlib.crc32(key.encode('utf-8', 'surrogateescape')) % count + 1
+
+
+def shard_name(filename, index, count):
+	"""Returns filename (e.g. of the state database) as shard index of count's own."""
+	(root, ext) = os.path.splitext(filename)
+	return '%s.shard-%d-of-%d%s' % (root, index, count, ext)
+
+
+def manifest_path(dest_root, index, count):
+	return os.path.join(dest_root, shard_name(manifest_filename, index, count))
+
+
+def write_manifest(path, source_root, dest_root, index, count, paths):
+	"""Writes the destination paths shard index of count mirrored, one JSON
+	string per line relative to dest_root, after a line recording the roots.
+	It's written to a temporary file and renamed into place, so a manifest is
+	either complete or not there."""
+	temp = path + '.new'
+	with open(temp, 'w', encoding='utf-8') as out:
+		out.write(json.dumps(dict(manifest=format_version, source=source_root, dest=dest_root,
+		                          shard=index, shards=count, created=round(time.time(), 3)),
+		                     sort_keys=True) + '\n')
+		for name in paths:
+			# Paths that aren't valid UTF-8 are escaped, and come back the same
+			out.write(json.dumps(os.path.relpath(name, dest_root)) + '\n')
+		out.flush()
+		os.fsync(out.fileno())
+	os.replace(temp, path)
+
+
+def remove_manifest(path):
+	"""Removes a shard's manifest as it starts, so it can't be merged until it has finished."""
+	try:
+		os.remove(path)
+	except FileNotFoundError:
+		pass
+
+
+def read_manifests(dest_root, count):
+	"""Checks the manifests of all count shards are there, then returns an
+	iterator over the destination paths in them. The paths are relative, so the
+	shards may have had the share mounted in different places."""
+	paths = [ manifest_path(dest_root, index, count) for index in range(1, count + 1) ]
+	missing = [ os.path.basename(path) for path in paths if not os.path.exists(path) ]
+	if missing:
+		raise ShardError('Not every shard has finished, there is no %s' % ', '.join(missing))
+	for (index, path) in enumerate(paths, 1):
+		with open(path, encoding='utf-8') as f:
+			try:
+				header = json.loads(f.readline())
+			except ValueError:
+				header = None
+		if not isinstance(header, dict) or header.get('manifest') != format_version:
+			raise ShardError('%s is not a mediamirror manifest this version can read' % path)
+		if (header['shard'], header['shards']) != (index, count):
+			raise ShardError('%s was written by shard %s/%s' % (path, header['shard'], header['shards']))
+	return _paths(paths, dest_root)
+
+
+def _paths(manifests, dest_root):
+	for path in manifests:
+		with open(path, encoding='utf-8') as f:
+			f.readline()
+			for line in f:
+				yield os.path.join(dest_root, json.loads(line))
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""On-disk record of what has already been mirrored, so that unchanged files can
+be skipped without touching the destination tree."""
+
+import os
+import time
+import hashlib
+import sqlite3
+
+from ioengine import stat_entry
+
+import logging
+log = logging.getLogger("mediamirror")
+
+# Default name of the state database, created in the root of the destination
+state_filename = ".mediamirror-state.db"
+
+# Commit after this many changes, or this many seconds after the last commit,
+# so an interrupted run keeps most of its work
+commit_interval = 500
+commit_seconds = 30.0
+
+schema = """
+CREATE TABLE IF NOT EXISTS files (
+	dir TEXT NOT NULL,
+	name TEXT NOT NULL,
+	size INTEGER NOT NULL,
+	mtime REAL NOT NULL,
+	md5 TEXT,
+	dest TEXT NOT NULL,
+	dest_mtime REAL NOT NULL,
+	PRIMARY KEY (dir, name)
+);
+CREATE TABLE IF NOT EXISTS dirs (
+	dir TEXT PRIMARY KEY,
+	fingerprint TEXT NOT NULL
+);
+"""
+
+
+def directory_fingerprint(directory, entries, salt=''):
+	"""Returns a hash of a directory's mtime and the (name, size, mtime) of the
+	files in it; entries maps names to os.DirEntry objects. Anything that
+	changes how the directory is mirrored should be passed in as salt."""
+	h = hashlib.sha1(salt.encode('utf-8', 'surrogateescape'))
+	h.update(str(os.stat(directory).st_mtime_ns).encode('ascii'))
+	for name in sorted(entries.keys()):
+		st = stat_entry(entries[name])
+		if st is None:
+			# A dangling symlink, or deleted since the directory was listed
+			h.update(('\0%s\0-' % name).encode('utf-8', 'surrogateescape'))
+		else:
+			h.update(('\0%s\0%d\0%d' % (name, st.st_size, st.st_mtime_ns)).encode('utf-8', 'surrogateescape'))
+	return h.hexdigest()
+
+
+def _below(column, rel):
+	"""Returns an SQL condition, and its arguments, for a relative path in
+	column being rel or anything below it. '' is the root, so everything."""
+	if rel == '':
+		return ('1', ())
+	return ('(%s = ? OR substr(%s, 1, ?) = ?)' % (column, column), (rel, len(rel) + 1, rel + os.sep))
+
+
+class MirrorState(object):
+	"""Maps each source file (by directory and name) to the size and mtime it had
+	when it was last mirrored, its FLAC audio MD5 (if known) and the destination
+	it was mirrored to. Paths are stored relative to the source/dest roots."""
+
+	def __init__(self, path, source_root, dest_root):
+		self.path = path
+		self.source_root = source_root
+		self.dest_root = dest_root
+		self.changes = 0
+		self.committed = time.monotonic()
+		self.db = sqlite3.connect(path)
+		self.db.executescript(schema)
+
+	def _split(self, source):
+		(head, tail) = os.path.split(os.path.relpath(source, self.source_root))
+		return (head, tail)
+
+	def directory(self, directory):
+		"""Returns {name: row} for everything recorded in a source directory."""
+		rows = self.db.execute("SELECT name, size, mtime, md5, dest, dest_mtime FROM files WHERE dir = ?", (self._dir(directory),))
+		return dict((row[0], row) for row in rows)
+
+	def _dir(self, directory):
+		rel = os.path.relpath(directory, self.source_root)
+		if rel == os.curdir:
+			rel = ''
+		return rel
+
+	def fingerprint(self, directory):
+		"""Returns the fingerprint recorded when directory was last fully mirrored."""
+		row = self.db.execute("SELECT fingerprint FROM dirs WHERE dir = ?", (self._dir(directory),)).fetchone()
+		if row is None:
+			return None
+		return row[0]
+
+	def set_fingerprint(self, directory, fingerprint):
+		self.db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?)", (self._dir(directory), fingerprint))
+		self._changed()
+
+	def keep_directories(self, directories, tops):
+		"""Forgets the files and fingerprints of the directories in and below
+		tops that aren't in directories, e.g. because they have been moved
+		away, so if they come back they are mirrored again."""
+		self.db.execute("CREATE TEMP TABLE IF NOT EXISTS seen (dir TEXT PRIMARY KEY)")
+		self.db.execute("DELETE FROM seen")
+		self.db.executemany("INSERT OR IGNORE INTO seen VALUES (?)", ((self._dir(d),) for d in directories))
+		for top in tops:
+			(below, args) = _below('dir', self._dir(top))
+			self.db.execute("DELETE FROM files WHERE dir NOT IN (SELECT dir FROM seen) AND " + below, args)
+			self.db.execute("DELETE FROM dirs WHERE dir NOT IN (SELECT dir FROM seen) AND " + below, args)
+		self._changed()
+
+	def forget_dests(self, paths):
+		"""Forgets the files mirrored to paths (or below them) in the
+		destination, and the fingerprints of their directories, once they have
+		been pruned."""
+		for path in paths:
+			rel = os.path.relpath(path, self.dest_root)
+			(below, args) = _below('dest', rel)
+			self.db.execute("DELETE FROM files WHERE " + below, args)
+			(below, args) = _below('dir', rel)
+			self.db.execute("DELETE FROM dirs WHERE " + below, args)
+		self._changed()
+
+	def is_current(self, row, st, dest):
+		"""True if the recorded row shows dest was made from a source with stat st."""
+		if row is None:
+			return False
+		return (row[1] == st.st_size and row[2] == st.st_mtime and
+		        row[4] == os.path.relpath(dest, self.dest_root))
+
+	def record(self, source, size, mtime, dest, dest_mtime, md5=None):
+		(head, tail) = self._split(source)
+		self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+		                (head, tail, size, mtime, md5, os.path.relpath(dest, self.dest_root), dest_mtime))
+		self._changed()
+
+	def forget(self, source):
+		(head, tail) = self._split(source)
+		self.db.execute("DELETE FROM files WHERE dir = ? AND name = ?", (head, tail))
+		self._changed()
+
+	def clear(self):
+		log.info('Clearing mirror state in %s', self.path)
+		self.db.execute("DELETE FROM files")
+		self.db.execute("DELETE FROM dirs")
+		self.db.commit()
+
+	def _changed(self):
+		self.changes += 1
+		if self.changes >= commit_interval or time.monotonic() - self.committed >= commit_seconds:
+			self.commit()
+
+	def commit(self):
+		self.db.commit()
+		self.changes = 0
+		self.committed = time.monotonic()
+
+	def close(self):
+		self.commit()
+		self.db.close()
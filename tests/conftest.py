@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules are run as scripts from the top of the tree rather than installed
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
@@ -0,0 +1,109 @@
+import os
+import json
+
+import journal
+from journal import Journal
+
+
+def touch(path, data=b'x', mtime=None):
+	with open(path, 'wb') as f:
+		f.write(data)
+	if mtime is not None:
+		os.utime(path, (mtime, mtime))
+
+
+def test_unfinished_is_what_began_and_never_ended(tmp_path):
+	path = str(tmp_path / 'journal')
+	j = Journal(path, str(tmp_path))
+	first = j.begin(str(tmp_path / 'a.mp3'))
+	second = j.begin(str(tmp_path / 'b.mp3'))
+	j.end(first)
+	j.close()
+	assert [ record['dest'] for record in journal.unfinished(path) ] == [ 'b.mp3' ]
+	assert j.in_flight.keys() == { second }
+
+
+def test_close_removes_the_journal_when_nothing_is_in_flight(tmp_path):
+	path = str(tmp_path / 'journal')
+	j = Journal(path, str(tmp_path))
+	j.end(j.begin(str(tmp_path / 'a.mp3')))
+	j.close()
+	assert not os.path.exists(path)
+
+
+def test_begin_records_the_destination_mtime(tmp_path):
+	dest = str(tmp_path / 'a.mp3')
+	touch(dest, mtime=1000000000)
+	path = str(tmp_path / 'journal')
+	j = Journal(path, str(tmp_path))
+	j.begin(dest)
+	j.close()
+	assert journal.unfinished(path)[0]['mtime'] == 1000000000
+	j = Journal(str(tmp_path / 'other'), str(tmp_path))
+	j.begin(str(tmp_path / 'missing.mp3'))
+	j.close()
+	assert journal.unfinished(str(tmp_path / 'other'))[0]['mtime'] is None
+
+
+def test_compacting_keeps_the_jobs_in_flight(tmp_path, monkeypatch):
+	monkeypatch.setattr(journal, 'compact_records', 10)
+	path = str(tmp_path / 'journal')
+	j = Journal(path, str(tmp_path))
+	kept = j.begin(str(tmp_path / 'kept.mp3'))
+	for n in range(20):
+		j.end(j.begin(str(tmp_path / ('%d.mp3' % n))))
+	j.close()
+	with open(path) as f:
+		assert len(f.readlines()) < 10
+	assert [ record['begin'] for record in journal.unfinished(path) ] == [ kept ]
+
+
+def test_a_torn_last_record_is_ignored(tmp_path):
+	path = str(tmp_path / 'journal')
+	j = Journal(path, str(tmp_path))
+	j.begin(str(tmp_path / 'a.mp3'))
+	j.close()
+	with open(path, 'a') as f:
+		f.write(json.dumps(dict(begin=1, dest='b.mp3', mtime=None))[:12])
+	assert [ record['dest'] for record in journal.unfinished(path) ] == [ 'a.mp3' ]
+
+
+def test_recover_removes_changed_destinations_and_temporaries(tmp_path):
+	root = str(tmp_path)
+	(changed, unchanged, new, done) = [ os.path.join(root, name) for name in [ 'changed.mp3', 'unchanged.mp3', 'new.mp3', 'done.mp3' ] ]
+	touch(changed, mtime=1000000000)
+	touch(unchanged, mtime=1000000000)
+	path = os.path.join(root, journal.journal_filename)
+	j = Journal(path, root)
+	for dest in [ changed, unchanged, new ]:
+		j.begin(dest)
+	j.end(j.begin(done))
+	# What the jobs left when the run was killed: a rewrite in place, the
+	# temporary files of flac2mp3.temp_name and fastcopy, and a finished file
+	touch(changed, b'half', mtime=1000000100)
+	temps = [ os.path.join(root, 'unchanged.123.part.mp3'), os.path.join(root, 'new.mp3.456.part') ]
+	for temp in temps:
+		touch(temp)
+	touch(done)
+	j.out.close()
+
+	(dests, removed) = journal.recover(path, root)
+
+	assert dests == [ changed, unchanged, new ]
+	assert removed == 3
+	assert not os.path.exists(changed)
+	assert os.path.exists(unchanged)
+	assert os.path.exists(done)
+	assert not any(os.path.exists(temp) for temp in temps)
+	assert not os.path.exists(path)
+
+
+def test_recover_without_a_journal_does_nothing(tmp_path):
+	assert journal.recover(str(tmp_path / 'journal'), str(tmp_path)) == ([], 0)
+
+
+def test_is_temporary():
+	assert journal.is_temporary('01 - Track 01.21841.part.mp3')
+	assert journal.is_temporary('cover.jpg.21841.part')
+	assert not journal.is_temporary('01 - Track 01.mp3')
+	assert not journal.is_temporary('the.part.mp3')
@@ -0,0 +1,47 @@
+import os
+
+from pathtree import PathTree
+
+root = os.path.join(os.sep, 'dest')
+
+
+def path(*names):
+	return os.path.join(root, *names)
+
+
+def test_adding_a_path_adds_its_parents():
+	tree = PathTree(root)
+	tree.add(path('Artist', 'Album', '01.mp3'))
+	assert path('Artist', 'Album', '01.mp3') in tree
+	assert path('Artist', 'Album') in tree
+	assert path('Artist') in tree
+	assert path('Artist', 'Other') not in tree
+	assert len(tree) == 3
+
+
+def test_children():
+	tree = PathTree(root + os.sep)
+	tree.add(path('Artist', 'Album', '01.mp3'))
+	tree.add(path('Artist', 'Album', '02.mp3'))
+	tree.add(path('Artist', 'best of.m3u'))
+	assert set(tree.children(path('Artist', 'Album'))) == { '01.mp3', '02.mp3' }
+	assert set(tree.children(path('Artist'))) == { 'Album', 'best of.m3u' }
+	assert set(tree.children(root)) == { 'Artist' }
+	assert tree.children(path('Nobody')) == {}
+
+
+def test_iterates_over_what_was_added():
+	tree = PathTree(root)
+	added = [ path('Artist', 'Album', '01.mp3'), path('Artist', 'best of.m3u'), path('.mediamirror-state.db') ]
+	for name in added + added:
+		tree.add(name)
+	assert sorted(tree) == sorted(added)
+	assert len(tree) == 5
+
+
+def test_paths_outside_the_root():
+	tree = PathTree(root)
+	tree.add(os.path.join(os.sep, 'elsewhere', 'state.db'))
+	assert os.path.join(os.sep, 'elsewhere', 'state.db') in tree
+	assert os.path.join(os.sep, 'elsewhere') not in tree
+	assert list(tree) == [ os.path.join(os.sep, 'elsewhere', 'state.db') ]
@@ -0,0 +1,76 @@
+import os
+import sys
+import time
+import signal
+import subprocess
+
+import flac2mp3
+import journal
+
+here = os.path.dirname(os.path.abspath(__file__))
+top = os.path.join(here, os.pardir)
+
+tracks = 12
+chunks = 10
+chunk_delay = 0.05
+
+
+def slow_transcode(source, dest):
+	"""A conversion handler that writes dest slowly, a chunk at a time, to the
+	temporary file flac2mp3 transcodes to, then renames it into place."""
+	os.makedirs(os.path.dirname(dest), exist_ok=True)
+	with open(source, 'rb') as f:
+		data = f.read()
+	temp = flac2mp3.temp_name(dest)
+	size = len(data) // chunks + 1
+	with open(temp, 'wb') as out:
+		for start in range(0, len(data), size):
+			out.write(data[start:start + size])
+			out.flush()
+			time.sleep(chunk_delay)
+	os.replace(temp, dest)
+	return {'action': 'transcoded', 'bytes': len(data)}
+
+
+def mirror(source, dest):
+	return [ sys.executable, os.path.join(top, 'mediamirror.py'), '-s', source, '-d', dest, '--state', '-j', '2',
+	         '--conversion', 'flac=mp3:test_resume.slow_transcode:10' ]
+
+
+def temporaries(dest):
+	return [ name for (dirpath, dirnames, filenames) in os.walk(dest) for name in filenames
+	         if journal.is_temporary(name) ]
+
+
+def test_a_run_killed_mid_transcode_is_finished_by_the_next(tmp_path):
+	source = str(tmp_path / 'source')
+	dest = str(tmp_path / 'dest')
+	album = os.path.join(source, 'Artist', 'Album')
+	os.makedirs(album)
+	for n in range(tracks):
+		with open(os.path.join(album, '%02d.flac' % n), 'wb') as f:
+			f.write(os.urandom(2000 + n))
+	env = dict(os.environ, PYTHONPATH=here)
+
+	# Kill the whole process group, workers and all, once something is half written
+	first = subprocess.Popen(mirror(source, dest), env=env, start_new_session=True,
+	                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	deadline = time.time() + 30
+	while not temporaries(dest) and first.poll() is None and time.time() < deadline:
+		time.sleep(0.01)
+	os.killpg(first.pid, signal.SIGKILL)
+	first.wait()
+	assert temporaries(dest)
+	assert os.path.exists(os.path.join(dest, journal.journal_filename))
+
+	subprocess.run(mirror(source, dest), env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+	               check=True, timeout=60)
+
+	assert temporaries(dest) == []
+	assert not os.path.exists(os.path.join(dest, journal.journal_filename))
+	for n in range(tracks):
+		name = '%02d' % n
+		with open(os.path.join(album, name + '.flac'), 'rb') as f:
+			expected = f.read()
+		with open(os.path.join(dest, 'Artist', 'Album', name + '.mp3'), 'rb') as f:
+			assert f.read() == expected
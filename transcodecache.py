@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""Content-addressed cache of transcoded files, keyed by the FLAC's audio MD5 and
+the encoder settings, so a track that has been moved or renamed in the source
+can be mirrored without transcoding it again."""
+
+import os
+import sys
+import hashlib
+
+import fastcopy
+
+import logging
+log = logging.getLogger("flac2mp3")
+
+# Re-count the size of the cache after this many files have been added
+recount_interval = 100
+
+
+def settings_key(settings):
+	"""Short, stable identifier for a list of encoder settings."""
+	return hashlib.sha1(repr(list(settings)).encode('utf-8')).hexdigest()[:12]
+
+
+class TranscodeCache(object):
+	"""Stores transcoded files as <root>/<md5[:2]>/<md5>-<settings key><ext>.
+
+	Files are copied (or reflinked) in and out, never hard linked, because
+	tag_sync rewrites the destination in place. Using an entry updates its
+	mtime, and the least recently used entries are deleted once the cache grows
+	beyond max_bytes."""
+
+	def __init__(self, root, max_bytes):
+		self.root = root
+		self.max_bytes = max_bytes
+		self.size = None
+		self.added = 0
+
+	def _path(self, md5, settings, ext):
+		return os.path.join(self.root, md5[:2], '%s-%s%s' % (md5, settings_key(settings), ext))
+
+	def fetch(self, md5, settings, dest):
+		"""Copies the cached transcode of md5 to dest, returning whether there was one."""
+		path = self._path(md5, settings, os.path.splitext(dest)[1])
+		if not os.path.isfile(path):
+			return False
+		log.debug("Using cached transcode %s", path)
+		try:
+			_copy(path, dest)
+			os.utime(path, None)
+		except OSError:
+			log.warning("Could not copy cached transcode %s: %s", path, sys.exc_info()[1])
+			return False
+		return True
+
+	def store(self, md5, settings, source):
+		"""Adds a freshly transcoded file to the cache."""
+		path = self._path(md5, settings, os.path.splitext(source)[1])
+		try:
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			_copy(source, path)
+		except OSError:
+			log.warning("Could not add %s to the transcode cache: %s", source, sys.exc_info()[1])
+			return
+		if self.size is not None:
+			self.size += os.path.getsize(path)
+		self.added += 1
+		if self.size is None or self.size > self.max_bytes or self.added >= recount_interval:
+			self.evict()
+
+	def _entries(self):
+		entries = []
+		for d in os.scandir(self.root):
+			if not d.is_dir():
+				continue
+			for entry in os.scandir(d.path):
+				if entry.is_file() and not entry.name.endswith('.part'):
+					st = entry.stat()
+					entries.append((st.st_mtime, st.st_size, entry.path))
+		return entries
+
+	def evict(self):
+		"""Deletes the least recently used entries until the cache fits in max_bytes."""
+		entries = self._entries()
+		self.size = sum(size for (mtime, size, path) in entries)
+		self.added = 0
+		if self.size <= self.max_bytes:
+			return
+		entries.sort()
+		for (mtime, size, path) in entries:
+			if self.size <= self.max_bytes:
+				break
+			log.debug("Evicting %s from the transcode cache", path)
+			try:
+				os.remove(path)
+				self.size -= size
+			except OSError:
+				# Probably removed by another worker already
+				pass
+
+
+def _copy(source, dest):
+	"""Copies via a temporary file so a partial copy is never mistaken for a whole
+	one. A reflink is used where the file system supports it, which is safe as
+	the clone is copy-on-write."""
+	fastcopy.copy(source, dest)
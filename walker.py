@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""Single-pass directory tree walker shared by mediamirror, its prune step and
+playlist. Each directory is listed once with os.scandir and the entries are
+handed out with their (cached) stat results, rather than listing a directory
+and then calling os.path.isdir/islink on every name in it."""
+
+import os
+
+import logging
+log = logging.getLogger("mediamirror")
+
+
+class Directory(object):
+	"""One directory of the tree.
+
+	files maps the names of everything that isn't a directory to its
+	os.DirEntry, dirs lists the entries of the sub-directories that will be
+	walked next (callers may remove entries to stop the walk descending into
+	them) and links lists symbolic links to directories, which are not
+	followed."""
+	__slots__ = ('path', 'files', 'dirs', 'links')
+
+	def __init__(self, path):
+		self.path = path
+		self.files = dict()
+		self.dirs = list()
+		self.links = list()
+
+	def filenames(self):
+		return sorted(self.files.keys())
+
+
+def is_excluded(path, excluded_paths):
+	for pattern in excluded_paths:
+		if pattern in path:
+			return True
+	return False
+
+
+def scan(path):
+	"""Lists a single directory, returning a Directory."""
+	d = Directory(path)
+	with os.scandir(path) as it:
+		for entry in it:
+			if not entry.is_dir():
+				d.files[entry.name] = entry
+			elif entry.is_symlink():
+				d.links.append(entry)
+			else:
+				d.dirs.append(entry)
+	d.dirs.sort(key=lambda entry: entry.name)
+	d.links.sort(key=lambda entry: entry.name)
+	return d
+
+
+def _exclude(d, excluded_paths):
+	wanted = list()
+	for entry in d.dirs:
+		if is_excluded(entry.path, excluded_paths):
+			log.debug('Ignoring path: %s' % entry.path)
+		else:
+			wanted.append(entry)
+	d.dirs = wanted
+
+
+def walk(top, excluded_paths=(), io=None, onerror=None):
+	"""Walks a directory tree, yielding a Directory for top and then each
+	directory beneath it, depth first in name order. Directories whose path
+	contains one of excluded_paths are skipped without being listed. Given an
+	ioengine.IOEngine as io, the sub-directories of each directory are listed
+	concurrently, ahead of the caller getting to them. As with os.walk, a
+	directory that can't be listed (e.g. it has been removed since its parent
+	was) raises the OSError, unless onerror is given, in which case it is
+	called with the error and the directory is skipped."""
+	if io is not None and io.limit > 1:
+		for x in _walk_ahead(top, excluded_paths, io, onerror):
+			yield x
+		return
+	try:
+		d = scan(top)
+	except OSError as e:
+		if onerror is None:
+			raise
+		onerror(e)
+		return
+	_exclude(d, excluded_paths)
+	yield d
+	for entry in d.dirs:
+		for x in walk(entry.path, excluded_paths, onerror=onerror):
+			yield x
+
+
+def _walk_ahead(top, excluded_paths, io, onerror):
+	# Listings yet to be yielded, the next one last
+	pending = [ io.submit(scan, top) ]
+	while pending:
+		try:
+			d = pending.pop().result()
+		except OSError as e:
+			if onerror is None:
+				raise
+			onerror(e)
+			continue
+		_exclude(d, excluded_paths)
+		yield d
+		# Only now, as the caller may have removed some of d.dirs
+		pending.extend(io.submit(scan, entry.path) for entry in reversed(d.dirs))
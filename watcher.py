@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""Reports which source directories have changed, for mediamirror's --watch
+mode. InotifyWatcher uses Linux's inotify (through ctypes, so nothing needs to
+be installed) and PollingWatcher re-lists the tree now and then, for systems
+or network shares that don't deliver inotify events."""
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+import walker
+from state import directory_fingerprint
+from ioengine import stat_entry
+
+import logging
+log = logging.getLogger("mediamirror")
+
+# inotify event flags, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# What a change to the files in a directory looks like. IN_CREATE isn't
+# included for files as IN_CLOSE_WRITE follows once they have been written.
+watch_mask = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_ONLYDIR)
+
+_event = struct.Struct('iIII')
+
+
+class WatchError(Exception):
+	pass
+
+
+def _parent(error):
+	"""The parent of the directory an OSError from walking the tree is about."""
+	return os.path.dirname(error.filename)
+
+
+class InotifyWatcher(object):
+	"""Watches every directory below root (other than excluded ones) with inotify."""
+
+	def __init__(self, root, excluded_paths=()):
+		self.root = root
+		self.excluded_paths = excluded_paths
+		self.paths = dict()
+		self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		if not hasattr(self.libc, 'inotify_init1'):
+			raise WatchError('inotify is not available')
+		self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		if self.fd < 0:
+			raise WatchError('inotify_init1: %s' % os.strerror(ctypes.get_errno()))
+		try:
+			self.add_tree(root)
+		except WatchError:
+			self.close()
+			raise
+
+	def add_tree(self, top):
+		"""Watches top and every directory below it. Returns the set of the
+		parents of any that were removed before they could be listed, as those
+		have changed again."""
+		vanished = set()
+		self._add(top)
+		for d in walker.walk(top, self.excluded_paths, onerror=lambda e: vanished.add(_parent(e))):
+			for entry in d.dirs:
+				self._add(entry.path)
+		return vanished
+
+	def _add(self, path):
+		wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), watch_mask)
+		if wd < 0:
+			err = ctypes.get_errno()
+			if err == errno.ENOSPC:
+				raise WatchError('Too many directories to watch; raise fs.inotify.max_user_watches')
+			if err in (errno.ENOENT, errno.ENOTDIR):
+				# Removed again before it could be watched
+				return
+			raise WatchError('inotify_add_watch %s: %s' % (path, os.strerror(err)))
+		# Watching a directory that has moved gives back its existing wd
+		self.paths[wd] = path
+
+	def read(self, timeout):
+		"""Waits up to timeout seconds (forever if None) for events, returning
+		the set of directories whose contents changed."""
+		(readable, writable, failed) = select.select([ self.fd ], [], [], timeout)
+		changed = set()
+		if not readable:
+			return changed
+		data = os.read(self.fd, 65536)
+		offset = 0
+		while offset < len(data):
+			(wd, mask, cookie, length) = _event.unpack_from(data, offset)
+			offset += _event.size
+			name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+			offset += length
+			if mask & IN_Q_OVERFLOW:
+				log.warning('Missed some file system events; checking everything')
+				changed.add(self.root)
+				continue
+			directory = self.paths.get(wd)
+			if mask & IN_IGNORED:
+				self.paths.pop(wd, None)
+				continue
+			if directory is None:
+				continue
+			path = os.path.join(directory, name)
+			if walker.is_excluded(path, self.excluded_paths):
+				continue
+			changed.add(directory)
+			if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+				changed |= self.add_tree(path)
+		return changed
+
+	def close(self):
+		os.close(self.fd)
+
+
+class PollingWatcher(object):
+	"""Lists the tree every interval seconds and reports the directories whose
+	files (or sub-directories) have changed since the last time."""
+
+	def __init__(self, root, excluded_paths=(), interval=60.0, io=None):
+		self.root = root
+		self.excluded_paths = excluded_paths
+		self.interval = interval
+		self.io = io
+		# Parents of directories removed while the tree was being listed
+		self.vanished = set()
+		self.snapshot = self._snapshot()
+		self.next_poll = time.time() + interval
+
+	def _snapshot(self):
+		snapshot = dict()
+		for d in walker.walk(self.root, self.excluded_paths, self.io, lambda e: self.vanished.add(_parent(e))):
+			if self.io is not None:
+				self.io.map(stat_entry, d.files.values())
+			try:
+				snapshot[d.path] = directory_fingerprint(d.path, d.files)
+			except OSError:
+				self.vanished.add(os.path.dirname(d.path))
+		return snapshot
+
+	def read(self, timeout):
+		wait = self.next_poll - time.time()
+		if timeout is not None and timeout < wait:
+			time.sleep(max(timeout, 0))
+			return set()
+		time.sleep(max(wait, 0))
+		self.next_poll = time.time() + self.interval
+		snapshot = self._snapshot()
+		changed = self.vanished
+		self.vanished = set()
+		for (path, fingerprint) in snapshot.items():
+			if self.snapshot.get(path) != fingerprint:
+				changed.add(path)
+		for path in self.snapshot:
+			if path not in snapshot:
+				changed.add(os.path.dirname(path))
+		self.snapshot = snapshot
+		return changed
+
+	def close(self):
+		pass
+
+
+def create(root, excluded_paths=(), poll=False, poll_interval=60.0, io=None):
+	"""Returns an InotifyWatcher for root, or a PollingWatcher if poll is set
+	or inotify can't be used. A PollingWatcher lists the tree with io (an
+	ioengine.IOEngine), if given."""
+	if not poll:
+		try:
+			return InotifyWatcher(root, excluded_paths)
+		except (WatchError, OSError):
+			log.warning('Cannot watch %s with inotify (%s); polling every %gs instead',
+			            root, sys.exc_info()[1], poll_interval)
+	return PollingWatcher(root, excluded_paths, poll_interval, io)
+
+
+def outermost(paths):
+	"""Drops the paths that are below another one in paths."""
+	result = list()
+	for path in sorted(paths, key=lambda path: path.split(os.sep)):
+		if result and (path == result[-1] or path.startswith(result[-1].rstrip(os.sep) + os.sep)):
+			continue
+		result.append(path)
+	return result
+
+
+def batches(watcher, delay=2.0, max_delay=30.0):
+	"""Yields lists of changed directories, once no more changes have been seen
+	for delay seconds (so a tagger rewriting an album is dealt with in one go),
+	or max_delay seconds after the first change if they keep coming."""
+	pending = set()
+	first = last = None
+	while True:
+		timeout = None
+		if pending:
+			now = time.time()
+			timeout = max(0, min(last + delay, first + max_delay) - now)
+		changed = watcher.read(timeout)
+		now = time.time()
+		if changed:
+			pending |= changed
+			last = now
+			if first is None:
+				first = now
+		if pending and (now - last >= delay or now - first >= max_delay):
+			yield outermost(pending)
+			pending = set()
+			first = last = None